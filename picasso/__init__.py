@@ -9,18 +9,50 @@ import os
 import sys
 from picasso.interfaces.rest import API
 from picasso.interfaces.web import frontend
+from picasso.utils import release_model_entry, start_warm_up
 
 if sys.version_info.major < 3 or (sys.version_info.major == 3 and
                                   sys.version_info.minor < 5):
     raise SystemError('Python 3.5+ required, found {}'.format(sys.version))
 
 
+class PicassoApp(Flask):
+    """Flask app that starts warming up the default model when it begins
+    serving, see `WARM_UP_ON_START`.
+
+    """
+
+    def start_warm_up(self):
+        """Load and warm up the default model in a background thread.
+
+        Called by :meth:`run`.  WSGI servers that import the app instead
+        should call it once the worker process has started, e.g. from
+        gunicorn's `post_worker_init` hook.
+
+        """
+        with self.app_context():
+            start_warm_up()
+
+    def run(self, host=None, port=None, debug=None, load_dotenv=True,
+            **options):
+        use_reloader = options.get('use_reloader',
+                                   self.debug if debug is None else debug)
+        # with the reloader, only the child process serves requests
+        if self.config['WARM_UP_ON_START'] and (
+                not use_reloader or
+                os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+            self.start_warm_up()
+        super().run(host=host, port=port, debug=debug,
+                    load_dotenv=load_dotenv, **options)
+
+
 def create_app(debug=False):
-    _app = Flask(__name__)
+    _app = PicassoApp(__name__)
     _app.debug = debug
     _app.config.from_object('picasso.config.Default')
     _app.register_blueprint(API, url_prefix='/api')
     _app.register_blueprint(frontend, url_prefix='/')
+    _app.teardown_appcontext(release_model_entry)
 
     # Use a bogus secret key for debugging ease. No client information is stored;
     # the secret key is only necessary for generating the session cookie.
@@ -0,0 +1,139 @@
+###############################################################################
+# Copyright (c) 2017 Merantix GmbH
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+"""Content-addressed storage of uploaded files
+
+Uploads are stored once per content, under their SHA-256 hash, and shared
+by all sessions which uploaded them.  Every session holding a file counts
+as a reference; a file is deleted when its last reference is released.
+
+"""
+import os
+import shutil
+import tempfile
+import threading
+
+from picasso.cache import hash_stream
+
+
+class BlobStore:
+    """Reference-counted files addressed by the hash of their content."""
+
+    def __init__(self, root=None):
+        """Create a new blob store.
+
+        Args:
+            root (:obj:`str`): directory holding the files.  A temporary
+                directory is used if this is `None`.
+
+        """
+        self.root = root or tempfile.mkdtemp(prefix='picasso-blobs-')
+        os.makedirs(self.root, exist_ok=True)
+        self._refs = {}
+        self._sizes = {}
+        self._usage = 0
+        self._writing = {}
+        self._lock = threading.Lock()
+
+    def path(self, digest):
+        """Path of the file with the given hash."""
+        return os.path.join(self.root, digest[:2], digest)
+
+    def __contains__(self, digest):
+        with self._lock:
+            return digest in self._refs
+
+    def put(self, fp, digest=None):
+        """Store the content of a file object and add a reference to it.
+
+        The content is only written if no file with the same content is
+        stored yet.
+
+        Args:
+            fp: seekable file object, read from its current position.
+            digest (:obj:`str`): SHA-256 hex digest of the content, if it
+                is known already.
+
+        Returns:
+            :obj:`str` digest of the content
+
+        """
+        start = fp.tell()
+        if digest is None:
+            digest = hash_stream(fp)
+        while True:
+            with self._lock:
+                writing = self._writing.get(digest)
+                if writing is None:
+                    if digest in self._refs:
+                        self._refs[digest] += 1
+                        return digest
+                    writing = self._writing[digest] = threading.Event()
+                    break
+            # the same content is being written by another upload
+            writing.wait()
+
+        path = self.path(digest)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fp.seek(start)
+            with tempfile.NamedTemporaryFile(dir=self.root, prefix='.tmp-',
+                                             delete=False) as tmp:
+                shutil.copyfileobj(fp, tmp)
+            os.rename(tmp.name, path)
+            with self._lock:
+                self._refs[digest] = 1
+                self._sizes[digest] = os.path.getsize(path)
+                self._usage += self._sizes[digest]
+        finally:
+            with self._lock:
+                del self._writing[digest]
+            writing.set()
+        return digest
+
+    def release(self, digest):
+        """Remove a reference to a file, deleting the file if it was the
+        last one."""
+        with self._lock:
+            self._release(digest)
+
+    def _release(self, digest):
+        # must be called with self._lock held
+        if digest not in self._refs:
+            return
+        self._refs[digest] -= 1
+        if self._refs[digest] <= 0:
+            del self._refs[digest]
+            self._usage -= self._sizes.pop(digest, 0)
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                pass
+
+    def reset_references(self, counts):
+        """Set the reference counts of all files, e.g. after a restart, and
+        delete the files without references.
+
+        Args:
+            counts (:obj:`dict`): number of references by digest.
+
+        """
+        with self._lock:
+            self._refs = {digest: count for digest, count in counts.items()
+                          if count > 0 and os.path.exists(self.path(digest))}
+            self._sizes = {digest: os.path.getsize(self.path(digest))
+                           for digest in self._refs}
+            self._usage = sum(self._sizes.values())
+            for dirpath, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    if filename not in self._refs:
+                        os.remove(os.path.join(dirpath, filename))
+
+    def usage(self):
+        """Bytes taken up by the stored files."""
+        with self._lock:
+            return self._usage
@@ -0,0 +1,334 @@
+###############################################################################
+# Copyright (c) 2017 Merantix GmbH
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+"""Content-addressed caches
+
+Visualization results are addressed by the content of their inputs, the
+visualizer, its settings and the model checkpoint, so identical requests
+can be answered without running the model again.  Predictions are memoized
+per image content in the same way.
+
+"""
+from collections import OrderedDict
+from concurrent.futures import Future
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+
+def hash_stream(fp, chunk_size=2 ** 20):
+    """SHA-256 hex digest of the rest of a file object's content."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fp.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_image(image):
+    """SHA-256 hex digest of a PIL image's pixels, mode and size."""
+    digest = hashlib.sha256()
+    digest.update('{} {}x{}'.format(image.mode, *image.size).encode('ascii'))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def result_files(result):
+    """Names of the files in the output directory a visualization result
+    refers to.
+
+    Args:
+        result (:obj:`dict`): a single result of `make_visualization`.
+
+    Returns:
+        :obj:`list` of filenames
+
+    """
+    filenames = list(result.get('output_file_names') or [])
+    if result.get('has_processed_input'):
+        filenames.append(result['processed_input_file_name'])
+    return filenames
+
+
+def copy_result_files(results, src_dir, dst_dir):
+    """Copy the files of visualization results to another directory.
+
+    Args:
+        results (:obj:`list`): return value of `make_visualization`.
+        src_dir (:obj:`str`): directory the files were written to.
+        dst_dir (:obj:`str`): directory to copy them to.
+
+    """
+    if os.path.abspath(src_dir) == os.path.abspath(dst_dir):
+        return
+    for result in results:
+        for filename in result_files(result):
+            shutil.copyfile(os.path.join(src_dir, filename),
+                            os.path.join(dst_dir, filename))
+
+
+class SingleFlight:
+    """Deduplicate concurrent calls with the same key.
+
+    While a call for a key is running, further calls for that key wait for
+    it and receive its result instead of doing the same work again.
+
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Call `fn`, unless a call with the same key is already running.
+
+        Args:
+            key: hashable identifier of the work done by `fn`.
+            fn: callable without arguments.
+
+        Returns:
+            :obj:`tuple` of the return value of `fn` and a flag which is
+            `True` if the value was computed by another caller.  Exceptions
+            are raised in all waiting callers.
+
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            shared = future is not None
+            if not shared:
+                future = Future()
+                self._calls[key] = future
+        if shared:
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return result, False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class LRUCache:
+    """Thread-safe mapping which keeps only its most recently used items."""
+
+    def __init__(self, max_size=128):
+        """Create a new cache.
+
+        Args:
+            max_size (int): maximum number of items.
+
+        """
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Look up an item and mark it as recently used."""
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def put(self, key, value):
+        """Add an item, evicting the least recently used ones if the cache
+        is full."""
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def clear(self):
+        """Remove all items."""
+        with self._lock:
+            self._items.clear()
+
+
+class ResultCache:
+    """Two-tier cache of visualization results.
+
+    Results and the files they refer to are kept in an in-memory LRU tier
+    and in a directory on disk, whose total size is bounded by evicting the
+    least recently used entries.
+
+    """
+
+    def __init__(self, memory_entries=256, disk_dir=None,
+                 disk_bytes=512 * 2 ** 20):
+        """Create a new result cache.
+
+        Args:
+            memory_entries (int): maximum number of results in memory.
+            disk_dir (:obj:`str`): directory of the disk tier.  A temporary
+                directory is created if this is `None`.
+            disk_bytes (int): maximum size of the disk tier in bytes.  Set to
+                0 to disable the disk tier.
+
+        """
+        self.memory = LRUCache(memory_entries)
+        self.disk_bytes = disk_bytes
+        self.disk_dir = None
+        if disk_bytes:
+            self.disk_dir = disk_dir or tempfile.mkdtemp(
+                prefix='picasso-cache-')
+            os.makedirs(self.disk_dir, exist_ok=True)
+        self._disk_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(input_hashes, vis_name, settings, model_id):
+        """Address of a visualization result.
+
+        Args:
+            input_hashes (:obj:`list` of :obj:`str`): content hashes of the
+                input images.
+            vis_name (:obj:`str`): name of the visualization class.
+            settings (:obj:`dict`): settings of the visualization.
+            model_id: anything identifying the model and its checkpoint.
+
+        Returns:
+            :obj:`str` key
+
+        """
+        description = json.dumps([list(input_hashes), vis_name,
+                                  sorted(dict(settings or {}).items()),
+                                  model_id], default=str)
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def get(self, key, output_dir):
+        """Look up a result and restore its files into `output_dir`.
+
+        Args:
+            key (:obj:`str`): address of the result, see `make_key`.
+            output_dir (:obj:`str`): directory to write the result's files
+                to.
+
+        Returns:
+            The cached result of `make_visualization`, or `None`.
+
+        """
+        entry = self.memory.get(key)
+        if entry is None:
+            entry = self._read_disk(key)
+            if entry is None:
+                return None
+            self.memory.put(key, entry)
+        results, files = entry
+        for filename, data in files.items():
+            path = os.path.join(output_dir, filename)
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.write(data)
+        return json.loads(results)
+
+    def put(self, key, results, output_dir):
+        """Store the results of a visualization call.
+
+        Args:
+            key (:obj:`str`): address of the result, see `make_key`.
+            results (:obj:`list`): return value of `make_visualization`.
+            output_dir (:obj:`str`): directory the visualization wrote its
+                files to.
+
+        """
+        files = {}
+        for result in results:
+            for filename in result_files(result):
+                with open(os.path.join(output_dir, filename), 'rb') as f:
+                    files[filename] = f.read()
+        # store results serialized, so callers can't modify cached values
+        entry = (json.dumps(results), files)
+        self.memory.put(key, entry)
+        if self.disk_dir:
+            self._write_disk(key, entry)
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        entry_dir = os.path.join(self.disk_dir, key)
+        try:
+            with open(os.path.join(entry_dir, 'results.json')) as f:
+                results = f.read()
+            files = {}
+            for filename in os.listdir(entry_dir):
+                if filename != 'results.json':
+                    with open(os.path.join(entry_dir, filename), 'rb') as f:
+                        files[filename] = f.read()
+            # mark as recently used
+            os.utime(entry_dir)
+        except OSError:
+            return None
+        return results, files
+
+    def _write_disk(self, key, entry):
+        results, files = entry
+        entry_dir = os.path.join(self.disk_dir, key)
+        if os.path.isdir(entry_dir):
+            return
+        # write into a temporary directory first, so readers never see
+        # partial entries
+        tmp_dir = tempfile.mkdtemp(dir=self.disk_dir, prefix='.tmp-')
+        with open(os.path.join(tmp_dir, 'results.json'), 'w') as f:
+            f.write(results)
+        for filename, data in files.items():
+            with open(os.path.join(tmp_dir, filename), 'wb') as f:
+                f.write(data)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another thread stored the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self._evict_disk()
+
+    def disk_usage(self):
+        """Size of the disk tier in bytes."""
+        return sum(size for _, _, size in self._disk_entries())
+
+    def _disk_entries(self):
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if name.startswith('.'):
+                continue
+            entry_dir = os.path.join(self.disk_dir, name)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, filename))
+                           for filename in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), entry_dir, size))
+            except OSError:
+                continue
+        return entries
+
+    def _evict_disk(self):
+        with self._disk_lock:
+            entries = sorted(self._disk_entries())
+            total = sum(size for _, _, size in entries)
+            for _, entry_dir, size in entries:
+                if total <= self.disk_bytes:
+                    break
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
@@ -0,0 +1,85 @@
+###############################################################################
+# Copyright (c) 2017 Merantix GmbH
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+"""Command line interface
+
+Installed as the `picasso` command.  The commands use the app's settings,
+so set `PICASSO_SETTINGS` as for running the app.
+
+"""
+import os
+
+import click
+
+
+@click.group()
+def main():
+    """Picasso, a CNN model visualizer."""
+
+
+@main.command()
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--model', 'model_name', default=None,
+              help='Name of the model in the MODELS setting.  Defaults to '
+                   'the default model.')
+def freeze(output_dir, model_name):
+    """Freeze a model into an inference-only graph.
+
+    Loads the configured model and its visualizations, and writes a frozen
+    graph with the ops they need to OUTPUT_DIR, together with its metadata.
+    Serve it with the FrozenModel class of picasso/models/frozen.py and
+    OUTPUT_DIR as its data_dir.
+
+    """
+    from flask import g
+    from picasso import app
+    from picasso.models.frozen import freeze_model
+    from picasso.utils import (
+        get_model,
+        get_model_configs,
+        get_model_name,
+        get_visualizations
+    )
+
+    os.makedirs(output_dir, exist_ok=True)
+    with app.app_context():
+        if model_name is not None:
+            if model_name not in get_model_configs():
+                raise click.BadParameter('Unknown model {}'.format(model_name),
+                                         param_hint='--model')
+            g.model_name = model_name
+        spec = get_model_configs()[get_model_name()]
+        model = get_model()
+        # the visualizations add the ops they need to the graph
+        get_visualizations()
+        name = os.path.basename(model.latest_ckpt_name or 'model')
+        path = os.path.join(output_dir,
+                            '{}.pb'.format(os.path.splitext(name)[0]))
+        metadata = freeze_model(model, path, spec['MODEL_CLS_PATH'],
+                                spec['MODEL_CLS_NAME'])
+    click.echo('Froze {} ({} nodes) to {}'.format(
+        metadata['model_cls_name'], metadata['num_nodes'], path))
+
+
+@main.command()
+@click.option('--host', default='127.0.0.1', show_default=True,
+              help='Interface to bind to.')
+@click.option('--port', default=5000, show_default=True,
+              help='Port to bind to.')
+@click.option('--debug', is_flag=True,
+              help='Enable the debugger and the reloader.')
+def serve(host, port, debug):
+    """Run the development server.
+
+    Unlike `flask run`, the default model starts loading and warming up
+    as soon as the server starts (see `WARM_UP_ON_START`), so the first
+    requests don't pay for it.
+
+    """
+    from picasso import app
+
+    app.run(host=host, port=port, debug=debug)
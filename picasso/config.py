@@ -40,3 +40,153 @@ class Default:
     MODEL_LOAD_ARGS = {
         'data_dir': os.path.join(base_dir, 'examples', 'keras', 'data-volume'),
     }
+
+    # :obj:`dict`: models to serve, by name, each a dict with the keys
+    # 'MODEL_CLS_PATH', 'MODEL_CLS_NAME' and 'MODEL_LOAD_ARGS'.  Requests
+    # select a model with the `model` parameter.  If empty, only the model
+    # of the settings above is served.
+    MODELS = {}
+
+    # :obj:`str`: name of the model in `MODELS` used by requests which don't
+    # select one.  Defaults to the first name in alphabetical order.
+    DEFAULT_MODEL = None
+
+    # :obj:`int`: maximum number of models kept loaded at once.  The least
+    # recently used idle models are unloaded to stay below it.  `None`
+    # means no limit.
+    MAX_LOADED_MODELS = None
+
+    # :obj:`int`: maximum bytes held by the parameters of all loaded
+    # models, enforced like `MAX_LOADED_MODELS`.  `None` means no limit.
+    MODEL_MEMORY_BUDGET = None
+
+    # :obj:`dict`: dictionary mapping visualization class names to dicts of
+    # args to pass to the constructor of the visualization.  E.g. the memory
+    # budgets (in bytes) of the partial occlusion sweep and of the saliency
+    # gradients.
+    VISUALIZATION_ARGS = {
+        'PartialOcclusion': {'memory_budget': 128 * 2 ** 20},
+        'SaliencyMaps': {'memory_budget': 16 * 2 ** 20},
+    }
+
+    # :obj:`int`: maximum number of examples that concurrent requests
+    # may share in one run of the model.  Set to 0 to run every request
+    # on its own.
+    INFERENCE_MAX_BATCH_SIZE = 32
+
+    # :obj:`float`: maximum number of seconds a request waits for other
+    # requests to share its batch.
+    INFERENCE_MAX_DELAY = 0.005
+
+    # :obj:`int`: maximum number of images whose predictions are memoized
+    # and shared between visualizations.  Their preprocessed arrays are
+    # kept for `UPLOAD_CACHE_ENTRIES` images.
+    PREDICTION_MEMO_SIZE = 64
+
+    # :obj:`float`: seconds between checks of the model's `data_dir` for
+    # new checkpoints.  A new checkpoint is loaded in the background and
+    # replaces the running model without downtime.  Set to 0 to load the
+    # model only once.
+    CHECKPOINT_POLL_INTERVAL = 10
+
+    # :obj:`list` of :obj:`int`: sizes of the synthetic batches run through
+    # the prediction and gradient paths of a model after it has been loaded,
+    # before it serves requests.  An empty list only builds the fetches.
+    WARMUP_BATCH_SIZES = [1, 8]
+
+    # :obj:`bool`: start loading and warming up the default model when the
+    # server starts, instead of on the first request or readiness probe
+    # that needs it.  See ``picasso serve``.
+    WARM_UP_ON_START = True
+
+    # :obj:`int`: maximum number of visualization results kept in memory.
+    RESULT_CACHE_ENTRIES = 256
+
+    # :obj:`str`: directory of the on-disk result cache.  A temporary
+    # directory is used if this is `None`.
+    RESULT_CACHE_DIR = None
+
+    # :obj:`int`: maximum size of the on-disk result cache in bytes.  Set to
+    # 0 to disable the on-disk tier.
+    RESULT_CACHE_DISK_BYTES = 512 * 2 ** 20
+
+    # :obj:`int`: number of visualizations that run at the same time.
+    # Requests to `/api/visualize` and `/api/jobs` queue up for these
+    # workers, cheapest first.
+    JOB_WORKERS = 4
+
+    # :obj:`int`: maximum estimated cost, in forward passes of single
+    # images, of a request to `/api/visualize` that runs right away in the
+    # request's thread instead of queueing for a worker, so cheap
+    # visualizations stay responsive while the workers are busy.
+    JOB_INLINE_MAX_COST = 10
+
+    # :obj:`float`: estimated cost by which a queued visualization moves
+    # ahead of newer ones per second it waits, so a steady stream of cheap
+    # requests can't hold back an expensive one forever.  `None` starts the
+    # cheapest first, regardless of waiting time.
+    JOB_AGING_RATE = 100
+
+    # :obj:`float`: seconds `/api/visualize` and `/api/visualize/batch` wait
+    # for a queued visualization.  After that they respond with the job's
+    # status, and the result can be fetched from `/api/jobs`.
+    VISUALIZE_TIMEOUT = 30
+
+    # :obj:`int`: maximum estimated cost, in forward passes of single
+    # images, of all queued and running visualizations.  Further requests
+    # are rejected with status 503.  Set to `None` to accept all requests.
+    JOB_MAX_BACKLOG = 10000
+
+    # :obj:`int`: number of finished jobs whose results are kept for polling.
+    JOB_HISTORY_SIZE = 1000
+
+    # :obj:`str`: where user sessions are stored, either 'memory' or
+    # 'sqlite'.  A subclass of :class:`picasso.sessions.BaseSessionStore` may
+    # be given instead.  The session cookie only holds the session id.
+    SESSION_BACKEND = 'memory'
+
+    # :obj:`dict`: dictionary of args to pass to the constructor of the
+    # session store, e.g. `{'path': '/var/lib/picasso/sessions.db'}` for
+    # 'sqlite'.  A database, like `STORAGE_ROOT`, must only be used by one
+    # server process at a time.
+    SESSION_BACKEND_ARGS = {}
+
+    # :obj:`str`: directory below which the uploads and outputs of each
+    # session are stored.  A temporary directory is used if this is `None`.
+    # It must not be shared by several server processes.
+    STORAGE_ROOT = None
+
+    # :obj:`int`: maximum number of bytes of uploads and outputs per session.
+    STORAGE_SESSION_QUOTA = 256 * 2 ** 20
+
+    # :obj:`int`: maximum number of bytes of uploads and outputs of all
+    # sessions.  Idle sessions are deleted to stay below it.
+    STORAGE_GLOBAL_QUOTA = 4 * 2 ** 30
+
+    # :obj:`float`: seconds after its last request at which a session and
+    # its files are deleted.
+    SESSION_TTL = 3600
+
+    # :obj:`float`: seconds between two searches for expired sessions.
+    STORAGE_GC_INTERVAL = 60
+
+    # :obj:`float`: minimum seconds between two searches for idle sessions
+    # to delete when the global quota is used up.  In between, requests
+    # that need more space are refused right away.
+    STORAGE_MIN_COLLECT_INTERVAL = 1
+
+    # :obj:`int`: maximum size of a request, and thus of an upload, in bytes.
+    MAX_CONTENT_LENGTH = 32 * 2 ** 20
+
+    # :obj:`int`: maximum number of pixels of an uploaded image.
+    UPLOAD_MAX_PIXELS = 50 * 10 ** 6
+
+    # :obj:`tuple`: (width, height) uploads are scaled down to fit into when
+    # they are decoded.  It should be at least the input size of the model
+    # and the output size of the visualizations.  JPEG images are decoded
+    # at reduced resolution directly.
+    UPLOAD_DECODE_SIZE = (512, 512)
+
+    # :obj:`int`: maximum number of decoded uploads kept in memory, and of
+    # their arrays preprocessed for each model.
+    UPLOAD_CACHE_ENTRIES = 128
@@ -38,23 +38,9 @@ class KerasVGG16Model(KerasModel):
         all_raw_inputs = np.array(image_arrays)
         return imagenet_utils.preprocess_input(all_raw_inputs)
 
-    def decode_prob(self, class_probabilities):
-        r = imagenet_utils.decode_predictions(class_probabilities,
-                                              top=self.top_probs)
-        results = [
-            [{'code': entry[0],
-              'name': entry[1],
-              'prob': '{:.3f}'.format(entry[2])}
-             for entry in row]
-            for row in r
-        ]
+    def load_class_table(self, num_classes):
+        # make Keras download and load the ImageNet class index
+        imagenet_utils.decode_predictions(np.zeros((1, num_classes)), top=1)
         classes = imagenet_utils.CLASS_INDEX
-        class_keys = list(classes.keys())
-        class_values = list(classes.values())
-
-        for result in results:
-            for entry in result:
-                entry['index'] = int(
-                    class_keys[class_values.index([entry['code'],
-                                                   entry['name']])])
-        return results
+        return {'code': [classes[str(i)][0] for i in range(num_classes)],
+                'name': [classes[str(i)][1] for i in range(num_classes)]}
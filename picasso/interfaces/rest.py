@@ -14,50 +14,99 @@
 This is used by the main flask application to provide a REST API.
 """
 
-import os
-import shutil
 import logging
-from tempfile import mkdtemp
+import mimetypes
 
-from PIL import Image
 from werkzeug.utils import secure_filename
 from flask import (
     Blueprint,
     current_app,
+    g,
     jsonify,
     session,
     request,
+    send_file,
     send_from_directory)
 from picasso import __version__
+from picasso.cache import hash_stream
+from picasso.jobs import Job, JobTimeout, Overloaded
+from picasso.storage import QuotaExceeded
+from picasso.uploads import InvalidUpload
 from picasso.utils import (
     get_app_state,
-    get_visualizations
+    get_decoded_images,
+    get_job_manager,
+    get_model,
+    get_model_configs,
+    get_model_name,
+    get_readiness,
+    get_session_store,
+    get_storage_manager,
+    get_visualizations,
+    list_models,
+    open_inputs,
+    run_visualization
 )
 
 API = Blueprint('api', __name__)
 logger = logging.getLogger(__name__)
 
+# endpoints polled by load balancers, which must not create sessions
+_SESSIONLESS_ENDPOINTS = {'api.health_live', 'api.health_ready'}
+
 
 @API.before_request
 def initialize_new_session():
     """Check session and initialize if necessary
 
     Before every request, check the user session.  If no session exists, add
-    one and provide temporary locations for images
+    one and provide a temporary location for output images.  The session
+    cookie only holds the session id; the session itself is kept in the
+    session store.
 
     """
-    if 'image_uid_counter' in session and 'image_list' in session:
-        logger.debug('images are already being tracked')
-    else:
-        # reset image list counter for the session
-        session['image_uid_counter'] = 0
-        session['image_list'] = []
-    if 'img_input_dir' in session and 'img_output_dir' in session:
-        logger.debug('temporary image directories already exist')
+    if request.endpoint in _SESSIONLESS_ENDPOINTS:
+        return
+    store = get_session_store()
+    sid = session.get('sid')
+    data = store.get(sid) if sid else None
+    if data is not None:
+        logger.debug('session already exists')
     else:
-        # make image upload directory
-        session['img_input_dir'] = mkdtemp()
-        session['img_output_dir'] = mkdtemp()
+        # make image output directory
+        data = get_storage_manager().create_session_dirs()
+        data['settings'] = {}
+        sid = store.create(data)
+        session['sid'] = sid
+    g.sid = sid
+    g.session_data = data
+
+
+@API.before_request
+def select_model():
+    """Use the model named by the `model` parameter of the request, if any
+
+    For JSON requests, the model may also be given in the body.
+
+    """
+    name = request.values.get('model')
+    if name is None and request.is_json:
+        name = (request.get_json(silent=True) or {}).get('model')
+    if name is not None:
+        if name not in get_model_configs():
+            return jsonify(ok=False, error='Unknown model {}'.format(name),
+                           code=404), 404
+        g.model_name = name
+
+
+def _get_session_image(uid):
+    """(filename, path, content hash) of an image of the current session,
+    or `None`"""
+    image = get_session_store().get_image(g.sid, uid)
+    if image is None:
+        return None
+    return (image['filename'], get_storage_manager().upload_path(image),
+            image['hash'])
 
 
 @API.route('/', methods=['GET'])
@@ -80,11 +129,38 @@ def app_state():
     return jsonify(state)
 
 
+@API.route('/health/live', methods=['GET'])
+def health_live():
+    """Report that the server process is up, whether or not it can serve
+    visualizations yet"""
+    return jsonify(alive=True)
+
+
+@API.route('/health/ready', methods=['GET'])
+def health_ready():
+    """Report whether the default model is loaded and warmed up
+
+    Responds with status code 503 until it is, and starts loading it in the
+    background on the first call.
+
+    """
+    readiness = get_readiness()
+    return jsonify(readiness), 200 if readiness['ready'] else 503
+
+
+@API.route('/models', methods=['GET'])
+def models():
+    """List the models served by the app and whether they are loaded"""
+    return jsonify(models=list_models())
+
+
 @API.route('/images', methods=['POST', 'GET'])
 def images():
     """Upload images via REST interface
 
-    Check if file upload was successful and sanatize user input.
+    Check if file upload was successful and sanatize user input.  Uploads
+    are stored by the hash of their content, so a file uploaded before, by
+    any session, is neither decoded nor written again.
 
     TODO: return file URL instead of filename
 
@@ -92,21 +168,27 @@ def images():
     if request.method == 'POST':
         file_upload = request.files['file']
         if file_upload:
-            image = dict()
-            image['filename'] = secure_filename(file_upload.filename)
-            full_path = os.path.join(session['img_input_dir'],
-                                     image['filename'])
-            file_upload.save(full_path)
-            image['uid'] = session['image_uid_counter']
-            session['image_uid_counter'] += 1
+            storage = get_storage_manager()
+            stream = file_upload.stream
+            digest = hash_stream(stream)
+            stream.seek(0)
+            decoded = None
+            if digest not in storage.blobs:
+                # decode once, here, and reject anything that isn't an image
+                decoded = get_decoded_images().decode(stream)
+                stream.seek(0)
+            image = storage.add_upload(
+                g.sid, g.session_data, stream,
+                secure_filename(file_upload.filename), digest)
+            if decoded is not None:
+                get_decoded_images().put(digest, decoded)
             current_app.logger.debug('File %d is saved as %s',
                                      image['uid'],
                                      image['filename'])
-            session['image_list'].append(image)
             return jsonify(ok="true", file=image['filename'], uid=image['uid'])
         return jsonify(ok="false")
     if request.method == 'GET':
-        return jsonify(images=session['image_list'])
+        return jsonify(images=get_session_store().list_images(g.sid))
 
 
 @API.route('/visualizers', methods=['GET'])
@@ -129,41 +211,237 @@ def visualizers_information(vis_name):
     return jsonify(settings=vis.ALLOWED_SETTINGS)
 
 
-@API.route('/visualize', methods=['GET'])
-def visualize():
-    """Trigger a visualization via the REST API
+def _get_visualization_request():
+    """Parse the visualizer, its settings and the input image of a request
 
-    Takes a single image and generates the visualization data, returning the
-    output exactly as given by the target visualization.
+    Returns:
+        :obj:`tuple` of the visualization, its parsed settings and a list of
+        (filename, path, content hash) of the input images
 
     """
-
-    session['settings'] = {}
-    image_uid = request.args.get('image')
-    vis_name = request.args.get('visualizer')
+    user_settings = {}
+    image_uid = request.values.get('image')
+    vis_name = request.values.get('visualizer')
     vis = get_visualizations()[vis_name]
     if vis.ALLOWED_SETTINGS:
         for key in vis.ALLOWED_SETTINGS.keys():
-            if request.args.get(key) is not None:
-                session['settings'][key] = request.args.get(key)
+            if request.values.get(key) is not None:
+                user_settings[key] = request.values.get(key)
             else:
-                session['settings'][key] = vis.ALLOWED_SETTINGS[key][0]
+                user_settings[key] = vis.ALLOWED_SETTINGS[key][0]
     else:
         logger.debug('Selected Visualizer {0} has no settings.'.format(vis_name))
-    inputs = []
-    for image in session['image_list']:
-        if image['uid'] == int(image_uid):
-            full_path = os.path.join(session['img_input_dir'],
-                                     image['filename'])
-            entry = dict()
-            entry['filename'] = image['filename']
-            entry['data'] = Image.open(full_path)
-            inputs.append(entry)
+    get_session_store().update(g.sid, settings=user_settings)
+    settings = vis.parse_settings(user_settings)
+    image = _get_session_image(int(image_uid))
+    images = [image] if image is not None else []
+    get_storage_manager().reserve_output(g.sid, g.session_data)
+    return vis, settings, images
+
+
+def _submit_visualization(vis, settings, images):
+    """Queue a visualization for the job workers, prioritized by its
+    estimated cost."""
+    output_dir = g.session_data['img_output_dir']
+    app = current_app._get_current_object()
+    vis_name = type(vis).__name__
+    model_name = get_model_name()
+
+    def work():
+        with app.app_context():
+            g.model_name = model_name
+            # runs with the model current when the job starts, which may
+            # have been reloaded since the job was queued
+            return run_visualization(get_visualizations()[vis_name], images,
+                                     output_dir, settings)[0]
+
+    return get_job_manager().submit(
+        work, cost=vis.estimate_cost(settings, len(images)))
 
-    vis.update_settings(session['settings'])
-    output = vis.make_visualization(
-        inputs, output_dir=session['img_output_dir'])
-    return jsonify(output[0])
+
+@API.route('/visualize', methods=['GET'])
+def visualize():
+    """Trigger a visualization via the REST API
+
+    Takes a single image and generates the visualization data, returning the
+    output exactly as given by the target visualization.
+
+    """
+    vis, settings, images = _get_visualization_request()
+    output_dir = g.session_data['img_output_dir']
+    # cached results and cheap visualizations don't queue for a worker
+    output = run_visualization(vis, images, output_dir, settings,
+                               cached_only=True)
+    if output is not None:
+        return jsonify(output[0])
+    if (vis.estimate_cost(settings, len(images)) <=
+            current_app.config['JOB_INLINE_MAX_COST']):
+        return jsonify(run_visualization(vis, images, output_dir,
+                                         settings)[0])
+    job = _submit_visualization(vis, settings, images)
+    return _wait_for_job(job)
+
+
+def _wait_for_job(job):
+    """Respond with the result of a job, or with its status if it takes
+    longer than `VISUALIZE_TIMEOUT`, so the client can poll for it."""
+    try:
+        return jsonify(job.wait(current_app.config['VISUALIZE_TIMEOUT']))
+    except JobTimeout:
+        return jsonify(job.to_dict()), 202
+
+
+def _bad_request(message):
+    return jsonify(ok=False, error=message, code=400), 400
+
+
+@API.route('/visualize/batch', methods=['POST'])
+def visualize_batch():
+    """Run several visualizations on several images at once
+
+    Expects a JSON body with a list of image uids and a list of
+    visualizers, each given by its name and optional settings.  The images
+    are decoded once and classified in a single batch, and every
+    visualization runs on all images together.
+
+    """
+    body = request.get_json(silent=True) or {}
+    images = []
+    for uid in body.get('images') or []:
+        try:
+            image = _get_session_image(int(uid))
+        except (TypeError, ValueError):
+            image = None
+        if image is None:
+            return _bad_request('Unknown image {}'.format(uid))
+        images.append(image)
+
+    available = get_visualizations()
+    requested = []
+    for spec in body.get('visualizers') or []:
+        if not isinstance(spec, dict):
+            spec = {'name': spec}
+        vis = available.get(spec.get('name'))
+        if vis is None:
+            return _bad_request('Unknown visualizer {}'
+                                .format(spec.get('name')))
+        try:
+            settings = vis.parse_settings(
+                {key: str(value)
+                 for key, value in (spec.get('settings') or {}).items()})
+        except ValueError as e:
+            return _bad_request(str(e))
+        requested.append((vis, settings))
+    if not images or not requested:
+        return _bad_request('At least one image and one visualizer are '
+                            'required')
+
+    get_storage_manager().reserve_output(g.sid, g.session_data)
+    output_dir = g.session_data['img_output_dir']
+    outputs = [run_visualization(vis, images, output_dir, settings,
+                                 cached_only=True)
+               for vis, settings in requested]
+    missing = [i for i, output in enumerate(outputs) if output is None]
+
+    def response(outputs):
+        return {'results': [{'visualizer': type(vis).__name__,
+                             'settings': dict(settings),
+                             'outputs': output}
+                            for (vis, settings), output in zip(requested,
+                                                               outputs)]}
+
+    if not missing:
+        return jsonify(response(outputs))
+
+    app = current_app._get_current_object()
+    model_name = get_model_name()
+
+    def work():
+        with app.app_context():
+            g.model_name = model_name
+            inputs = open_inputs(images)
+            # classify all images in one batch; the visualizations reuse
+            # the memoized predictions
+            get_model().preprocess_and_predict([inp['data']
+                                                for inp in inputs])
+            current = get_visualizations()
+            computed = list(outputs)
+            for i in missing:
+                computed[i] = run_visualization(
+                    current[type(requested[i][0]).__name__], images,
+                    output_dir, requested[i][1], inputs=inputs)
+            return response(computed)
+
+    cost = sum(requested[i][0].estimate_cost(requested[i][1], len(images))
+               for i in missing)
+    job = get_job_manager().submit(work, cost=cost)
+    return _wait_for_job(job)
+
+
+@API.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue a visualization for execution in the background
+
+    Takes the same parameters as `/visualize` and responds with the status
+    of the new job, including its `job_id`.
+
+    """
+    job = _submit_visualization(*_get_visualization_request())
+    return jsonify(job.to_dict()), 202
+
+
+def _job_not_found(job_id):
+    return jsonify(ok=False, error='Unknown job {}'.format(job_id),
+                   code=404), 404
+
+
+@API.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Get the status of a job"""
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return _job_not_found(job_id)
+    return jsonify(job.to_dict())
+
+
+@API.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """Get the output of a finished job
+
+    Responds with the output of the visualization once the job is done, and
+    with the job's status otherwise.
+
+    """
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return _job_not_found(job_id)
+    if job.status == Job.DONE:
+        return jsonify(job.result)
+    if job.status == Job.FAILED:
+        return jsonify(job.to_dict()), 500
+    if job.status == Job.CANCELLED:
+        return jsonify(job.to_dict()), 410
+    return jsonify(job.to_dict()), 202
+
+
+@API.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a job that has not started yet"""
+    manager = get_job_manager()
+    job = manager.get(job_id)
+    if job is None:
+        return _job_not_found(job_id)
+    cancelled = manager.cancel(job_id)
+    return jsonify(ok=cancelled, **job.to_dict())
+
+
+@API.route('/storage', methods=['GET'])
+def storage():
+    """Report the disk usage of the current session and of all sessions"""
+    usage = get_storage_manager().usage()
+    usage['session_bytes'] = get_storage_manager().session_usage(
+        g.sid, g.session_data)
+    return jsonify(usage)
 
 
 @API.route('/reset', methods=['GET'])
@@ -171,26 +449,50 @@ def reset():
     """Delete the session and clear temporary directories
 
     """
-    shutil.rmtree(session['img_input_dir'])
-    shutil.rmtree(session['img_output_dir'])
+    get_storage_manager().delete_session(g.sid, g.session_data)
     session.clear()
     return jsonify(ok='true')
 
 
 @API.route('/inputs/<filename>')
 def download_inputs(filename):
-    """For serving input images"""
-    return send_from_directory(session['img_input_dir'],
-                               filename)
+    """For serving input images
+
+    Serves the latest upload of the session with the given name.
+
+    """
+    image = get_session_store().find_image(g.sid, filename)
+    if image is None:
+        return jsonify(ok=False, error='Unknown image {}'.format(filename),
+                       code=404), 404
+    return send_file(get_storage_manager().upload_path(image),
+                     mimetype=mimetypes.guess_type(filename)[0])
 
 
 @API.route('/outputs/<filename>')
 def download_outputs(filename):
     """For serving output images"""
-    return send_from_directory(session['img_output_dir'],
+    return send_from_directory(g.session_data['img_output_dir'],
                                filename)
 
 
+@API.errorhandler(Overloaded)
+def overloaded_error(e):
+    response = jsonify(ok=False, error=str(e), code=503)
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+
+@API.errorhandler(InvalidUpload)
+def invalid_upload_error(e):
+    return jsonify(ok=False, error=str(e), code=400), 400
+
+
+@API.errorhandler(QuotaExceeded)
+def quota_exceeded_error(e):
+    return jsonify(ok=False, error=str(e), code=413), 413
+
+
 @API.errorhandler(500)
 def internal_server_error(e):
     return jsonify(ok=False, error=e, code=500), 500
@@ -0,0 +1,315 @@
+###############################################################################
+# Copyright (c) 2017 Merantix GmbH
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+"""Background execution of long-running visualizations
+
+Jobs are executed by a fixed pool of worker threads, so slow visualizations
+queue up there instead of blocking the threads serving HTTP requests.
+Clients poll a job's status and fetch its result once it is done.
+
+Every job carries an estimated cost.  Queued jobs are started cheapest
+first, with a bonus for the time they have waited so expensive jobs are not
+starved, and new jobs are rejected while the total cost of unfinished jobs
+exceeds a limit, so latency stays bounded under load.
+
+"""
+from collections import OrderedDict
+import itertools
+import logging
+import math
+import queue
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a job is rejected because the backlog is too large."""
+
+    def __init__(self, retry_after):
+        """Create a new exception.
+
+        Args:
+            retry_after (int): estimated seconds until the job would be
+                accepted.
+
+        """
+        super().__init__('Too many pending jobs, retry after {} seconds'
+                         .format(retry_after))
+        self.retry_after = retry_after
+
+
+class JobTimeout(RuntimeError):
+    """Raised when a job does not finish within the time waited for it."""
+
+
+class Job:
+    """A unit of work executed by a :class:`JobManager`."""
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, fn, cost=1):
+        """Create a new job.
+
+        Args:
+            fn: callable without arguments doing the work of the job.  Its
+                return value is the result of the job.
+            cost (int): estimated cost of the job.
+
+        """
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.cost = cost
+        self.status = Job.PENDING
+        self.result = None
+        self.error = None
+        self.exception = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._finished_event = threading.Event()
+
+    @property
+    def finished(self):
+        """Whether the job is done, failed or was cancelled.
+
+        :type: bool
+
+        """
+        return self.status in (Job.DONE, Job.FAILED, Job.CANCELLED)
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish and return its result.
+
+        Args:
+            timeout (float): maximum number of seconds to wait.
+
+        Returns:
+            the result of the job
+
+        Raises:
+            the exception raised by the job if it failed, `JobTimeout` if it
+            did not finish in time, or `RuntimeError` if it was cancelled.
+
+        """
+        if not self._finished_event.wait(timeout):
+            raise JobTimeout('Job {} did not finish in time'.format(self.id))
+        if self.status == Job.FAILED:
+            raise self.exception
+        if self.status == Job.CANCELLED:
+            raise RuntimeError('Job {} was cancelled'.format(self.id))
+        return self.result
+
+    def to_dict(self):
+        """Status of the job, without its result.
+
+        Returns:
+            :obj:`dict` with the keys `job_id`, `status`, `cost`,
+            `submitted_at`, `started_at`, `finished_at` and `error`.
+
+        """
+        return {'job_id': self.id,
+                'status': self.status,
+                'cost': self.cost,
+                'submitted_at': self.submitted_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'error': self.error}
+
+
+class JobManager:
+    """Executes jobs on a pool of worker threads, cheapest first, with aging.
+
+    Finished jobs are kept for polling until `max_finished` newer jobs have
+    finished.
+
+    """
+
+    # weight of the latest job in the moving average of the throughput
+    THROUGHPUT_SMOOTHING = 0.2
+
+    def __init__(self, num_workers=2, max_finished=1000, max_backlog=None,
+                 aging_rate=None):
+        """Create a new job manager and start its workers.
+
+        Args:
+            num_workers (int): number of jobs executed at the same time.
+            max_finished (int): number of finished jobs kept for polling.
+            max_backlog (int): maximum total cost of unfinished jobs.  A job
+                is rejected if it would exceed this, unless no other job is
+                unfinished.  `None` accepts all jobs.
+            aging_rate (float): cost by which a queued job moves ahead per
+                second it waits.  A job is thus started before any job
+                submitted `t` seconds later whose cost is lower by less than
+                `t * aging_rate`, and cheap jobs can't hold back an
+                expensive one forever.  `None` orders by cost only.
+
+        """
+        self.num_workers = num_workers
+        self.max_finished = max_finished
+        self.max_backlog = max_backlog
+        self.aging_rate = aging_rate
+
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._jobs = {}
+        self._finished = OrderedDict()
+        self._lock = threading.Lock()
+        self._accepting = True
+        self._backlog = 0
+        self._throughput = None
+        self._workers = [threading.Thread(target=self._work,
+                                          name='picasso-job-{}'.format(i),
+                                          daemon=True)
+                         for i in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def backlog(self):
+        """Total estimated cost of the pending and running jobs.
+
+        :type: int
+
+        """
+        with self._lock:
+            return self._backlog
+
+    def submit(self, fn, cost=1):
+        """Queue work for execution.
+
+        Args:
+            fn: callable without arguments.
+            cost (int): estimated cost of the work.  Cheaper jobs are
+                started first.
+
+        Returns:
+            the new :class:`Job`
+
+        Raises:
+            RuntimeError: if the manager is shutting down.
+            Overloaded: if the backlog is too large to accept the job.
+
+        """
+        job = Job(fn, cost=cost)
+        with self._lock:
+            if not self._accepting:
+                raise RuntimeError('The job manager is shutting down')
+            if (self.max_backlog is not None and self._backlog and
+                    self._backlog + cost > self.max_backlog):
+                raise Overloaded(self._retry_after())
+            self._jobs[job.id] = job
+            self._backlog += cost
+            priority = cost
+            if self.aging_rate:
+                # constant per job, so the queue order stays valid
+                priority += self.aging_rate * job.submitted_at
+            self._queue.put((priority, next(self._order), job))
+        return job
+
+    def get(self, job_id):
+        """Look up a job.
+
+        Returns:
+            the :class:`Job`, or `None` if it is unknown or was forgotten.
+
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a job that has not started yet.
+
+        Running jobs can't be interrupted and finish normally.
+
+        Returns:
+            bool: whether the job was cancelled.
+
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != Job.PENDING:
+                return False
+            job.fn = None
+            self._finish(job, Job.CANCELLED)
+            return True
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs and stop the workers once all queued jobs
+        are done.
+
+        Args:
+            wait (bool): whether to block until the workers have stopped.
+
+        """
+        with self._lock:
+            if not self._accepting:
+                return
+            self._accepting = False
+        # sort after all jobs, so that the queue is drained first
+        for _ in self._workers:
+            self._queue.put((math.inf, next(self._order), None))
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def _retry_after(self):
+        # must be called with self._lock held
+        if not self._throughput:
+            return 1
+        seconds = self._backlog / (self._throughput * self.num_workers)
+        return max(1, int(math.ceil(seconds)))
+
+    def _finish(self, job, status):
+        # must be called with self._lock held
+        job.status = status
+        job.finished_at = time.time()
+        self._backlog -= job.cost
+        if job.started_at is not None:
+            throughput = job.cost / max(job.finished_at - job.started_at,
+                                        1e-3)
+            if self._throughput is None:
+                self._throughput = throughput
+            else:
+                self._throughput += self.THROUGHPUT_SMOOTHING * (
+                    throughput - self._throughput)
+        self._finished[job.id] = job
+        while len(self._finished) > self.max_finished:
+            old_id, _ = self._finished.popitem(last=False)
+            del self._jobs[old_id]
+        job._finished_event.set()
+
+    def _work(self):
+        while True:
+            _, _, job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                if job.status != Job.PENDING:
+                    continue
+                job.status = Job.RUNNING
+                job.started_at = time.time()
+                fn = job.fn
+            try:
+                result = fn()
+            except Exception as e:
+                logger.exception('Job %s failed', job.id)
+                with self._lock:
+                    job.error = str(e)
+                    job.exception = e
+                    self._finish(job, Job.FAILED)
+            else:
+                with self._lock:
+                    job.result = result
+                    self._finish(job, Job.DONE)
+            job.fn = None
@@ -11,9 +11,15 @@
 #    Josh Chen - refactor and class config
 ###############################################################################
 import importlib
-from operator import itemgetter
+import threading
+import time
 import warnings
 
+import numpy as np
+
+from picasso.cache import LRUCache, hash_image
+from picasso.models.scheduler import InferenceScheduler
+
 
 def load_model(model_cls_path, model_cls_name, model_load_args):
     """Get an instance of the described model.
@@ -75,6 +81,13 @@ class BaseModel:
         self._model_name = None
         self._latest_ckpt_name = None
         self._latest_ckpt_time = None
+        self._scheduler = None
+        self._class_table = None
+        self._class_table_lock = threading.Lock()
+        self._fetches = None
+        self._fetches_lock = threading.Lock()
+        self._memo = LRUCache(64)
+        self._arrays = LRUCache(64)
 
     def load(self, *args, **kwargs):
         """Load the model's graph and parameters from disk, restoring the model
@@ -134,6 +147,280 @@ class BaseModel:
         """
         return self._latest_ckpt_name
 
+    def enable_batching(self, max_batch_size=32, max_delay=0.005):
+        """Coalesce concurrent calls of :meth:`run` into batches.
+
+        Must be called after `load`.  Passing a `max_batch_size` below 2
+        disables batching.
+
+        Args:
+            max_batch_size (int): maximum number of examples per batch.
+            max_delay (float): maximum number of seconds a call waits for
+                other calls to share its batch.
+
+        """
+        if self._scheduler is not None:
+            self._scheduler.close()
+            self._scheduler = None
+        self._class_table = None
+        self._class_table_lock = threading.Lock()
+        self._fetches = None
+        self._fetches_lock = threading.Lock()
+        if max_batch_size and max_batch_size > 1:
+            self._scheduler = InferenceScheduler(self.sess,
+                                                 max_batch_size=max_batch_size,
+                                                 max_delay=max_delay)
+
+    def enable_memo(self, max_entries=64, max_arrays=None):
+        """Set the number of images whose predictions and preprocessed
+        arrays are memoized by :meth:`preprocess_and_predict`.  Passing 0
+        disables memoization.
+
+        Args:
+            max_entries (int): maximum number of images whose predictions
+                are memoized.
+            max_arrays (int): maximum number of images whose preprocessed
+                arrays are memoized.  Defaults to `max_entries`.
+
+        """
+        self._memo = LRUCache(max_entries)
+        self._arrays = LRUCache(max_entries if max_arrays is None
+                                else max_arrays)
+
+    def warm_up(self, batch_sizes=(1,)):
+        """Run the prediction path on synthetic batches of zeros, so the
+        first requests don't pay for building the fetches, initializing the
+        session and selecting kernels.
+
+        Models whose input shape is not fully known only build their
+        fetches.
+
+        Args:
+            batch_sizes (:obj:`list` of int): number of examples of each
+                synthetic batch.
+
+        Returns:
+            :obj:`list` of :obj:`dict` with the `batch_size` and the
+            `seconds` taken by each run
+
+        """
+        self.get_fetches()
+        latencies = []
+        for inputs in self.synthetic_batches(batch_sizes):
+            start = time.time()
+            self.run_top_k(inputs)
+            latencies.append({'batch_size': len(inputs),
+                              'seconds': time.time() - start})
+        return latencies
+
+    def synthetic_batches(self, batch_sizes):
+        """Batches of zeros with the shape of the model's input, e.g. for
+        warming up.
+
+        Args:
+            batch_sizes (:obj:`list` of int): number of examples of each
+                batch.
+
+        Returns:
+            :obj:`list` of arrays, empty if the input shape is not fully
+            known
+
+        """
+        shape = self.tf_input_var.get_shape()
+        if shape.ndims is None or not shape[1:].is_fully_defined():
+            return []
+        dtype = self.tf_input_var.dtype.as_numpy_dtype
+        return [np.zeros([batch_size] + shape[1:].as_list(), dtype=dtype)
+                for batch_size in batch_sizes]
+
+    def run(self, fetches, feed_dict):
+        """Evaluate tensors of the model's graph on a batch of examples.
+
+        Visualizations should use this instead of `self.sess.run` so that
+        concurrent calls can share a batch (see :meth:`enable_batching`).
+        All fed arrays and fetched tensors must be batch-major.
+
+        Args:
+            fetches: a tensor or a list of tensors, as for `sess.run`.
+            feed_dict (:obj:`dict`): mapping of tensors to arrays whose first
+                dimension is the number of examples.
+
+        Returns:
+            The same as `self.sess.run(fetches, feed_dict)`.
+
+        """
+        if self._scheduler is None:
+            return self.sess.run(fetches, feed_dict=feed_dict)
+        return self._scheduler.run(fetches, feed_dict)
+
+    def get_fetches(self):
+        """Tensors that reduce the model's predictions inside the graph.
+
+        The ops are added to the graph once per model, the first time they
+        are needed, and looked up by name if the graph already has them.
+
+        Returns:
+            :obj:`dict` with the keys
+
+              - 'top_k_values', 'top_k_indices': probabilities and indices
+                of the `self.top_probs` most probable classes per example.
+              - 'class_indices': int32 placeholder of shape (num_examples,
+                num_classes_to_fetch) selecting classes per example.
+              - 'class_probs': probabilities of the classes selected by
+                'class_indices'.
+
+        """
+        with self._fetches_lock:
+            if self._fetches is None:
+                self._fetches = self._build_fetches()
+            return self._fetches
+
+    def _build_fetches(self):
+        import tensorflow as tf
+
+        graph = self.sess.graph
+        names = ['top_k_values', 'top_k_indices',
+                 'class_indices', 'class_probs']
+        try:
+            return {name: graph.get_tensor_by_name('bv_{}:0'.format(name))
+                    for name in names}
+        except KeyError:
+            pass
+
+        num_classes = self.tf_predict_var.get_shape().as_list()[-1]
+        with graph.as_default():
+            top_k = tf.nn.top_k(self.tf_predict_var,
+                                k=min(self.top_probs, num_classes))
+            class_indices = tf.placeholder(tf.int32, shape=[None, None],
+                                           name='bv_class_indices')
+            rows = tf.tile(tf.range(tf.shape(class_indices)[0])[:, None],
+                           [1, tf.shape(class_indices)[1]])
+            class_probs = tf.gather_nd(self.tf_predict_var,
+                                       tf.stack([rows, class_indices],
+                                                axis=-1))
+            return {'top_k_values': tf.identity(top_k.values,
+                                                name='bv_top_k_values'),
+                    'top_k_indices': tf.identity(top_k.indices,
+                                                 name='bv_top_k_indices'),
+                    'class_indices': class_indices,
+                    'class_probs': tf.identity(class_probs,
+                                               name='bv_class_probs')}
+
+    def run_top_k(self, inputs):
+        """Find the most probable classes of preprocessed inputs.
+
+        The selection happens inside the graph, so only `self.top_probs`
+        values per example are fetched from the session.
+
+        Args:
+            inputs (array): preprocessed inputs, as returned by
+                `self.preprocess`.
+
+        Returns:
+            :obj:`tuple` of two arrays of shape (num_examples, top_probs)
+            holding the class indices and their probabilities, most probable
+            first.
+
+        """
+        fetches = self.get_fetches()
+        values, indices = self.run([fetches['top_k_values'],
+                                    fetches['top_k_indices']],
+                                   {self.tf_input_var: inputs})
+        return indices, values
+
+    def preprocess_and_predict(self, raw_inputs, keys=None):
+        """Preprocess raw inputs and predict their most probable classes.
+
+        Preprocessed arrays are memoized per image content, and predictions
+        per image content and checkpoint, so visualizations of an image
+        share one preprocessing and forward pass.  The returned arrays must
+        not be modified.
+
+        Args:
+            raw_inputs (:obj:`list` of :obj:`PIL.Image`): List of raw
+                input images of any mode and shape.
+            keys (:obj:`list` of :obj:`str`): hashes identifying the
+                content of each input, e.g. the `digest` of an upload.
+                Missing keys are computed from the images' pixels.
+
+        Returns:
+            :obj:`tuple` of the preprocessed inputs, the class indices,
+            probabilities and annotated predictions returned by
+            :meth:`predict_and_decode`.
+
+        """
+        keys = keys or [None] * len(raw_inputs)
+        keys = [key or hash_image(raw) for raw, key in zip(raw_inputs, keys)]
+        arrays = [self._arrays.get(key) for key in keys]
+        missing = [i for i, array in enumerate(arrays) if array is None]
+        if missing:
+            preprocessed = self.preprocess([raw_inputs[i] for i in missing])
+            for j, i in enumerate(missing):
+                arrays[i] = preprocessed[j]
+                self._arrays.put(keys[i], arrays[i])
+        arrays = np.stack(arrays)
+
+        checkpoint = (self.latest_ckpt_name, self.latest_ckpt_time)
+        entries = [self._memo.get((checkpoint, key)) for key in keys]
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        if missing:
+            indices, probs, decoded = self.predict_and_decode(arrays[missing])
+            for j, i in enumerate(missing):
+                entries[i] = (indices[j], probs[j], decoded[j])
+                self._memo.put((checkpoint, keys[i]), entries[i])
+
+        return (arrays,
+                np.stack([entry[0] for entry in entries]),
+                np.stack([entry[1] for entry in entries]),
+                [[dict(pred) for pred in entry[2]] for entry in entries])
+
+    def predict_and_decode(self, inputs):
+        """Predict and annotate the most probable classes of preprocessed
+        inputs.
+
+        The classes are selected inside the graph and annotated by
+        :meth:`decode_top_k`, unless a subclass overrides
+        :meth:`decode_prob`.  Then the full class probabilities are fetched
+        and passed to it.
+
+        Args:
+            inputs (array): preprocessed inputs, as returned by
+                `self.preprocess`.
+
+        Returns:
+            :obj:`tuple` of the class indices and probabilities returned by
+            :meth:`run_top_k` and the annotated predictions of each example.
+
+        """
+        if type(self).decode_prob is BaseModel.decode_prob:
+            indices, probs = self.run_top_k(inputs)
+            return indices, probs, self.decode_top_k(indices, probs)
+        class_probabilities = self.run(self.tf_predict_var,
+                                       {self.tf_input_var: inputs})
+        indices, probs = self.top_k(class_probabilities)
+        return indices, probs, self.decode_prob(class_probabilities)
+
+    def predict_classes(self, inputs, class_indices):
+        """Predict the probabilities of selected classes only.
+
+        Args:
+            inputs (array): preprocessed inputs, as returned by
+                `self.preprocess`.
+            class_indices (array): classes to fetch, either one list for all
+                examples or an array of shape (num_examples, num_selected).
+
+        Returns:
+            array of shape (num_examples, num_selected)
+
+        """
+        class_indices = np.asarray(class_indices, dtype='int32')
+        if class_indices.ndim == 1:
+            class_indices = np.tile(class_indices, (len(inputs), 1))
+        fetches = self.get_fetches()
+        return self.run(fetches['class_probs'],
+                        {self.tf_input_var: inputs,
+                         fetches['class_indices']: class_indices})
+
     def preprocess(self, raw_inputs):
         """Preprocess raw inputs into the format required by the model.
 
@@ -171,11 +458,107 @@ class BaseModel:
         """
         raise NotImplementedError
 
+    def load_class_table(self, num_classes):
+        """Load the annotations of every class of the model.
+
+        Called once per model, the first time predictions are decoded.  By
+        default, we name each class using its index in the logits array.
+
+        Args:
+            num_classes (int): number of classes predicted by the model.
+
+        Returns:
+            :obj:`dict` mapping annotation names (e.g. 'name') to arrays of
+            length `num_classes` holding the annotation of each class.
+
+        """
+        return {'name': np.array([str(i) for i in range(num_classes)])}
+
+    def get_class_table(self, num_classes):
+        """The class annotations loaded by :meth:`load_class_table`.
+
+        Args:
+            num_classes (int): number of classes predicted by the model.
+
+        Returns:
+            :obj:`dict` mapping annotation names to arrays of length
+            `num_classes`.
+
+        """
+        with self._class_table_lock:
+            if self._class_table is None:
+                self._class_table = {
+                    field: np.asarray(values)
+                    for field, values in
+                    self.load_class_table(num_classes).items()}
+            return self._class_table
+
+    def top_k(self, class_probabilities, k=None):
+        """Find the most probable classes of each example.
+
+        Args:
+            class_probabilities (array): Class probabilities as output by
+                `self.predict`, i.e., a numpy array of shape (num_examples,
+                num_classes).
+            k (int): number of classes to keep.  Defaults to
+                `self.top_probs`.
+
+        Returns:
+            :obj:`tuple` of two arrays of shape (num_examples, k) holding
+            the class indices and their probabilities, most probable first.
+
+        """
+        class_probabilities = np.asarray(class_probabilities)
+        k = min(k or self.top_probs, class_probabilities.shape[-1])
+        rows = np.arange(len(class_probabilities))[:, None]
+        # find the k largest entries in linear time, then only sort those
+        indices = np.argpartition(-class_probabilities, k - 1,
+                                  axis=-1)[:, :k]
+        order = np.argsort(-class_probabilities[rows, indices], axis=-1)
+        indices = indices[rows, order]
+        return indices, class_probabilities[rows, indices]
+
+    def decode_top_k(self, indices, probs, num_classes=None):
+        """Annotate the most probable classes of each example.
+
+        Args:
+            indices (array): class indices, of shape (num_examples, k).
+            probs (array): the probabilities of these classes.
+            num_classes (int): number of classes predicted by the model.
+                Defaults to the size of the last dimension of
+                `self.tf_predict_var`.
+
+        Returns:
+            Annotated class probabilities, as described in
+            :meth:`decode_prob`.
+
+        """
+        indices = np.asarray(indices)
+        if num_classes is None:
+            num_classes = self.tf_predict_var.get_shape().as_list()[-1]
+        table = self.get_class_table(num_classes)
+        annotations = {field: values[indices].tolist()
+                       for field, values in table.items()}
+        index_rows = indices.tolist()
+        results = []
+        for i, row in enumerate(index_rows):
+            entries = []
+            for j, index in enumerate(row):
+                entry = {'index': index}
+                for field in annotations:
+                    entry[field] = annotations[field][i][j]
+                entry['prob'] = '{:.3f}'.format(probs[i][j])
+                entries.append(entry)
+            results.append(entries)
+        return results
+
     def decode_prob(self, class_probabilities):
         """Given predicted class probabilites for a set of examples, annotate
-        each logit with a class name.
+        the `self.top_probs` most probable classes of each example.
 
-        By default, we name each class using its index in the logits array.
+        Classes are annotated with the table returned by
+        :meth:`load_class_table`, which by default names each class using its
+        index in the logits array.
 
         Args:
             class_probabilities (array): Class probabilities as output by
@@ -192,19 +575,6 @@ class BaseModel:
                 }
 
         """
-        results = []
-        for row in class_probabilities:
-            entries = []
-            for i, prob in enumerate(row):
-                entries.append({'index': i,
-                                'name': str(i),
-                                'prob': prob})
-
-            entries = sorted(entries,
-                             key=itemgetter('prob'),
-                             reverse=True)[:self.top_probs]
-
-            for entry in entries:
-                entry['prob'] = '{:.3f}'.format(entry['prob'])
-            results.append(entries)
-        return results
+        indices, probs = self.top_k(class_probabilities)
+        return self.decode_top_k(indices, probs,
+                                 num_classes=np.shape(class_probabilities)[-1])
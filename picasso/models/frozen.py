@@ -0,0 +1,156 @@
+###############################################################################
+# Copyright (c) 2017 Merantix GmbH
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+"""Frozen, inference-only model artifacts
+
+Freezing replaces the variables of a loaded model by constants and prunes
+every op that the predictions and the visualizations don't need, such as
+savers, optimizer slots and training ops.  The result is a single GraphDef
+file, which loads much faster and takes less memory than the training
+checkpoint.  A JSON file next to it records the tensor names and the model
+class whose preprocessing and class annotations are used.
+
+"""
+import glob
+import importlib.util
+import json
+import os
+import time
+
+import tensorflow as tf
+
+from picasso.models.base import BaseModel
+
+# prefix of the ops added to the graph for the visualizations
+VISUALIZATION_OP_PREFIX = 'bv_'
+
+# graph transforms applied to frozen graphs, if TensorFlow provides them
+GRAPH_TRANSFORMS = ['remove_nodes(op=CheckNumerics)',
+                    'fold_constants(ignore_errors=true)',
+                    'fold_batch_norms',
+                    'fold_old_batch_norms']
+
+
+def _metadata_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def freeze_model(model, path, model_cls_path, model_cls_name):
+    """Write a frozen, inference-only copy of a loaded model.
+
+    The ops which the visualizations add to the graph (named with the
+    prefix `bv_`) are kept, so they must have been built before, e.g. by
+    instantiating the visualizations for the model.
+
+    Args:
+        model (:class:`.BaseModel`): the loaded model.
+        path (:obj:`str`): path of the GraphDef file to write, e.g.
+            'model.pb'.  The metadata is written next to it, with the
+            extension '.json'.
+        model_cls_path (:obj:`str`): path of the module defining the model's
+            class.
+        model_cls_name (:obj:`str`): name of the model's class.
+
+    Returns:
+        :obj:`dict` metadata of the artifact
+
+    """
+    model.get_fetches()
+    input_name = model.tf_input_var.op.name
+    output_names = [model.tf_predict_var.op.name]
+    output_names.extend(
+        op.name for op in model.sess.graph.get_operations()
+        if op.name.startswith(VISUALIZATION_OP_PREFIX) and
+        op.name not in output_names)
+
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        model.sess, model.sess.graph.as_graph_def(), output_names)
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        # only pruned, not folded
+        pass
+    else:
+        graph_def = TransformGraph(graph_def, [input_name], output_names,
+                                   GRAPH_TRANSFORMS)
+
+    with open(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    metadata = {'model_cls_path': os.path.abspath(model_cls_path),
+                'model_cls_name': model_cls_name,
+                'input_tensor': model.tf_input_var.name,
+                'predict_tensor': model.tf_predict_var.name,
+                'top_probs': model.top_probs,
+                'latest_ckpt_name': model.latest_ckpt_name,
+                'latest_ckpt_time': model.latest_ckpt_time,
+                'frozen_at': time.time(),
+                'num_nodes': len(graph_def.node)}
+    with open(_metadata_path(path), 'w') as f:
+        json.dump(metadata, f, indent=2, sort_keys=True)
+    return metadata
+
+
+class FrozenModel(BaseModel):
+    """Model loaded from an artifact written by :func:`freeze_model`.
+
+    Preprocessing and class annotations are taken from the class of the
+    frozen model, which is instantiated but not loaded, so its `preprocess`
+    and `load_class_table` must not depend on `load`.
+
+    """
+
+    def load(self, data_dir, model_cls_path=None):
+        """Load the newest frozen graph (`.pb`) in a directory.
+
+        Args:
+            data_dir (:obj:`str`): location of the frozen graph and its
+                metadata.
+            model_cls_path (:obj:`str`): path of the module defining the
+                frozen model's class, if it has moved since freezing.
+
+        """
+        try:
+            path = max(glob.iglob(os.path.join(data_dir, '*.pb')),
+                       key=os.path.getctime)
+        except ValueError:
+            raise FileNotFoundError('No frozen graph (.pb) files '
+                                    'available at {}'.format(data_dir))
+        with open(_metadata_path(path)) as f:
+            metadata = json.load(f)
+
+        spec = importlib.util.spec_from_file_location(
+            'frozen_model', model_cls_path or metadata['model_cls_path'])
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        self._source = getattr(module, metadata['model_cls_name'])(
+            top_probs=metadata['top_probs'])
+        self.top_probs = metadata['top_probs']
+
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self._sess = tf.Session(graph=graph)
+        self._tf_input_var = graph.get_tensor_by_name(
+            metadata['input_tensor'])
+        self._tf_predict_var = graph.get_tensor_by_name(
+            metadata['predict_tensor'])
+        self._model_name = metadata['model_cls_name']
+        self._latest_ckpt_name = metadata['latest_ckpt_name']
+        self._latest_ckpt_time = metadata['latest_ckpt_time']
+
+    def preprocess(self, raw_inputs):
+        return self._source.preprocess(raw_inputs)
+
+    def load_class_table(self, num_classes):
+        return self._source.load_class_table(num_classes)
+
+    def predict(self, input_array):
+        return self.run(self.tf_predict_var,
+                        {self.tf_input_var: input_array})
@@ -75,4 +75,7 @@ class KerasModel(BaseModel):
         self._latest_ckpt_time = latest_ckpt_time
 
     def predict(self, input_array):
-        return self._model.predict(input_array)
+        # runs in the model's own session, which need not be the global
+        # Keras session
+        return self.run(self.tf_predict_var,
+                        {self.tf_input_var: input_array})
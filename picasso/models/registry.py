@@ -0,0 +1,443 @@
+###############################################################################
+# Copyright (c) 2017 Merantix GmbH
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+"""Process-wide registry of loaded models
+
+Loading a model executes the model module, rebuilds the graph and reads the
+weights from disk.  The registry makes sure this happens once per process
+and configured model, and hands out the same instance to every request.
+
+Several models can be served by one process.  Each is then loaded into a
+graph and session of its own, and idle models are evicted, least recently
+used first, to stay within a number of models or a memory budget.
+
+When a new checkpoint appears, the model is loaded again into a graph and
+session of its own, warmed up and swapped in atomically.  Requests which
+started with the old model keep using it; it is closed once the last of
+them has finished.
+
+"""
+import logging
+import threading
+import time
+import weakref
+
+from picasso.models.base import load_model
+
+logger = logging.getLogger(__name__)
+
+
+def _graph_bytes(model):
+    """Estimate the memory held by the parameters of a model's graph.
+
+    Args:
+        model (:obj:`.models.base.BaseModel`): a loaded model.
+
+    Returns:
+        int: number of bytes taken up by the graph's global variables and
+        constants, which hold the parameters of frozen graphs, or 0 if the
+        model has no session.
+
+    """
+    if model.sess is None:
+        return 0
+    import tensorflow as tf
+    total = 0
+    for var in model.sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES):
+        num_elements = var.get_shape().num_elements()
+        if num_elements:
+            total += num_elements * var.dtype.base_dtype.size
+    for op in model.sess.graph.get_operations():
+        if op.type == 'Const':
+            total += op.node_def.attr['value'].tensor.ByteSize()
+    return total
+
+
+def _load_isolated(model_cls_path, model_cls_name, model_load_args):
+    """Load a model into a new graph and session, leaving the default graph
+    and the models loaded into it untouched.
+
+    Returns:
+        the loaded model
+
+    """
+    import tensorflow as tf
+    graph = tf.Graph()
+    sess = tf.Session(graph=graph)
+    # Keras picks up the default session, TensorFlow models create their
+    # own session for the default graph
+    with graph.as_default(), sess.as_default():
+        model = load_model(model_cls_path, model_cls_name, model_load_args)
+    if model.sess is not sess:
+        sess.close()
+    return model
+
+
+def _warm_up_model(entry):
+    # default warm-up of reloaded models: the prediction path only
+    return entry.model.warm_up()
+
+
+class ModelEntry:
+    """A loaded model together with the statistics of its loading.
+
+    Users of the model hold a reference to the entry while they run it, see
+    :meth:`acquire`, so the entry can be closed safely once it has been
+    replaced.
+
+    """
+
+    def __init__(self, model, load_time, memory_footprint, generation=0,
+                 owns_session=False, previous_ckpt_name=None,
+                 warm_up_latencies=None):
+        """Create a new registry entry.
+
+        Args:
+            model (:obj:`.models.base.BaseModel`): the loaded model.
+            load_time (float): seconds it took to load the model.
+            memory_footprint (int): estimated bytes held by the model's
+                parameters.
+            generation (int): number of times the model has been reloaded.
+            owns_session (bool): whether the model's session is closed when
+                the entry is.  Models sharing the default graph keep their
+                session open.
+            previous_ckpt_name (:obj:`str`): checkpoint of the entry this
+                one replaced.
+            warm_up_latencies (:obj:`dict`): seconds taken by the warm-up
+                runs of the model, as returned by the `warm_up` callable of
+                :meth:`ModelRegistry.get_entry`.
+
+        Attributes:
+            visualizations (:obj:`dict`): visualization instances built for
+                the model, by name.  They are dropped when the entry is
+                closed, together with their references to the model.
+
+        """
+        self.model = model
+        self.load_time = load_time
+        self.memory_footprint = memory_footprint
+        self.loaded_at = time.time()
+        self.generation = generation
+        self.owns_session = owns_session
+        self.previous_ckpt_name = previous_ckpt_name
+        self.warm_up_latencies = warm_up_latencies
+        self.visualizations = {}
+        self.last_used = self.loaded_at
+        self.retired = False
+        self.closed = False
+        self._refs = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """Loading statistics of the model.
+
+        Returns:
+            :obj:`dict` with the keys `load_time`, `memory_footprint`,
+            `loaded_at`, `generation`, `previous_ckpt_name` and
+            `warm_up_latencies`.
+
+        """
+        return {'load_time': self.load_time,
+                'memory_footprint': self.memory_footprint,
+                'loaded_at': self.loaded_at,
+                'generation': self.generation,
+                'previous_ckpt_name': self.previous_ckpt_name,
+                'warm_up_latencies': self.warm_up_latencies}
+
+    @property
+    def in_flight(self):
+        """Number of users currently holding the entry."""
+        with self._lock:
+            return self._refs
+
+    def acquire(self):
+        """Hold the entry, so its model is not closed while it is used.
+
+        Returns:
+            the entry itself
+
+        """
+        with self._lock:
+            self._refs += 1
+            self.last_used = time.time()
+        return self
+
+    def release(self):
+        """Stop holding the entry, closing it if it has been retired and
+        this was the last user."""
+        with self._lock:
+            self._refs -= 1
+            close = self.retired and self._refs == 0
+        if close:
+            self.close()
+
+    def retire(self):
+        """Mark the entry as replaced, closing it once it is not used
+        anymore."""
+        with self._lock:
+            self.retired = True
+            close = self._refs == 0
+        if close:
+            self.close()
+
+    def close(self):
+        """Stop the model's batching thread, drop the visualizations built
+        for it and, if the entry owns it, close the model's session."""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.visualizations = {}
+        self.model.enable_batching(max_batch_size=0)
+        if self.owns_session and self.model.sess is not None:
+            self.model.sess.close()
+        logger.info('Closed model %s (%s)', type(self.model).__name__,
+                    self.model.latest_ckpt_name)
+
+
+class ModelRegistry:
+    """Thread-safe cache of loaded models with process lifetime.
+
+    Models are identified by the module path, class name and load arguments
+    they were loaded with.  Concurrent requests for a model that is still
+    loading wait for the first load to finish instead of loading it again;
+    requests for other models are not blocked.  Models stay loaded until
+    they are evicted, see :meth:`evict`.
+
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._key_locks = {}
+        # replaced entries, only kept alive by the requests still using them
+        self._retired = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_cls_path, model_cls_name, model_load_args):
+        """Identify a model configuration.
+
+        Returns:
+            :obj:`tuple` usable as a dictionary key.
+
+        """
+        return (model_cls_path, model_cls_name,
+                repr(sorted((model_load_args or {}).items())))
+
+    def get_entry(self, model_cls_path, model_cls_name, model_load_args,
+                  setup=None, warm_up=None, isolated=False, acquire=False):
+        """Get the registry entry of a model, loading the model if necessary.
+
+        Args:
+            model_cls_path: Path to the module in which the model class
+                is defined.
+            model_cls_name: Name of the model class.
+            model_load_args: Dictionary of args to pass to the `load` method
+                of the model instance.
+            setup: Optional callable which is applied to a newly loaded model
+                before it is handed out.
+            warm_up: Optional callable which runs the model of a new
+                :class:`ModelEntry` after `setup`, before the entry is
+                handed out, so the first requests don't pay for initializing
+                it.  Returns the latencies of its runs, which are kept in
+                the entry.
+            isolated (bool): load the model into a graph and session of its
+                own instead of the default graph, so several models can be
+                loaded and closed independently.
+            acquire (bool): hold the entry (see :meth:`ModelEntry.acquire`)
+                before it is returned, so it cannot be evicted in between.
+
+        Returns:
+            :class:`ModelEntry` of the model
+
+        """
+        key = self.make_key(model_cls_path, model_cls_name, model_load_args)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry.acquire() if acquire else entry
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # another thread may have finished loading while we waited
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    return entry.acquire() if acquire else entry
+
+            start = time.time()
+            if isolated:
+                model = _load_isolated(model_cls_path, model_cls_name,
+                                       model_load_args)
+            else:
+                model = load_model(model_cls_path, model_cls_name,
+                                   model_load_args)
+            if setup is not None:
+                setup(model)
+            load_time = time.time() - start
+            entry = ModelEntry(model, load_time, _graph_bytes(model),
+                               owns_session=isolated)
+            entry.warm_up_latencies = self._warm_up(entry, warm_up)
+            with self._lock:
+                self._entries[key] = entry
+                return entry.acquire() if acquire else entry
+
+    @staticmethod
+    def _warm_up(entry, warm_up):
+        if warm_up is None:
+            return None
+        start = time.time()
+        latencies = warm_up(entry)
+        logger.info('Warmed up model %s in %.3f seconds',
+                    type(entry.model).__name__, time.time() - start)
+        return latencies
+
+    def get_loaded(self, model_cls_path, model_cls_name, model_load_args):
+        """Get the registry entry of a model without loading it.
+
+        Takes the same arguments as :meth:`get_entry`.
+
+        Returns:
+            :class:`ModelEntry` of the model, or `None` if it is not loaded
+
+        """
+        key = self.make_key(model_cls_path, model_cls_name, model_load_args)
+        with self._lock:
+            return self._entries.get(key)
+
+    def reload(self, model_cls_path, model_cls_name, model_load_args,
+               setup=None, warm_up=None):
+        """Load a model again, e.g. from a new checkpoint, and swap it in.
+
+        The new model is loaded into a graph and session of its own and
+        warmed up while the old one keeps serving requests, with `warm_up`
+        or by default :meth:`.BaseModel.warm_up`.  Then it
+        replaces the old one atomically, and the old one is closed as soon
+        as its current users have released it.  Models which are not loaded
+        are left alone; they load the new checkpoint when they are needed.
+
+        Takes the same arguments as :meth:`get_entry`.
+
+        Returns:
+            the new :class:`ModelEntry`, or `None` if the model is not loaded
+
+        """
+        key = self.make_key(model_cls_path, model_cls_name, model_load_args)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                old = self._entries.get(key)
+            if old is None:
+                return None
+
+            start = time.time()
+            model = _load_isolated(model_cls_path, model_cls_name,
+                                   model_load_args)
+            if setup is not None:
+                setup(model)
+            load_time = time.time() - start
+            entry = ModelEntry(model, load_time, _graph_bytes(model),
+                               generation=old.generation + 1,
+                               owns_session=True,
+                               previous_ckpt_name=old.model.latest_ckpt_name)
+            entry.warm_up_latencies = self._warm_up(
+                entry, warm_up or _warm_up_model)
+            with self._lock:
+                if self._entries.get(key) is not old:
+                    # evicted while loading
+                    entry.close()
+                    return None
+                self._entries[key] = entry
+                self._retired.add(old)
+        logger.info('Swapped in model %s (%s)', model_cls_name,
+                    model.latest_ckpt_name)
+        old.retire()
+        return entry
+
+    def evict(self, max_models=None, memory_budget=None):
+        """Unload idle models, least recently used first, until the loaded
+        models fit the given limits.
+
+        Models which are in use are not evicted, so the limits may be
+        exceeded while they are.
+
+        Args:
+            max_models (int): maximum number of loaded models, or `None`.
+            memory_budget (int): maximum estimated bytes held by the
+                parameters of all loaded models, or `None`.
+
+        Returns:
+            :obj:`list` of the evicted :class:`ModelEntry` instances
+
+        """
+        evicted = []
+        with self._lock:
+            count = len(self._entries)
+            memory = sum(entry.memory_footprint
+                         for entry in self._entries.values())
+            for key, entry in sorted(self._entries.items(),
+                                     key=lambda item: item[1].last_used):
+                if ((max_models is None or count <= max_models) and
+                        (memory_budget is None or memory <= memory_budget)):
+                    break
+                if entry.in_flight:
+                    continue
+                del self._entries[key]
+                count -= 1
+                memory -= entry.memory_footprint
+                evicted.append(entry)
+        for entry in evicted:
+            logger.info('Evicting model %s (%s)', type(entry.model).__name__,
+                        entry.model.latest_ckpt_name)
+            entry.retire()
+        return evicted
+
+    def get(self, model_cls_path, model_cls_name, model_load_args,
+            setup=None):
+        """Get a shared instance of the described model.
+
+        See :meth:`get_entry` for the arguments.
+
+        Returns:
+            An instance of :class:`.models.base.BaseModel` or subclass
+
+        """
+        return self.get_entry(model_cls_path, model_cls_name,
+                              model_load_args, setup=setup).model
+
+    def entries(self):
+        """All loaded models.
+
+        Returns:
+            :obj:`list` of :class:`ModelEntry`
+
+        """
+        with self._lock:
+            return list(self._entries.values())
+
+    def retiring(self):
+        """Replaced models which are still in use.
+
+        Returns:
+            :obj:`list` of :class:`ModelEntry`
+
+        """
+        with self._lock:
+            return [entry for entry in self._retired if not entry.closed]
+
+    def clear(self):
+        """Forget all loaded models."""
+        with self._lock:
+            self._entries.clear()
+            self._key_locks.clear()
+            self._retired = weakref.WeakSet()
+
+
+# the registry shared by the whole process
+registry = ModelRegistry()
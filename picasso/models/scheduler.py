@@ -0,0 +1,178 @@
+###############################################################################
+# Copyright (c) 2017 Merantix GmbH
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+"""Micro-batching of concurrent session runs
+
+Requests typically carry a single image, which leaves most of the CPU idle
+during `sess.run`.  The scheduler collects concurrent calls that evaluate the
+same tensors, concatenates their inputs along the batch dimension, runs them
+with a single `sess.run` and hands each caller its slice of the result.
+
+"""
+from collections import OrderedDict
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class _Request:
+    """A pending call of :meth:`InferenceScheduler.run`."""
+
+    __slots__ = ('key', 'fetches', 'feed_dict', 'size', 'future')
+
+    def __init__(self, fetches, feed_dict):
+        self.fetches = fetches
+        self.feed_dict = {tensor: np.asarray(value)
+                          for tensor, value in feed_dict.items()}
+        # only calls with the same example shapes can be concatenated
+        fed = sorted(self.feed_dict, key=lambda t: t.name)
+        self.key = (tuple(fetches), tuple(fed),
+                    tuple((self.feed_dict[tensor].shape[1:],
+                           self.feed_dict[tensor].dtype)
+                          for tensor in fed))
+        sizes = {len(value) for value in self.feed_dict.values()}
+        if len(sizes) != 1:
+            raise ValueError('All fed arrays must have the same batch size, '
+                             'got {}'.format(sorted(sizes)))
+        self.size = sizes.pop()
+        self.future = Future()
+
+
+class InferenceScheduler:
+    """Coalesces concurrent session runs into batches.
+
+    All fed values and all fetched tensors must be batch-major, i.e. their
+    first dimension is the number of examples, and examples must not
+    influence each other's results.  This holds for inference with all
+    common image models.
+
+    """
+
+    def __init__(self, sess, max_batch_size=32, max_delay=0.005):
+        """Create a new scheduler.
+
+        Args:
+            sess (:obj:`tf.Session`): session used to evaluate the batches.
+            max_batch_size (int): maximum number of examples per batch.
+                Calls with more examples bypass the scheduler.
+            max_delay (float): maximum number of seconds to wait for further
+                calls after the first call of a batch arrived.
+
+        """
+        self.sess = sess
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def run(self, fetches, feed_dict):
+        """Evaluate `fetches`, batched with concurrent calls.
+
+        Args:
+            fetches: a tensor or a list of tensors, as for `sess.run`.
+            feed_dict (:obj:`dict`): mapping of tensors to batch-major arrays.
+
+        Returns:
+            The same as `sess.run(fetches, feed_dict)`.
+
+        """
+        single = not isinstance(fetches, (list, tuple))
+        request = _Request([fetches] if single else list(fetches), feed_dict)
+        if request.size >= self.max_batch_size:
+            results = self.sess.run(request.fetches, request.feed_dict)
+        else:
+            self._ensure_worker()
+            self._queue.put(request)
+            results = request.future.result()
+        return results[0] if single else results
+
+    def close(self):
+        """Stop the worker thread after it has served all queued calls."""
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work,
+                                                name='inference-scheduler',
+                                                daemon=True)
+                self._thread.start()
+
+    def _work(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            pending = [request]
+            num_examples = request.size
+            deadline = time.time() + self.max_delay
+            stop = False
+            while num_examples < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                pending.append(request)
+                num_examples += request.size
+
+            for batch in self._make_batches(pending):
+                self._execute(batch)
+            if stop:
+                return
+
+    def _make_batches(self, requests):
+        """Group requests by the tensors they evaluate, with at most
+        `max_batch_size` examples per batch."""
+        groups = OrderedDict()
+        for request in requests:
+            groups.setdefault(request.key, []).append(request)
+
+        for group in groups.values():
+            batch = []
+            num_examples = 0
+            for request in group:
+                if batch and num_examples + request.size > self.max_batch_size:
+                    yield batch
+                    batch = []
+                    num_examples = 0
+                batch.append(request)
+                num_examples += request.size
+            yield batch
+
+    def _execute(self, batch):
+        first = batch[0]
+        # a failure only fails the calls of this batch, never the worker
+        try:
+            feed_dict = {tensor: np.concatenate([request.feed_dict[tensor]
+                                                 for request in batch])
+                         for tensor in first.feed_dict}
+            results = self.sess.run(first.fetches, feed_dict)
+            offsets = np.cumsum([request.size for request in batch])[:-1]
+            split_results = [np.split(result, offsets) for result in results]
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        for i, request in enumerate(batch):
+            request.future.set_result([result[i]
+                                       for result in split_results])
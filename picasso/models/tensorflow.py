@@ -84,5 +84,5 @@ class TFModel(BaseModel):
         self._latest_ckpt_time = latest_ckpt_time
 
     def predict(self, input_array):
-        return self.sess.run(self.tf_predict_var,
-                             {self.tf_input_var: input_array})
+        return self.run(self.tf_predict_var,
+                        {self.tf_input_var: input_array})
@@ -0,0 +1,111 @@
+###############################################################################
+# Copyright (c) 2017 Merantix GmbH
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+"""Detection of new checkpoints
+
+A background thread polls the model's data directory and triggers a reload
+when its files have changed.  Training jobs write checkpoints in several
+files and steps, so a change only counts once the directory has stopped
+changing for one polling interval.
+
+"""
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def checkpoint_signature(data_dir):
+    """Summarize the files of a data directory, to detect changes.
+
+    Args:
+        data_dir (:obj:`str`): directory holding the model's files.
+
+    Returns:
+        :obj:`tuple` of (name, size, modification time) of every file
+
+    """
+    signature = []
+    for name in sorted(os.listdir(data_dir)):
+        try:
+            stat = os.stat(os.path.join(data_dir, name))
+        except OSError:
+            # deleted in the meantime
+            continue
+        signature.append((name, stat.st_size, stat.st_mtime))
+    return tuple(signature)
+
+
+class CheckpointWatcher:
+    """Calls a function when the files in a directory have changed."""
+
+    def __init__(self, data_dir, on_change, interval=10):
+        """Create a new watcher.
+
+        Args:
+            data_dir (:obj:`str`): directory to watch.
+            on_change: callable without arguments, e.g. reloading the model.
+            interval (float): seconds between two checks of the directory.
+
+        """
+        self.data_dir = data_dir
+        self.on_change = on_change
+        self.interval = interval
+        self._signature = checkpoint_signature(data_dir)
+        self._pending = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        """Check the directory once, calling `on_change` if it has changed
+        and then stayed unchanged since the previous check.
+
+        Returns:
+            bool: whether `on_change` was called
+
+        """
+        signature = checkpoint_signature(self.data_dir)
+        if signature == self._signature:
+            self._pending = None
+            return False
+        if signature != self._pending:
+            # still being written
+            self._pending = signature
+            return False
+        logger.info('New checkpoint in %s', self.data_dir)
+        self.on_change()
+        self._signature = signature
+        self._pending = None
+        return True
+
+    def start(self):
+        """Call :meth:`poll` every `interval` seconds in a background
+        thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='picasso-checkpoint-watcher',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                # keep serving the old model, and retry on the next change
+                logger.exception('Reloading the model from %s failed',
+                                 self.data_dir)
+                self._signature = checkpoint_signature(self.data_dir)
+                self._pending = None
@@ -0,0 +1,155 @@
+###############################################################################
+# Copyright (c) 2017 Merantix GmbH
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+"""Heatmap rendering with NumPy and PIL
+
+Colormaps are applied through lookup tables, layers are blended with
+vectorized alpha compositing and the result is encoded by PIL directly.
+Nothing here touches global state, so all functions can be called from
+many threads at once.
+
+"""
+import numpy as np
+from PIL import Image
+
+# Colors of the matplotlib colormaps of the same name at 33 evenly spaced
+# points; the full tables are interpolated from these.
+_COLORMAP_ANCHORS = {
+    'viridis': [
+        (68, 1, 84), (71, 13, 96), (72, 24, 106), (72, 35, 116),
+        (71, 45, 123), (69, 55, 129), (66, 64, 134), (62, 73, 137),
+        (59, 82, 139), (55, 91, 141), (51, 99, 141), (47, 107, 142),
+        (44, 114, 142), (41, 122, 142), (38, 130, 142), (35, 137, 142),
+        (33, 145, 140), (31, 152, 139), (31, 160, 136), (34, 167, 133),
+        (40, 174, 128), (50, 182, 122), (63, 188, 115), (78, 195, 107),
+        (94, 201, 98), (112, 207, 87), (132, 212, 75), (152, 216, 62),
+        (173, 220, 48), (194, 223, 35), (216, 226, 25), (236, 229, 27),
+        (253, 231, 37)],
+    'inferno': [
+        (0, 0, 4), (4, 3, 18), (11, 7, 36), (21, 11, 55),
+        (33, 12, 74), (47, 10, 91), (61, 9, 101), (74, 12, 107),
+        (87, 16, 110), (100, 21, 110), (113, 25, 110), (125, 30, 109),
+        (138, 34, 106), (151, 39, 102), (163, 44, 97), (176, 49, 91),
+        (188, 55, 84), (199, 62, 76), (210, 70, 68), (219, 80, 59),
+        (228, 90, 49), (235, 102, 40), (241, 115, 29), (246, 128, 19),
+        (249, 142, 9), (251, 157, 7), (252, 172, 17), (251, 188, 33),
+        (249, 203, 53), (245, 219, 76), (242, 234, 105), (243, 246, 138),
+        (252, 255, 164)],
+}
+
+LUT_SIZE = 256
+
+
+def _make_lut(anchors):
+    anchors = np.array(anchors, dtype='float64')
+    anchor_positions = np.linspace(0, 1, len(anchors))
+    positions = np.linspace(0, 1, LUT_SIZE)
+    return np.stack([np.interp(positions, anchor_positions, anchors[:, c])
+                     for c in range(3)], axis=-1).round().astype('uint8')
+
+
+# (:obj:`dict`): colormap name to lookup table of shape (LUT_SIZE, 3)
+COLORMAPS = {name: _make_lut(anchors)
+             for name, anchors in _COLORMAP_ANCHORS.items()}
+
+
+def apply_colormap(values, cmap='viridis', vmin=None, vmax=None):
+    """Map a 2D array of values to RGB colors.
+
+    Args:
+        values (array): 2D array of scalar values.
+        cmap (:obj:`str`): name of a colormap in `COLORMAPS`.
+        vmin (float): value mapped to the lowest color.  Defaults to the
+            minimum of `values`.
+        vmax (float): value mapped to the highest color.  Defaults to the
+            maximum of `values`.
+
+    Returns:
+        uint8 array of shape values.shape + (3,)
+
+    """
+    values = np.asarray(values, dtype='float64')
+    vmin = values.min() if vmin is None else vmin
+    vmax = values.max() if vmax is None else vmax
+    scale = (LUT_SIZE - 1) / (vmax - vmin) if vmax > vmin else 0.
+    indices = np.clip((values - vmin) * scale, 0, LUT_SIZE - 1)
+    return COLORMAPS[cmap][indices.astype('intp')]
+
+
+def upsample(arr, size):
+    """Resize an image array with nearest-neighbor interpolation.
+
+    Args:
+        arr (array): array whose first two dimensions are rows and columns.
+        size (:obj:`tuple`): target (width, height), as used by PIL.
+
+    Returns:
+        array of shape (height, width) + arr.shape[2:]
+
+    """
+    width, height = size
+    rows = np.arange(height) * arr.shape[0] // height
+    cols = np.arange(width) * arr.shape[1] // width
+    return arr[rows[:, None], cols[None, :]]
+
+
+def blend(background, foreground, alpha):
+    """Alpha-composite `foreground` over an opaque `background`.
+
+    Args:
+        background (array): uint8 RGB array.
+        foreground (array): uint8 RGB array of the same shape.
+        alpha (float): opacity of the foreground, between 0 and 1.
+
+    Returns:
+        uint8 RGB array
+
+    """
+    blended = (alpha * foreground.astype('float32') +
+               (1. - alpha) * background.astype('float32'))
+    return blended.round().astype('uint8')
+
+
+def render_heatmap(values, size, cmap='viridis', vmin=None, vmax=None,
+                   underlay=None, alpha=1.):
+    """Render a heatmap, optionally on top of an image.
+
+    Args:
+        values (array): 2D array of scalar values.
+        size (:obj:`tuple`): (width, height) of the result.
+        cmap (:obj:`str`): name of a colormap in `COLORMAPS`.
+        vmin (float): value mapped to the lowest color, see
+            `apply_colormap`.
+        vmax (float): value mapped to the highest color, see
+            `apply_colormap`.
+        underlay (:obj:`PIL.Image`): optional image to draw underneath the
+            heatmap.  It is shown with opacity `1 - alpha` on a white
+            background.
+        alpha (float): opacity of the heatmap.
+
+    Returns:
+        uint8 RGB array of shape (height, width, 3)
+
+    """
+    heatmap = upsample(apply_colormap(values, cmap=cmap,
+                                      vmin=vmin, vmax=vmax), size)
+    if underlay is None or alpha >= 1.:
+        return heatmap
+    white = np.full_like(heatmap, 255)
+    image = np.array(underlay.convert('RGB').resize(size, Image.BILINEAR))
+    return blend(blend(white, image, 1. - alpha), heatmap, alpha)
+
+
+def save_png(arr, path):
+    """Encode an RGB array as PNG.
+
+    Args:
+        arr (array): uint8 RGB array.
+        path (:obj:`str`): file to write to.
+
+    """
+    Image.fromarray(arr).save(path, format='PNG')
@@ -0,0 +1,334 @@
+###############################################################################
+# Copyright (c) 2017 Merantix GmbH
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+"""Server-side storage of user sessions
+
+The session cookie only carries a session id.  The session's data and its
+list of uploaded images live in a session store, where images are looked up
+by uid or filename through an index, so the cost of a request does not grow
+with the number of uploads.
+
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class BaseSessionStore:
+    """Interface of session stores.
+
+    A session has a dict of JSON-serializable data and a list of images,
+    each a JSON-serializable dict with a `uid` that is unique within the
+    session.
+
+    """
+
+    def create(self, data):
+        """Start a new session.
+
+        Args:
+            data (:obj:`dict`): initial data of the session.
+
+        Returns:
+            :obj:`str` id of the new session
+
+        """
+        raise NotImplementedError
+
+    def get(self, sid):
+        """Get the data of a session and mark it as accessed.
+
+        Returns:
+            :obj:`dict` of session data, or `None` if the session does not
+            exist.
+
+        """
+        raise NotImplementedError
+
+    def update(self, sid, **fields):
+        """Change fields of a session's data.  Nothing happens if the
+        session does not exist, e.g. because it has expired during the
+        request."""
+        raise NotImplementedError
+
+    def delete(self, sid):
+        """Delete a session and its images."""
+        raise NotImplementedError
+
+    def add_image(self, sid, image):
+        """Add an image to a session, assigning it the next uid.
+
+        Args:
+            sid (:obj:`str`): id of the session.
+            image (:obj:`dict`): description of the image.
+
+        Returns:
+            :obj:`dict` image with its `uid`
+
+        """
+        raise NotImplementedError
+
+    def get_image(self, sid, uid):
+        """Look up an image of a session by uid.
+
+        Returns:
+            :obj:`dict` image, or `None` if the session has no such image.
+
+        """
+        raise NotImplementedError
+
+    def find_image(self, sid, filename):
+        """Look up the latest image of a session with the given filename.
+
+        Returns:
+            :obj:`dict` image, or `None` if the session has no such image.
+
+        """
+        raise NotImplementedError
+
+    def list_images(self, sid):
+        """All images of a session, in order of upload.
+
+        Returns:
+            :obj:`list` of :obj:`dict`
+
+        """
+        raise NotImplementedError
+
+    def list_sessions(self):
+        """All sessions with the time they were last accessed.
+
+        Returns:
+            :obj:`list` of (sid, data, last_access) tuples
+
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def new_sid():
+        return uuid.uuid4().hex
+
+
+class MemorySessionStore(BaseSessionStore):
+    """Session store keeping sessions in the memory of the process."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def create(self, data):
+        sid = self.new_sid()
+        with self._lock:
+            self._sessions[sid] = {'data': dict(data),
+                                   'images': {},
+                                   'uids_by_filename': {},
+                                   'uid_counter': 0,
+                                   'last_access': time.time()}
+        return sid
+
+    def get(self, sid):
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None:
+                return None
+            session['last_access'] = time.time()
+            return dict(session['data'])
+
+    def update(self, sid, **fields):
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is not None:
+                session['data'].update(fields)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def add_image(self, sid, image):
+        with self._lock:
+            session = self._sessions[sid]
+            image = dict(image, uid=session['uid_counter'])
+            session['uid_counter'] += 1
+            session['images'][image['uid']] = image
+            session['uids_by_filename'][image.get('filename')] = image['uid']
+            return dict(image)
+
+    def get_image(self, sid, uid):
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None or uid not in session['images']:
+                return None
+            return dict(session['images'][uid])
+
+    def find_image(self, sid, filename):
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None:
+                return None
+            uid = session['uids_by_filename'].get(filename)
+            return None if uid is None else dict(session['images'][uid])
+
+    def list_images(self, sid):
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None:
+                return []
+            return [dict(image) for _, image in
+                    sorted(session['images'].items())]
+
+    def list_sessions(self):
+        with self._lock:
+            return [(sid, dict(session['data']), session['last_access'])
+                    for sid, session in self._sessions.items()]
+
+
+class SQLiteSessionStore(BaseSessionStore):
+    """Session store backed by an SQLite database.
+
+    Sessions survive restarts of the server.  The database must only be
+    used by one server process at a time: the reference counts of the
+    uploads the sessions share are kept in the memory of that process (see
+    :class:`.storage.StorageManager`), so another process collecting
+    sessions would delete uploads still in use.
+
+    """
+
+    def __init__(self, path=':memory:'):
+        """Open or create a session database.
+
+        Args:
+            path (:obj:`str`): path of the database file.  By default, the
+                database is kept in memory.
+
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    sid TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    uid_counter INTEGER NOT NULL DEFAULT 0,
+                    last_access REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS images (
+                    sid TEXT NOT NULL,
+                    uid INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    filename TEXT,
+                    PRIMARY KEY (sid, uid));
+                CREATE INDEX IF NOT EXISTS images_filename
+                    ON images (sid, filename, uid);
+            ''')
+
+    def create(self, data):
+        sid = self.new_sid()
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO sessions (sid, data, last_access) '
+                'VALUES (?, ?, ?)', (sid, json.dumps(data), time.time()))
+        return sid
+
+    def get(self, sid):
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM sessions '
+                                     'WHERE sid = ?', (sid,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE sessions SET last_access = ? '
+                               'WHERE sid = ?', (time.time(), sid))
+        return json.loads(row[0])
+
+    def update(self, sid, **fields):
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            row = self._conn.execute('SELECT data FROM sessions '
+                                     'WHERE sid = ?', (sid,)).fetchone()
+            if row is None:
+                return
+            data = json.loads(row[0])
+            data.update(fields)
+            self._conn.execute('UPDATE sessions SET data = ? WHERE sid = ?',
+                               (json.dumps(data), sid))
+
+    def delete(self, sid):
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.execute('DELETE FROM images WHERE sid = ?', (sid,))
+            self._conn.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def add_image(self, sid, image):
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            uid = self._conn.execute('SELECT uid_counter FROM sessions '
+                                     'WHERE sid = ?', (sid,)).fetchone()[0]
+            image = dict(image, uid=uid)
+            self._conn.execute('UPDATE sessions SET uid_counter = ? '
+                               'WHERE sid = ?', (uid + 1, sid))
+            self._conn.execute('INSERT INTO images '
+                               '(sid, uid, data, filename) '
+                               'VALUES (?, ?, ?, ?)',
+                               (sid, uid, json.dumps(image),
+                                image.get('filename')))
+        return image
+
+    def get_image(self, sid, uid):
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM images '
+                                     'WHERE sid = ? AND uid = ?',
+                                     (sid, uid)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def find_image(self, sid, filename):
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM images '
+                                     'WHERE sid = ? AND filename = ? '
+                                     'ORDER BY uid DESC LIMIT 1',
+                                     (sid, filename)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def list_images(self, sid):
+        with self._lock:
+            rows = self._conn.execute('SELECT data FROM images WHERE sid = ? '
+                                      'ORDER BY uid', (sid,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def list_sessions(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT sid, data, last_access '
+                                      'FROM sessions').fetchall()
+        return [(sid, json.loads(data), last_access)
+                for sid, data, last_access in rows]
+
+
+# (:obj:`dict`): session store classes by the names used in the settings
+SESSION_BACKENDS = {
+    'memory': MemorySessionStore,
+    'sqlite': SQLiteSessionStore,
+}
+
+
+def make_session_store(backend, args=None):
+    """Create a session store.
+
+    Args:
+        backend: name of a backend in `SESSION_BACKENDS`, or a subclass of
+            :class:`BaseSessionStore`.
+        args (:obj:`dict`): arguments of the store's constructor.
+
+    Returns:
+        instance of :class:`BaseSessionStore`
+
+    """
+    store_cls = SESSION_BACKENDS.get(backend, backend)
+    if not (isinstance(store_cls, type) and
+            issubclass(store_cls, BaseSessionStore)):
+        raise ValueError('Unknown session backend {}'.format(backend))
+    return store_cls(**(args or {}))
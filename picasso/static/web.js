@@ -69,41 +69,67 @@ $("document").ready(function() {
         $.each(div_settings_list[0].getElementsByClassName('vizSetting'), function(i, j) {
             data[j.name] = j.options[j.selectedIndex].text
         })
+        return getResult('/api/visualize', $.param(data))
+    }
+
+    // Visualizations that take long answer with the status of their job
+    // (202), whose result is polled until it is done.  An overloaded server
+    // answers with 503 and asks to try again after Retry-After seconds.
+    function getResult(url, params) {
         return $.ajax({
             type: 'GET',
-            url: '/api/visualize',
-            data: $.param(data),
+            url: url,
+            data: params,
             cache: false,
             contentType: false,
             processData: false,
-            success: function(data) {
-                tr_text_results.empty();
-                tr_image_results.empty();
-                tr_image_results.append('<td align="center"><img src="/api/inputs/'+ data.input_file_name+'" style="width:244px;height:244px;"/></td>');
-                if (data.has_processed_input) {
-                    tr_image_results.append('<td align="center"><img src="/api/outputs/'+ data.processed_input_file_name+'" style="width:244px;height:244px;"/></td>');
-                }
-                if (data.has_output) {
-                    $.each(data.output_file_names, function(i, j) {
-                        tr_image_results.append('<td align="center"><img src="/api/outputs/'+ j +'" style="width:244px;height:244px;"/></td>');
-                    })
+            success: function(data, textStatus, xhr) {
+                if (xhr.status == 202) {
+                    console.log(data)
+                    setTimeout(function() {
+                        getResult('/api/jobs/' + data.job_id + '/result')
+                    }, 1000)
+                } else {
+                    showVisualization(data)
                 }
-                tr_text_results.append('<td align="center"><b>'+ data.input_file_name +'</b></td>')
-                if (data.has_processed_input) {
-                    tr_text_results.append('<td align="center"><b>Processed Image</b></td>')
-                }
-                $.each(data.predict_probs, function(i, j) {
-                    tr_text_results.append('<td align="center"><b>'+ j.name + ': ' + j.prob +'</b></td>');
-                })
-                console.log(data)
             },
             error: function(err) {
-                console.log(err),
-                alert('error: ('+ err.status + ') ' + err.statusText)
+                var retryAfter = parseInt(err.getResponseHeader('Retry-After'));
+                if (err.status == 503 && !isNaN(retryAfter)) {
+                    console.log(err)
+                    setTimeout(function() {
+                        getResult(url, params)
+                    }, retryAfter * 1000)
+                } else {
+                    console.log(err),
+                    alert('error: ('+ err.status + ') ' + err.statusText)
+                }
             },
         })
     }
 
+    function showVisualization(data) {
+        tr_text_results.empty();
+        tr_image_results.empty();
+        tr_image_results.append('<td align="center"><img src="/api/inputs/'+ data.input_file_name+'" style="width:244px;height:244px;"/></td>');
+        if (data.has_processed_input) {
+            tr_image_results.append('<td align="center"><img src="/api/outputs/'+ data.processed_input_file_name+'" style="width:244px;height:244px;"/></td>');
+        }
+        if (data.has_output) {
+            $.each(data.output_file_names, function(i, j) {
+                tr_image_results.append('<td align="center"><img src="/api/outputs/'+ j +'" style="width:244px;height:244px;"/></td>');
+            })
+        }
+        tr_text_results.append('<td align="center"><b>'+ data.input_file_name +'</b></td>')
+        if (data.has_processed_input) {
+            tr_text_results.append('<td align="center"><b>Processed Image</b></td>')
+        }
+        $.each(data.predict_probs, function(i, j) {
+            tr_text_results.append('<td align="center"><b>'+ j.name + ': ' + j.prob +'</b></td>');
+        })
+        console.log(data)
+    }
+
     function loadVisualizerSettings(visualizerSettings) {
         var settingItems = '';
         $.each(visualizerSettings, function(setting, options) {
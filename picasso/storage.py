@@ -0,0 +1,462 @@
+###############################################################################
+# Copyright (c) 2017 Merantix GmbH
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+"""Lifecycle of the directories holding uploads and outputs of sessions
+
+Every session gets an output directory below a common root.  Uploads are
+kept in a content-addressed blob store in the same root, so an image
+uploaded by many sessions, or many times, is stored once.  The storage
+manager enforces byte quotas per session and for all sessions together, and
+a background thread deletes sessions which have been idle for too long, so
+the disk use of a long-running server stays bounded.
+
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from picasso.blobs import BlobStore
+from picasso.cache import hash_stream
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    """Raised when storing a file would exceed a storage quota."""
+
+
+def file_sizes(path):
+    """Sizes of the files below a directory, in bytes, by their path
+    relative to it."""
+    sizes = {}
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            try:
+                sizes[os.path.relpath(full_path, path)] = \
+                    os.path.getsize(full_path)
+            except OSError:
+                # deleted in the meantime
+                pass
+    return sizes
+
+
+class _Sizes:
+    """Sizes of files by name, and their running total."""
+
+    def __init__(self, sizes=None):
+        self.sizes = dict(sizes or {})
+        self.total = sum(self.sizes.values())
+
+    def set(self, name, size):
+        """Set the size of a file, returning the change of the total."""
+        change = size - self.sizes.get(name, 0)
+        self.sizes[name] = size
+        self.total += change
+        return change
+
+
+class StorageManager:
+    """Creates, measures and garbage-collects session directories and
+    uploads.
+
+    The bytes stored by each session and by all sessions are counted as
+    files are added and deleted, so checking a quota doesn't touch the disk.
+    The files of a session that existed before, e.g. after a restart, are
+    measured once, the first time the session is seen.
+
+    The reference counts of the uploads, like these sizes, are kept in the
+    memory of the process and rebuilt from the session store on start, so
+    a root directory and its session store must only be used by one
+    process at a time.
+
+    """
+
+    def __init__(self, session_store, root=None,
+                 session_quota=256 * 2 ** 20, global_quota=4 * 2 ** 30,
+                 ttl=3600, gc_interval=60, min_collect_interval=1):
+        """Create a new storage manager.
+
+        Args:
+            session_store (:class:`.sessions.BaseSessionStore`): store of the
+                sessions owning the directories.
+            root (:obj:`str`): directory below which session directories are
+                created.  A temporary directory is used if this is `None`.
+            session_quota (int): maximum bytes stored by one session.
+            global_quota (int): maximum bytes stored by all sessions.
+            ttl (float): seconds after its last access at which a session
+                is deleted.
+            gc_interval (float): seconds between garbage collection runs.
+            min_collect_interval (float): minimum seconds between two
+                garbage collection runs started to make room for a file,
+                when the global quota is used up.  Until then, further
+                files are refused right away.
+
+        """
+        self.session_store = session_store
+        self.root = root or tempfile.mkdtemp(prefix='picasso-sessions-')
+        os.makedirs(self.root, exist_ok=True)
+        self.session_quota = session_quota
+        self.global_quota = global_quota
+        self.ttl = ttl
+        self.gc_interval = gc_interval
+        self.min_collect_interval = min_collect_interval
+        self.blobs = BlobStore(os.path.join(self.root, 'blobs'))
+
+        # sizes of the uploads of each session by uid, counting uploads
+        # shared with other sessions in full
+        self._uploads = {}
+        # sizes of the files in each output directory by name
+        self._outputs = {}
+        self._output_bytes = 0
+        # bytes reserved for uploads not yet added to their session, by
+        # sid, and the bytes they will add to the disk use
+        self._reserved = {}
+        self._reserved_new_bytes = 0
+        self._last_collect = 0.
+        self._lock = threading.Lock()
+        # serializes quota checks and deleting sessions, so concurrent
+        # uploads can't overrun a quota together and the uploads of a
+        # session are released exactly once
+        self._quota_lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def create_session_dirs(self):
+        """Create the directories of a new session.
+
+        Returns:
+            :obj:`dict` with the key 'img_output_dir'
+
+        """
+        session_dir = tempfile.mkdtemp(dir=self.root)
+        dirs = {'img_output_dir': os.path.join(session_dir, 'outputs')}
+        os.mkdir(dirs['img_output_dir'])
+        with self._lock:
+            self._outputs[dirs['img_output_dir']] = _Sizes()
+        return dirs
+
+    def _session_uploads(self, sid):
+        # must be called without self._lock held
+        with self._lock:
+            uploads = self._uploads.get(sid)
+        if uploads is None:
+            sizes = {image['uid']: image.get('size', 0)
+                     for image in self.session_store.list_images(sid)}
+            with self._lock:
+                uploads = self._uploads.setdefault(sid, _Sizes(sizes))
+        return uploads
+
+    def _session_outputs(self, output_dir):
+        # must be called without self._lock held
+        with self._lock:
+            outputs = self._outputs.get(output_dir)
+        if outputs is None:
+            sizes = file_sizes(output_dir)
+            with self._lock:
+                outputs = self._outputs.get(output_dir)
+                if outputs is None:
+                    outputs = self._outputs[output_dir] = _Sizes(sizes)
+                    self._output_bytes += outputs.total
+        return outputs
+
+    def _global_usage(self):
+        with self._lock:
+            usage = self._output_bytes + self._reserved_new_bytes
+        return usage + self.blobs.usage()
+
+    def session_usage(self, sid, data):
+        """Bytes stored by a session, counting each of its uploads in full
+        even if other sessions share it, and the uploads in progress.
+
+        Args:
+            sid (:obj:`str`): id of the session.
+            data (:obj:`dict`): the session's data.
+
+        """
+        uploads = self._session_uploads(sid)
+        outputs = self._session_outputs(data.get('img_output_dir', ''))
+        with self._lock:
+            return (uploads.total + outputs.total +
+                    self._reserved.get(sid, (0, 0))[0])
+
+    def reserve(self, sid, data, num_bytes, new_bytes=None):
+        """Make sure a session may store `num_bytes` more.
+
+        If the global quota would be exceeded, idle sessions are deleted,
+        least recently used first, to make room, at most every
+        `min_collect_interval` seconds.  The bytes count towards the
+        session's usage until :meth:`release_reservation` is called, e.g.
+        once the file has been added to the session's images.
+
+        Args:
+            sid (:obj:`str`): id of the session.
+            data (:obj:`dict`): the session's data.
+            num_bytes (int): size of the file to store.
+            new_bytes (int): bytes the file adds to the disk use of the
+                server, which is 0 if it is stored already.  Defaults to
+                `num_bytes`.
+
+        Raises:
+            QuotaExceeded: if there is no room for the file.
+
+        """
+        if new_bytes is None:
+            new_bytes = num_bytes
+        with self._quota_lock:
+            if (self.session_usage(sid, data) + num_bytes >
+                    self.session_quota):
+                raise QuotaExceeded('Storing {} bytes would exceed the '
+                                    'session quota of {} bytes'
+                                    .format(num_bytes, self.session_quota))
+            usage = self._global_usage()
+            if (usage + new_bytes > self.global_quota and
+                    time.time() - self._last_collect >=
+                    self.min_collect_interval):
+                usage = self.collect(required=new_bytes, keep=sid)
+            if usage + new_bytes > self.global_quota:
+                raise QuotaExceeded('The server is out of storage space')
+            if num_bytes or new_bytes:
+                with self._lock:
+                    reserved, reserved_new = self._reserved.get(sid, (0, 0))
+                    self._reserved[sid] = (reserved + num_bytes,
+                                           reserved_new + new_bytes)
+                    self._reserved_new_bytes += new_bytes
+
+    def release_reservation(self, sid, num_bytes, new_bytes=None):
+        """Stop counting bytes reserved with :meth:`reserve` as part of the
+        session's usage and the disk use of the server.
+
+        Args:
+            sid (:obj:`str`): id of the session.
+            num_bytes (int): bytes reserved for the session.
+            new_bytes (int): bytes reserved on the disk.  Defaults to
+                `num_bytes`.
+
+        """
+        if new_bytes is None:
+            new_bytes = num_bytes
+        with self._lock:
+            reserved, reserved_new = self._reserved.get(sid, (0, 0))
+            new_bytes = min(new_bytes, reserved_new)
+            self._reserved_new_bytes -= new_bytes
+            if reserved > num_bytes or reserved_new > new_bytes:
+                self._reserved[sid] = (max(reserved - num_bytes, 0),
+                                       reserved_new - new_bytes)
+            else:
+                self._reserved.pop(sid, None)
+
+    def reserve_output(self, sid, data):
+        """Make sure a session may write the outputs of a visualization.
+
+        Their size is not known in advance, so this only checks that the
+        session and the server are below their quotas, deleting idle
+        sessions if necessary.  The written files are counted with
+        :meth:`add_output`.
+
+        Args:
+            sid (:obj:`str`): id of the session.
+            data (:obj:`dict`): the session's data.
+
+        Raises:
+            QuotaExceeded: if a quota is used up.
+
+        """
+        self.reserve(sid, data, 0)
+
+    def add_output(self, paths):
+        """Count files written to sessions' output directories in their
+        usage and in the disk use of the server.  Files counted before are
+        counted again with their current size.
+
+        Args:
+            paths (:obj:`list` of :obj:`str`): paths of the files.
+
+        """
+        for path in paths:
+            output_dir, filename = os.path.split(path)
+            if not os.path.isdir(output_dir):
+                # the session has been deleted in the meantime
+                continue
+            outputs = self._session_outputs(output_dir)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            with self._lock:
+                if self._outputs.get(output_dir) is outputs:
+                    self._output_bytes += outputs.set(filename, size)
+
+    def add_upload(self, sid, data, fp, filename, digest=None):
+        """Store an uploaded file and add it to a session's images.
+
+        The file's content is only written if no session has uploaded it
+        before.
+
+        Args:
+            sid (:obj:`str`): id of the session.
+            data (:obj:`dict`): the session's data.
+            fp: seekable file object of the upload, at its start.
+            filename (:obj:`str`): sanitized name of the upload.
+            digest (:obj:`str`): SHA-256 hex digest of the content, if it is
+                known already.
+
+        Returns:
+            :obj:`dict` image of the session, with its `uid`, `filename`,
+            content `hash` and `size`
+
+        Raises:
+            QuotaExceeded: if there is no room for the file.
+
+        """
+        start = fp.tell()
+        if digest is None:
+            digest = hash_stream(fp)
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell() - start
+        fp.seek(start)
+        new_bytes = 0 if digest in self.blobs else size
+        self.reserve(sid, data, size, new_bytes=new_bytes)
+        try:
+            uploads = self._session_uploads(sid)
+            self.blobs.put(fp, digest)
+            try:
+                image = self.session_store.add_image(
+                    sid, {'filename': filename, 'hash': digest,
+                          'size': size})
+            except BaseException:
+                self.blobs.release(digest)
+                raise
+            with self._lock:
+                if self._uploads.get(sid) is uploads:
+                    uploads.set(image['uid'], size)
+            return image
+        finally:
+            # once added, the image itself counts
+            self.release_reservation(sid, size, new_bytes)
+
+    def upload_path(self, image):
+        """Path of the stored file of a session's image."""
+        return self.blobs.path(image['hash'])
+
+    def delete_session(self, sid, data):
+        """Delete a session, its directories and its references to
+        uploads."""
+        output_dir = data.get('img_output_dir', '')
+        with self._quota_lock:
+            # a session deleted concurrently has no images left
+            images = self.session_store.list_images(sid)
+            self.session_store.delete(sid)
+            for image in images:
+                self.blobs.release(image['hash'])
+            with self._lock:
+                self._uploads.pop(sid, None)
+                outputs = self._outputs.pop(output_dir, None)
+                if outputs is not None:
+                    self._output_bytes -= outputs.total
+        shutil.rmtree(output_dir, ignore_errors=True)
+        parent = os.path.dirname(output_dir)
+        if os.path.dirname(parent) == self.root:
+            shutil.rmtree(parent, ignore_errors=True)
+
+    def collect(self, required=0, keep=None):
+        """Delete expired sessions, and further idle sessions until
+        `required` bytes fit into the global quota.
+
+        Args:
+            required (int): bytes that need to be stored.
+            keep (:obj:`str`): id of a session which must not be deleted.
+
+        Returns:
+            int: bytes stored by the remaining sessions and uploads
+
+        """
+        # a session must not be deleted by two collections at once
+        with self._quota_lock:
+            now = self._last_collect = time.time()
+            sessions = []
+            for sid, data, last_access in self.session_store.list_sessions():
+                if sid != keep and now - last_access > self.ttl:
+                    logger.info('Deleting session %s, idle for %d seconds',
+                                sid, now - last_access)
+                    self.delete_session(sid, data)
+                else:
+                    # measure the files of sessions not seen before
+                    self._session_uploads(sid)
+                    self._session_outputs(data.get('img_output_dir', ''))
+                    sessions.append((last_access, sid, data))
+            with self._lock:
+                # directories of sessions deleted while being measured
+                for output_dir in [output_dir for output_dir in self._outputs
+                                   if not os.path.isdir(output_dir)]:
+                    self._output_bytes -= self._outputs.pop(output_dir).total
+            usage = self._global_usage()
+
+            for _, sid, data in sorted(sessions,
+                                       key=lambda session: session[0]):
+                if usage + required <= self.global_quota:
+                    break
+                if sid == keep:
+                    continue
+                self.delete_session(sid, data)
+                # only uploads no other session holds are freed
+                remaining = self._global_usage()
+                logger.info('Deleted session %s to free %d bytes', sid,
+                            usage - remaining)
+                usage = remaining
+            return usage
+
+    def usage(self):
+        """Report the disk usage of the sessions.
+
+        Returns:
+            :obj:`dict` with the keys `used_bytes`, `upload_bytes`,
+            `global_quota`, `session_quota` and `num_sessions`
+
+        """
+        return {'used_bytes': self._global_usage(),
+                'upload_bytes': self.blobs.usage(),
+                'global_quota': self.global_quota,
+                'session_quota': self.session_quota,
+                'num_sessions': len(self.session_store.list_sessions())}
+
+    def restore_references(self):
+        """Count the references of the sessions to the stored uploads, and
+        delete the uploads no session holds, e.g. after a restart."""
+        counts = {}
+        for sid, _, _ in self.session_store.list_sessions():
+            for image in self.session_store.list_images(sid):
+                counts[image['hash']] = counts.get(image['hash'], 0) + 1
+        self.blobs.reset_references(counts)
+
+    def start(self):
+        """Run :meth:`collect` every `gc_interval` seconds in a background
+        thread."""
+        if self._thread is None:
+            self.restore_references()
+            self.collect()
+            self._thread = threading.Thread(target=self._run,
+                                            name='picasso-storage-gc',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.gc_interval):
+            try:
+                self.collect()
+            except Exception:
+                logger.exception('Garbage collection of sessions failed')
@@ -0,0 +1,107 @@
+###############################################################################
+# Copyright (c) 2017 Merantix GmbH
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+"""Decoding of uploaded images
+
+Uploads are decoded once, when they arrive, and kept in memory at a
+resolution close to what the model and the visualizations need.  JPEG
+images are scaled down while they are decoded, which avoids decoding
+multi-megapixel photos at full resolution.
+
+"""
+from PIL import Image
+
+from picasso.cache import LRUCache
+
+
+class InvalidUpload(ValueError):
+    """Raised when an upload is not an image that can be processed."""
+
+
+def decode_image(fp, max_size=(512, 512), max_pixels=50 * 10 ** 6):
+    """Decode an image, scaled down to fit into `max_size`.
+
+    Args:
+        fp: path or file object of the encoded image.
+        max_size (:obj:`tuple`): (width, height) the image is scaled down to
+            fit into, keeping its aspect ratio.  Smaller images are not
+            changed.
+        max_pixels (int): maximum number of pixels of the encoded image.
+
+    Returns:
+        the decoded :obj:`PIL.Image`, with the `format` of the encoded image
+
+    Raises:
+        InvalidUpload: if the data is not an image or too large.
+
+    """
+    try:
+        image = Image.open(fp)
+    except Exception:
+        # PIL raises different errors for unknown formats, truncated headers
+        # and decompression bombs
+        raise InvalidUpload('Not a supported image')
+    image_format = image.format
+    width, height = image.size
+    if width * height > max_pixels:
+        raise InvalidUpload('Images may have at most {} pixels, got {}x{}'
+                            .format(max_pixels, width, height))
+    if max_size:
+        # lets the JPEG decoder scale down by up to a factor of 8 for free
+        image.draft(image.mode, max_size)
+    try:
+        image.load()
+    except Exception as e:
+        raise InvalidUpload('Corrupt image: {}'.format(e))
+    if max_size:
+        image.thumbnail(max_size, Image.BILINEAR)
+    image.format = image_format
+    return image
+
+
+class DecodedImageCache:
+    """Bounded cache of decoded images, by the hash of their file's
+    content."""
+
+    def __init__(self, max_entries=128, max_size=(512, 512),
+                 max_pixels=50 * 10 ** 6):
+        """Create a new cache.
+
+        Args:
+            max_entries (int): maximum number of images kept in memory.
+            max_size (:obj:`tuple`): see :func:`decode_image`.
+            max_pixels (int): see :func:`decode_image`.
+
+        """
+        self.max_size = max_size
+        self.max_pixels = max_pixels
+        self._images = LRUCache(max_entries)
+
+    def decode(self, fp):
+        """Decode an image with the settings of the cache."""
+        return decode_image(fp, max_size=self.max_size,
+                            max_pixels=self.max_pixels)
+
+    def put(self, digest, image):
+        """Remember the decoded image of a file."""
+        self._images.put(digest, image)
+
+    def get(self, digest, path):
+        """Get the decoded image of a file, decoding it if necessary.
+
+        The returned image is shared and must not be modified.
+
+        Args:
+            digest (:obj:`str`): hash of the file's content.
+            path (:obj:`str`): path of the file.
+
+        """
+        image = self._images.get(digest)
+        if image is None:
+            image = self.decode(path)
+            self._images.put(digest, image)
+        return image
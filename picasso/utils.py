@@ -17,17 +17,69 @@ This code only provides utility functions to access the backend.
 """
 from types import ModuleType
 from importlib import import_module
+import atexit
 import inspect
+import logging
+import os
+import threading
 from flask import (
     g,
     current_app
 )
 from picasso.visualizations import *
 from picasso.visualizations.base import BaseVisualization
-from picasso.models.base import load_model
+from picasso.models.registry import registry
+from picasso.models.watcher import CheckpointWatcher
+from picasso.jobs import JobManager
+from picasso.sessions import make_session_store
+from picasso.storage import StorageManager
+from picasso.uploads import DecodedImageCache
+from picasso.cache import (
+    ResultCache,
+    SingleFlight,
+    copy_result_files,
+    result_files
+)
 
 APP_TITLE = 'Picasso Visualizer'
 
+logger = logging.getLogger(__name__)
+
+# guards building the visualizations of a model entry
+_visualizations_lock = threading.Lock()
+
+# visualization results shared by all requests
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+# visualization calls currently running, shared by identical requests
+_visualization_flights = SingleFlight()
+
+# server-side storage of user sessions
+_session_store = None
+_session_store_lock = threading.Lock()
+
+# manager of the sessions' directories
+_storage_manager = None
+_storage_manager_lock = threading.Lock()
+
+# decoded uploads, shared by all requests
+_decoded_images = None
+_decoded_images_lock = threading.Lock()
+
+# reload the models when new checkpoints appear, by model name
+_checkpoint_watchers = {}
+_checkpoint_watchers_lock = threading.Lock()
+
+# loads and warms up the default model in the background
+_warm_up_thread = None
+_warm_up_error = None
+_warm_up_lock = threading.Lock()
+
+# executor of visualization jobs
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
 
 def _get_visualization_classes():
     """Import visualizations classes dynamically
@@ -49,36 +101,424 @@ def _get_visualization_classes():
     return visualization_classes
 
 
+def _setup_model(model):
+    """Apply the app's inference settings to a freshly loaded model."""
+    model.enable_batching(
+        max_batch_size=current_app.config['INFERENCE_MAX_BATCH_SIZE'],
+        max_delay=current_app.config['INFERENCE_MAX_DELAY'])
+    model.enable_memo(
+        current_app.config['PREDICTION_MEMO_SIZE'],
+        max_arrays=current_app.config['UPLOAD_CACHE_ENTRIES'])
+
+
+def get_model_configs():
+    """Get the models served by the app.
+
+    Returns:
+        :obj:`dict` mapping model names to dicts with the keys
+        'MODEL_CLS_PATH', 'MODEL_CLS_NAME' and 'MODEL_LOAD_ARGS'.  Without
+        `MODELS` in the settings, this is the single model of the
+        `MODEL_*` settings, named by its class.
+
+    """
+    config = current_app.config
+    if config['MODELS']:
+        return config['MODELS']
+    return {config['MODEL_CLS_NAME']: {
+        'MODEL_CLS_PATH': config['MODEL_CLS_PATH'],
+        'MODEL_CLS_NAME': config['MODEL_CLS_NAME'],
+        'MODEL_LOAD_ARGS': config['MODEL_LOAD_ARGS']}}
+
+
+def get_default_model_name():
+    """Name of the model used by requests which don't select one."""
+    return (current_app.config['DEFAULT_MODEL'] or
+            sorted(get_model_configs())[0])
+
+
+def get_model_name():
+    """Name of the model used in the current app context, as selected by
+    setting `g.model_name`, or the default model."""
+    return g.get('model_name') or get_default_model_name()
+
+
+def _model_spec(name):
+    spec = get_model_configs()[name]
+    return (spec['MODEL_CLS_PATH'], spec['MODEL_CLS_NAME'],
+            spec.get('MODEL_LOAD_ARGS', {}))
+
+
+def _warm_up_model(entry):
+    """Run synthetic batches of the `WARMUP_BATCH_SIZES` through the
+    prediction path of a freshly loaded model and the paths of its
+    visualizations, e.g. gradients.
+
+    Returns:
+        :obj:`dict` mapping 'predict' and visualization names to the
+        latencies of their runs
+
+    """
+    batch_sizes = current_app.config['WARMUP_BATCH_SIZES']
+    latencies = {'predict': entry.model.warm_up(batch_sizes)}
+    for name, vis in _get_entry_visualizations(entry).items():
+        vis_latencies = vis.warm_up(batch_sizes)
+        if vis_latencies:
+            latencies[name] = vis_latencies
+    return latencies
+
+
+def _watch_checkpoints(name):
+    """Start reloading a model whenever its data directory changes,
+    unless this is disabled or already running."""
+    interval = current_app.config['CHECKPOINT_POLL_INTERVAL']
+    spec = _model_spec(name)
+    data_dir = spec[2].get('data_dir')
+    if not interval or not data_dir:
+        return
+    with _checkpoint_watchers_lock:
+        if name not in _checkpoint_watchers:
+            app = current_app._get_current_object()
+
+            def reload():
+                with app.app_context():
+                    registry.reload(*spec, setup=_setup_model,
+                                    warm_up=_warm_up_model)
+
+            watcher = CheckpointWatcher(data_dir, reload, interval=interval)
+            watcher.start()
+            _checkpoint_watchers[name] = watcher
+
+
+def get_model_entry():
+    """Get the registry entry of the selected model (see
+    :func:`get_model_name`).  Models are loaded on first use, each into a
+    graph and session of its own, and shared between requests until they
+    are evicted to make room for other models.
+
+    Within an app context, e.g. a request or a job, the same entry is
+    returned by every call and held until the context ends, so a model
+    swapped out by a reload or evicted is only closed after its users are
+    done.
+
+    Returns:
+        instance of :class:`.models.registry.ModelEntry`
+
+    """
+    entry = g.get('model_entry')
+    if entry is None:
+        name = get_model_name()
+        entry = registry.get_entry(*_model_spec(name), setup=_setup_model,
+                                   warm_up=_warm_up_model, isolated=True,
+                                   acquire=True)
+        g.model_entry = entry
+        registry.evict(max_models=current_app.config['MAX_LOADED_MODELS'],
+                       memory_budget=current_app.config['MODEL_MEMORY_BUDGET'])
+        _watch_checkpoints(name)
+    return entry
+
+
+def list_models():
+    """Describe the models served by the app, whether they are loaded or
+    not.
+
+    Returns:
+        :obj:`list` of :obj:`dict`, sorted by model name
+
+    """
+    default = get_default_model_name()
+    models = []
+    for name in sorted(get_model_configs()):
+        entry = registry.get_loaded(*_model_spec(name))
+        model = {'name': name,
+                 'default': name == default,
+                 'loaded': entry is not None}
+        if entry is not None:
+            model.update(entry.stats())
+            model['latest_ckpt_name'] = entry.model.latest_ckpt_name
+            model['in_flight'] = entry.in_flight
+        models.append(model)
+    return models
+
+
+def release_model_entry(exception=None):
+    """Release the model entry held by the ending app context.  Registered
+    as a teardown function of the app."""
+    entry = g.pop('model_entry', None)
+    if entry is not None:
+        entry.release()
+
+
+def start_warm_up():
+    """Load and warm up the default model in a background thread, unless it
+    is loaded or loading already.  A failed attempt is retried on the next
+    call."""
+    global _warm_up_thread
+    with _warm_up_lock:
+        if _warm_up_thread is not None and _warm_up_thread.is_alive():
+            return
+        app = current_app._get_current_object()
+
+        def warm_up():
+            global _warm_up_error
+            with app.app_context():
+                try:
+                    get_model_entry()
+                    _warm_up_error = None
+                except Exception as e:
+                    logger.exception('Loading the model failed')
+                    _warm_up_error = str(e)
+
+        _warm_up_thread = threading.Thread(target=warm_up,
+                                           name='picasso-warm-up',
+                                           daemon=True)
+        _warm_up_thread.start()
+
+
+def get_readiness():
+    """Check whether the default model is loaded and warmed up, starting
+    to load it in the background if it is not.
+
+    Returns:
+        :obj:`dict` with the keys `ready` and `model`, and `error` if the
+        last attempt to load the model failed, or `warm_up_latencies` if
+        it is ready
+
+    """
+    name = get_default_model_name()
+    entry = registry.get_loaded(*_model_spec(name))
+    if entry is None:
+        start_warm_up()
+        state = {'ready': False, 'model': name}
+        if _warm_up_error is not None:
+            state['error'] = _warm_up_error
+        return state
+    return {'ready': True, 'model': name,
+            'warm_up_latencies': entry.warm_up_latencies}
+
+
 def get_model():
-    """Get the NN model that's being analyzed from the request context.  Put
-    the model in the request context if it is not yet there.
+    """Get the NN model that's being analyzed.  The model is loaded on first
+    use and then shared by all requests of the process.
 
     Returns:
         instance of :class:`.models.model.Model` or derived
         class
     """
-    if not hasattr(g, 'model'):
-        g.model = load_model(current_app.config['MODEL_CLS_PATH'],
-                             current_app.config['MODEL_CLS_NAME'],
-                             current_app.config['MODEL_LOAD_ARGS'])
-    return g.model
+    return get_model_entry().model
 
 
 def get_visualizations():
-    """Get the available visualizations from the request context.  Put the
-    visualizations in the request context if they are not yet there.
+    """Get the available visualizations for the current model.  The
+    visualizations are built once per model and shared by all requests;
+    per-request settings are passed to `make_visualization` instead.
+
+    Returns:
+        :obj:`dict` mapping names to instances of :class:`.BaseVisualization`
+        or derived class
+
+    """
+    return _get_entry_visualizations(get_model_entry())
+
+
+def _get_entry_visualizations(entry):
+    # kept on the registry entry, so they are dropped with the model
+    with _visualizations_lock:
+        if not entry.visualizations:
+            visualizations = {}
+            vis_args = current_app.config['VISUALIZATION_ARGS']
+            for VisClass in _get_visualization_classes():
+                vis = VisClass(entry.model,
+                               **vis_args.get(VisClass.__name__, {}))
+                visualizations[vis.__class__.__name__] = vis
+            entry.visualizations = visualizations
+        return entry.visualizations
+
+
+def get_model_id():
+    """Identify the current model and checkpoint, e.g. for cache keys.
+
+    Returns:
+        :obj:`list` of the model's class path, class name, load args and
+        latest checkpoint
+
+    """
+    model = get_model()
+    model_cls_path, model_cls_name, model_load_args = _model_spec(
+        get_model_name())
+    return [model_cls_path,
+            model_cls_name,
+            sorted(model_load_args.items()),
+            model.latest_ckpt_name,
+            model.latest_ckpt_time]
+
+
+def get_result_cache():
+    """Get the cache of visualization results, creating it on first use.
+
+    Returns:
+        instance of :class:`.cache.ResultCache`
+
+    """
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(
+                memory_entries=current_app.config['RESULT_CACHE_ENTRIES'],
+                disk_dir=current_app.config['RESULT_CACHE_DIR'],
+                disk_bytes=current_app.config['RESULT_CACHE_DISK_BYTES'])
+        return _result_cache
+
+
+def get_session_store():
+    """Get the configured store of user sessions, creating it on first use.
+
+    Returns:
+        instance of :class:`.sessions.BaseSessionStore`
+
+    """
+    global _session_store
+    with _session_store_lock:
+        if _session_store is None:
+            _session_store = make_session_store(
+                current_app.config['SESSION_BACKEND'],
+                current_app.config['SESSION_BACKEND_ARGS'])
+        return _session_store
+
+
+def get_storage_manager():
+    """Get the manager of the sessions' directories.  On first use, it is
+    created and starts collecting expired sessions in the background.
+
+    Returns:
+        instance of :class:`.storage.StorageManager`
+
+    """
+    global _storage_manager
+    with _storage_manager_lock:
+        if _storage_manager is None:
+            _storage_manager = StorageManager(
+                get_session_store(),
+                root=current_app.config['STORAGE_ROOT'],
+                session_quota=current_app.config['STORAGE_SESSION_QUOTA'],
+                global_quota=current_app.config['STORAGE_GLOBAL_QUOTA'],
+                ttl=current_app.config['SESSION_TTL'],
+                gc_interval=current_app.config['STORAGE_GC_INTERVAL'],
+                min_collect_interval=current_app.config[
+                    'STORAGE_MIN_COLLECT_INTERVAL'])
+            _storage_manager.start()
+        return _storage_manager
+
+
+def get_job_manager():
+    """Get the executor of visualization jobs, starting it on first use.
+    Queued jobs are finished before the process exits.
 
     Returns:
-        :obj:`list` of instances of :class:`.BaseVisualization` or
-        derived class
+        instance of :class:`.jobs.JobManager`
 
     """
-    if not hasattr(g, 'visualizations'):
-        g.visualizations = {}
-        for VisClass in _get_visualization_classes():
-            vis = VisClass(get_model())
-            g.visualizations[vis.__class__.__name__] = vis
-    return g.visualizations
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager(
+                num_workers=current_app.config['JOB_WORKERS'],
+                max_finished=current_app.config['JOB_HISTORY_SIZE'],
+                max_backlog=current_app.config['JOB_MAX_BACKLOG'],
+                aging_rate=current_app.config['JOB_AGING_RATE'])
+            atexit.register(_job_manager.shutdown)
+        return _job_manager
+
+
+def get_decoded_images():
+    """Get the cache of decoded uploads, creating it on first use.
+
+    Returns:
+        instance of :class:`.uploads.DecodedImageCache`
+
+    """
+    global _decoded_images
+    with _decoded_images_lock:
+        if _decoded_images is None:
+            _decoded_images = DecodedImageCache(
+                max_entries=current_app.config['UPLOAD_CACHE_ENTRIES'],
+                max_size=current_app.config['UPLOAD_DECODE_SIZE'],
+                max_pixels=current_app.config['UPLOAD_MAX_PIXELS'])
+        return _decoded_images
+
+
+def open_inputs(images):
+    """Open images as inputs of `make_visualization`.  Images decoded at
+    upload are taken from memory.
+
+    Args:
+        images (:obj:`list` of :obj:`tuple`): (filename, path, content hash)
+            of each image.
+
+    Returns:
+        :obj:`list` of :obj:`dict` with the keys 'filename', 'data' and
+        'digest', the content hash of the upload, under which the model
+        memoizes its preprocessed array
+
+    """
+    decoded_images = get_decoded_images()
+    return [{'filename': filename, 'data': decoded_images.get(digest, path),
+             'digest': digest}
+            for filename, path, digest in images]
+
+
+def run_visualization(vis, images, output_dir, settings,
+                      cached_only=False, inputs=None):
+    """Visualize images, reusing earlier and concurrent identical calls.
+
+    Results are looked up in the result cache first.  If they are missing,
+    concurrent calls for the same images, visualization, settings and
+    checkpoint wait for a single computation and share its result.
+
+    Args:
+        vis (:class:`.BaseVisualization`): the visualization to run.
+        images (:obj:`list` of :obj:`tuple`): (filename, path, content hash)
+            of each input image.
+        output_dir (:obj:`str`): directory to write the output files to.
+        settings (:class:`.visualizations.base.Settings`): parsed settings
+            of the visualization.
+        cached_only (bool): only look up the result cache, without running
+            the visualization.
+        inputs (:obj:`list` of :obj:`dict`): the images already opened as
+            `make_visualization` inputs, to share them between calls.  The
+            images are opened from `images` if this is `None`.
+
+    Returns:
+        the results of `vis.make_visualization`, or `None` if `cached_only`
+        is set and the results are not cached
+
+    """
+    cache = get_result_cache()
+    key = cache.make_key([digest for _, _, digest in images],
+                         type(vis).__name__, settings, get_model_id())
+    output = cache.get(key, output_dir)
+    if output is None and cached_only:
+        return None
+    if output is None:
+        def compute():
+            results = vis.make_visualization(
+                inputs or open_inputs(images), output_dir=output_dir,
+                settings=settings)
+            cache.put(key, results, output_dir)
+            return results, output_dir
+
+        (output, src_dir), shared = _visualization_flights.do(key, compute)
+        if shared:
+            copy_result_files(output, src_dir, output_dir)
+            output = [dict(result) for result in output]
+
+    get_storage_manager().add_output(
+        [os.path.join(output_dir, filename)
+         for result in output for filename in result_files(result)])
+
+    # the same content may have been uploaded under another name
+    for result, (filename, _, _) in zip(output, images):
+        result['input_file_name'] = filename
+    return output
 
 
 def get_app_state():
@@ -89,11 +529,20 @@ def get_app_state():
 
     """
     if not hasattr(g, 'app_state'):
-        model = get_model()
+        entry = get_model_entry()
+        model = entry.model
         g.app_state = {
             'app_title': APP_TITLE,
+            'model': get_model_name(),
             'model_name': type(model).__name__,
             'latest_ckpt_name': model.latest_ckpt_name,
-            'latest_ckpt_time': model.latest_ckpt_time
+            'latest_ckpt_time': model.latest_ckpt_time,
+            'model_load_time': entry.load_time,
+            'model_memory_footprint': entry.memory_footprint,
+            'model_loaded_at': entry.loaded_at,
+            'model_generation': entry.generation,
+            'previous_ckpt_name': entry.previous_ckpt_name,
+            'model_warm_up_latencies': entry.warm_up_latencies,
+            'retiring_models': len(registry.retiring())
         }
     return g.app_state
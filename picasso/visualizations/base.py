@@ -10,15 +10,75 @@
 #    documentation
 #    Josh Chen - refactor and class config
 ###############################################################################
+from collections.abc import Mapping
 import re
 
 
+def setting_attribute_name(setting):
+    """Convert a setting name into a valid, lowercase attribute name.
+
+    See:
+
+    https://stackoverflow.com/questions/3303312/how-do-i-convert-a-string-to-a-valid-variable-name-in-python
+
+    """
+    return re.sub(r'\W|^(?=\d)', '_', setting).lower()
+
+
+class Settings(Mapping):
+    """Immutable settings of a single visualization call.
+
+    Settings behave like a read-only :obj:`dict` mapping setting names to
+    values.  Each setting can also be read as an attribute named after the
+    lowercase setting name, with invalid characters replaced by underscores
+    (e.g. the setting 'Window' is available as `settings.window`).
+
+    """
+    __slots__ = ('_values', '_attributes')
+
+    def __init__(self, values=None):
+        values = dict(values or {})
+        object.__setattr__(self, '_values', values)
+        object.__setattr__(self, '_attributes',
+                           {setting_attribute_name(setting): value
+                            for setting, value in values.items()})
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getattr__(self, name):
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Settings are immutable')
+
+    def __hash__(self):
+        return hash(frozenset(self._values.items()))
+
+    def __repr__(self):
+        return 'Settings({!r})'.format(self._values)
+
+
 class BaseVisualization:
     """Interface encapsulating a NN visualization.
 
     This interface defines how a visualization is computed for a given NN
     model.
 
+    Instances are created once per model and shared between requests, so
+    subclasses must not store per-call state on the instance.  Everything
+    that depends on the user's choices is passed to `make_visualization`
+    as an immutable :class:`Settings` object.
+
     """
     # (:obj:`str`): Short description of the visualization.
     DESCRIPTION = None
@@ -27,7 +87,8 @@ class BaseVisualization:
     REFERENCE_LINK = None
 
     # (:obj:`dict`): Optional visualization settings that the user can select,
-    # as a dict mapping setting names to lists of their allowed values.
+    # as a dict mapping setting names to lists of their allowed values.  The
+    # first value of each list is the default.
     ALLOWED_SETTINGS = None
 
     def __init__(self, model):
@@ -43,11 +104,6 @@ class BaseVisualization:
         """
         self._model = model
 
-        # give default settings
-        if self.ALLOWED_SETTINGS:
-            self.update_settings({setting: self.ALLOWED_SETTINGS[setting][0]
-                                  for setting in self.ALLOWED_SETTINGS})
-
     @property
     def model(self):
         """NN model to be visualized.
@@ -57,49 +113,95 @@ class BaseVisualization:
         """
         return self._model
 
-    def update_settings(self, settings):
-        """Update the settings
+    def parse_settings(self, settings=None):
+        """Validate user settings and fill in defaults.
 
         If a derived class has an ALLOWED_SETTINGS dict, we check here that
-        incoming settings from the web app are allowed, and set the child
-        properties as appropriate.
+        incoming settings from the web app are allowed.  Settings the user
+        did not choose take the first allowed value.
+
+        Args:
+            settings (:obj:`dict`): Settings selected by the user, mapping
+                setting names to values.  May be `None`.
+
+        Returns:
+            :class:`Settings` for a single call of `make_visualization`.
 
         """
+        if isinstance(settings, Settings):
+            return settings
 
         def error_string(setting, setting_val):
             return ('{val} is not an acceptable value for '
-                    'parameter {param} for visualization'
+                    'parameter {param} for visualization '
                     '{vis}.').format(val=setting_val,
                                      param=setting,
                                      vis=self.__class__.__name__)
 
+        allowed_settings = self.ALLOWED_SETTINGS or {}
+        settings = settings or {}
+        values = {setting: allowed[0]
+                  for setting, allowed in allowed_settings.items()}
         for setting in settings:
-            if settings[setting] in self.ALLOWED_SETTINGS[setting]:
-                # if the setting is allowed, set the attribute but remove
-                # invalid variable characters
-                #
-                # see:
-                #
-                # https://stackoverflow.com/questions/3303312/how-do-i-convert-a-string-to-a-valid-variable-name-in-python
-                setattr(self, '_' + re.sub('\W|^(?=\d)', '_', setting).lower(),
-                        settings[setting])
-            else:
-                raise ValueError(error_string(settings[setting], setting))
+            if setting not in allowed_settings:
+                raise ValueError('{param} is not a setting of visualization '
+                                 '{vis}.'.format(param=setting,
+                                                 vis=self.__class__.__name__))
+            if settings[setting] not in allowed_settings[setting]:
+                raise ValueError(error_string(setting, settings[setting]))
+            values[setting] = settings[setting]
+        return Settings(values)
+
+    def estimate_cost(self, settings, num_inputs):
+        """Estimate the work of a call of `make_visualization`.
+
+        Used to schedule cheap calls first and to reject calls when the
+        server is overloaded.  Costs are measured in forward passes of single
+        examples; by default, each input takes one.
+
+        Args:
+            settings (:class:`Settings`): parsed settings of the call.
+            num_inputs (int): number of input images.
+
+        Returns:
+            int: the estimated cost
+
+        """
+        return num_inputs
+
+    def warm_up(self, batch_sizes):
+        """Run the model paths of the visualization which the prediction
+        path does not cover, e.g. gradients, on synthetic batches.
+
+        Called after the model has been loaded, before it serves requests.
+        By default, nothing is run.
+
+        Args:
+            batch_sizes (:obj:`list` of int): number of examples of each
+                synthetic batch.
+
+        Returns:
+            :obj:`list` of :obj:`dict` with the `batch_size` and the
+            `seconds` taken by each run, as :meth:`.BaseModel.warm_up`
+
+        """
+        return []
 
     def make_visualization(self, inputs, output_dir, settings=None):
         """Generate the visualization.
 
-        All visualizations must implement this method.
+        All visualizations must implement this method.  Implementations should
+        call `self.parse_settings(settings)` to validate the settings and fill
+        in defaults.
 
         Args:
             inputs (iterable of :class:`PIL.Image`): Batch of input images to
                 make visualizations for, as PIL :obj:`Image` objects.
             output_dir (:obj:`str`): A directory to write outputs (e.g.,
                 plots) to.
-            settings (:obj:`str`): Dictionary of settings that the user
-                selected, as a dict mapping setting names to values.  This
-                should only be provided if this class's `ALLOWED_SETTINGS`
-                attribute is non-null.
+            settings (:obj:`dict` or :class:`Settings`): Settings that the
+                user selected, as a mapping from setting names to values.
+                Settings that are not given take their default value.
 
         Returns:
             Object used to render the visualization, passed directly to the
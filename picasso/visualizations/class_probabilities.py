@@ -25,13 +25,11 @@ class ClassProbabilities(BaseVisualization):
 
     ALLOWED_SETTINGS = dict()
 
-    def make_visualization(self, inputs, output_dir):
-        pre_processed_arrays = self.model.preprocess([example['data']
-                                                      for example in inputs])
-        predictions = self.model.sess.run(self.model.tf_predict_var,
-                                          feed_dict={self.model.tf_input_var:
-                                                     pre_processed_arrays})
-        filtered_predictions = self.model.decode_prob(predictions)
+    def make_visualization(self, inputs, output_dir, settings=None):
+        self.parse_settings(settings)
+        _, _, _, filtered_predictions = self.model.preprocess_and_predict(
+            [example['data'] for example in inputs],
+            keys=[example.get('digest') for example in inputs])
         results = []
         for i, inp in enumerate(inputs):
             results.append({'input_file_name': inp['filename'],
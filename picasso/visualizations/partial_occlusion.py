@@ -16,10 +16,7 @@ import time
 import numpy as np
 from PIL import Image
 
-import matplotlib
-matplotlib.use('Agg')
-from matplotlib import pyplot
-
+from picasso.rendering import render_heatmap, save_png
 from picasso.visualizations.base import BaseVisualization
 
 
@@ -42,42 +39,55 @@ class PartialOcclusion(BaseVisualization):
     ALLOWED_SETTINGS = {
         'Window': ['0.50', '0.40', '0.30', '0.20', '0.10', '0.05'],
         'Strides': ['2', '5', '10', '20', '30'],
-        'Occlusion': ['grey', 'black', 'white']
+        'Occlusion': ['grey', 'black', 'white'],
+        'Mode': ['dense', 'adaptive']
     }
 
-    @property
-    def window(self):
-        return float(self._window)
+    # (:obj:`dict`): Pixel value of the occluding patch per 'Occlusion'
+    # setting.
+    OCCLUSION_VALUES = {'white': 255, 'black': 0, 'grey': 128}
 
-    @property
-    def num_windows(self):
-        return int(self._strides)
+    def __init__(self, model, memory_budget=128 * 2 ** 20,
+                 adaptive_threshold=0.05):
+        """Create a new partial occlusion visualization.
 
-    @property
-    def occlusion_method(self):
-        return self._occlusion
+        Args:
+            model (:obj:`.models.model.BaseModel`): NN model to be
+                visualized.
+            memory_budget (int): maximum number of bytes of occluded model
+                inputs to evaluate at once.  Larger sweeps are split into
+                chunks.  Activations grow with the chunk size, so this also
+                bounds the memory used by the model.
+            adaptive_threshold (float): in 'adaptive' mode, regions are
+                refined where occlusion lowers the probability of the top
+                class by more than this.
 
-    def __init__(self, model):
+        """
         super().__init__(model)
-        self.predict_tensor = self.get_predict_tensor()
+        self.memory_budget = memory_budget
+        self.adaptive_threshold = adaptive_threshold
 
         self.grid_percent = 0.01
-        self.occlusion_value = 255
         self.initial_resize = (244, 244)
+        self.output_size = (244, 244)
+
+    def estimate_cost(self, settings, num_inputs):
+        # one prediction per occluded copy of each input; 'adaptive' mode
+        # usually needs fewer, but the dense sweep is its upper bound
+        num_windows = int(self.parse_settings(settings).strides)
+        return num_inputs * (1 + num_windows ** 2)
 
-    def make_visualization(self, inputs, output_dir):
-        if self.occlusion_method == 'black':
-            self.occlusion_value = 0
-        elif self.occlusion_method == 'grey':
-            self.occlusion_value = 128
+    def make_visualization(self, inputs, output_dir, settings=None):
+        settings = self.parse_settings(settings)
+        window = float(settings.window)
+        num_windows = int(settings.strides)
+        occlusion_value = self.OCCLUSION_VALUES[settings.occlusion]
 
         # get class predictions as in ClassProbabilities
-        pre_processed_arrays = self.model.preprocess([example['data']
-                                                      for example in inputs])
-        class_predictions = self.model.sess.run(
-            self.model.tf_predict_var,
-            feed_dict={self.model.tf_input_var: pre_processed_arrays})
-        decoded_predictions = self.model.decode_prob(class_predictions)
+        prediction = self.model.preprocess_and_predict(
+            [example['data'] for example in inputs],
+            keys=[example.get('digest') for example in inputs])
+        _, top_indices, top_probs, decoded_predictions = prediction
 
         results = []
         for i, example in enumerate(inputs):
@@ -86,19 +96,30 @@ class PartialOcclusion(BaseVisualization):
             if self.initial_resize:
                 im = im.resize(self.initial_resize, Image.ANTIALIAS)
 
-            occ_im = self.occluded_images(im)
-            predictions = self.model.sess.run(
-                self.predict_tensor,
-                feed_dict={self.model.tf_input_var:
-                           self.model.preprocess(occ_im['occluded_images'])})
-
-            example_im = self.make_example_image(im,
-                                                 occ_im['centers_horizontal'],
-                                                 occ_im['centers_vertical'],
-                                                 occ_im['win_width'],
-                                                 occ_im['win_length'],
-                                                 occ_im['pad_vertical'],
-                                                 occ_im['pad_horizontal'])
+            # occlude the preprocessed image directly instead of
+            # preprocessing every occluded copy of it
+            base_array = self.model.preprocess([im])[0]
+            fill_array = self.model.preprocess(
+                [Image.fromarray(np.full_like(np.array(im),
+                                              occlusion_value))])[0]
+            class_indices = top_indices[i]
+            if settings.mode == 'adaptive':
+                predictions = self.adaptive_occlusion_predictions(
+                    base_array, fill_array, window, num_windows,
+                    class_indices, reference=top_probs[i][0],
+                    image_size=im.size)
+            else:
+                predictions = self.occlusion_predictions(
+                    base_array, fill_array, window, num_windows,
+                    class_indices, image_size=im.size)
+
+            geometry = self.occlusion_geometry(im.size[0], im.size[1],
+                                               window, num_windows)
+            example_im = self.make_example_image(
+                im, geometry['centers_horizontal'],
+                geometry['centers_vertical'], geometry['win_width'],
+                geometry['win_length'], geometry['pad_vertical'],
+                geometry['pad_horizontal'])
             example_filename = '{ts}{fn}'.format(ts=str(time.time()),
                                                  fn=example['filename'])
             example_im.save(
@@ -106,8 +127,7 @@ class PartialOcclusion(BaseVisualization):
                 format=im_format)
 
             filenames = self.make_heatmaps(
-                predictions, output_dir, example['filename'],
-                decoded_predictions=decoded_predictions[i])
+                predictions, output_dir, example['filename'], num_windows)
             results.append({'input_file_name': example['filename'],
                             'has_output': True,
                             'output_file_names': filenames,
@@ -116,75 +136,272 @@ class PartialOcclusion(BaseVisualization):
                             'processed_input_file_name': example_filename})
         return results
 
-    def get_predict_tensor(self):
-        # Assume that predict is the softmax
-        # tensor in the computation graph
-        return self.model.sess.graph.get_tensor_by_name(
-            self.model.tf_predict_var.name)
-
-    def make_heatmaps(self, predictions,
-                      output_dir, filename,
-                      decoded_predictions=None):
-        if decoded_predictions:
-            relevant_class_indices = [pred['index']
-                                      for pred in decoded_predictions]
-            predictions = predictions[:, relevant_class_indices]
-        stacked_heatmaps = predictions.reshape(self.num_windows,
-                                               self.num_windows,
+    def make_heatmaps(self, predictions, output_dir, filename, num_windows):
+        stacked_heatmaps = predictions.reshape(num_windows,
+                                               num_windows,
                                                predictions.shape[-1])
         filenames = []
         for i in range(predictions.shape[-1]):
             grid = stacked_heatmaps[:, :, i]
-            pyplot.axis('off')
-            if i == 0:
-                im = pyplot.imshow(grid, vmin=0, vmax=1)
-                pyplot.axis('off')
-                im.axes.get_xaxis().set_visible(False)
-                im.axes.get_yaxis().set_visible(False)
-            else:
-                im.set_data(grid)
             hm_filename = '{ts}{label}_{fn}'.format(ts=str(time.time()),
                                                     label=str(i),
                                                     fn=filename)
-            pyplot.savefig(os.path.join(output_dir, hm_filename),
-                           format='PNG', bbox_inches='tight', pad_inches=0)
+            save_png(render_heatmap(grid, self.output_size, vmin=0, vmax=1),
+                     os.path.join(output_dir, hm_filename))
             filenames.append(hm_filename)
         return filenames
 
-    def occluded_images(self, im):
-        width = im.size[0]
-        length = im.size[1]
-        win_width = round(self.window * width)
-        win_length = round(self.window * length)
+    def occlusion_geometry(self, width, length, window, num_windows):
+        """Size and positions of the occluding windows in an image.
+
+        Args:
+            width (int): width of the image in pixels.
+            length (int): height of the image in pixels.
+            window (float): size of a window relative to the image.
+            num_windows (int): number of window positions along each axis.
+
+        Returns:
+            :obj:`dict` with the window size (`win_width`, `win_length`), its
+            half size (`pad_horizontal`, `pad_vertical`) and the window
+            centers along each axis (`centers_horizontal`,
+            `centers_vertical`).
+
+        """
+        win_width = round(window * width)
+        win_length = round(window * length)
         pad_horizontal = win_width // 2
         pad_vertical = win_length // 2
         centers_horizontal, centers_vertical = self.get_centers(
             width, length, win_width, win_length, pad_horizontal, pad_vertical,
-            self.num_windows)
-        upper_left_corners = np.array(
-            [(w - pad_vertical, v - pad_horizontal)
-             for w in centers_vertical
-             for v in centers_horizontal]
-        )
-
-        images = []
-        for corner in upper_left_corners:
-            arr = np.array(im)
-            self.add_occlusion_to_arr(arr, corner,
-                                      win_width, win_length,
-                                      occ_val=self.occlusion_value)
-            images.append(
-                Image.fromarray(arr)
-            )
-
-        return {'occluded_images': images,
-                'centers_horizontal': centers_horizontal,
+            num_windows)
+        return {'centers_horizontal': centers_horizontal,
                 'centers_vertical': centers_vertical,
                 'win_width': win_width,
                 'win_length': win_length,
                 'pad_horizontal': pad_horizontal,
                 'pad_vertical': pad_vertical}
 
+    def occlusion_predictions(self, base_array, fill_array, window,
+                              num_windows, class_indices, indices=None,
+                              image_size=None):
+        """Predict the class probabilities of occluded images.
+
+        The sweep is evaluated in chunks of at most `self.memory_budget`
+        bytes of model input, and only the probabilities of the classes of
+        interest are kept.
+
+        Args:
+            base_array (array): a single preprocessed image.
+            fill_array (array): the preprocessed occluding color.
+            window (float): size of a window relative to the image.
+            num_windows (int): number of window positions along each axis.
+            class_indices (:obj:`list` of int): classes to keep.
+            indices (array): window positions to evaluate (see
+                `occluded_arrays`).  Defaults to all positions.
+            image_size (tuple): (width, height) of the image the windows
+                are laid out on (see `occluded_arrays`).
+
+        Returns:
+            array of shape (len(indices), len(class_indices)).
+
+        """
+        if indices is None:
+            indices = np.arange(num_windows ** 2)
+        indices = np.asarray(indices)
+        chunk_size = max(1, self.memory_budget // base_array.nbytes)
+        predictions = np.empty((len(indices), len(class_indices)),
+                               dtype='float32')
+        for start in range(0, len(indices), chunk_size):
+            predictions[start:start + chunk_size] = self.model.predict_classes(
+                self.occluded_arrays(
+                    base_array, fill_array, window, num_windows,
+                    indices=indices[start:start + chunk_size],
+                    image_size=image_size),
+                class_indices)
+        return predictions
+
+    def adaptive_occlusion_predictions(self, base_array, fill_array, window,
+                                       num_windows, class_indices, reference,
+                                       image_size=None):
+        """Predict class probabilities of occluded images coarse-to-fine.
+
+        A coarse grid of window positions, whose windows still cover the
+        whole image, is evaluated first.  The grid is then refined, halving
+        its spacing at every level, but only around positions where
+        occlusion lowered the probability of the top class by more than
+        `self.adaptive_threshold`.  Positions that were never
+        evaluated take the prediction of the nearest evaluated position.
+
+        Args:
+            base_array (array): a single preprocessed image.
+            fill_array (array): the preprocessed occluding color.
+            window (float): size of a window relative to the image.
+            num_windows (int): number of window positions along each axis.
+            class_indices (:obj:`list` of int): classes to keep.  The first
+                one is the top class.
+            reference (float): probability of the top class for the image
+                without occlusion.
+            image_size (tuple): (width, height) of the image the windows
+                are laid out on (see `occluded_arrays`).
+
+        Returns:
+            array of shape (num_windows ** 2, len(class_indices)), like
+            `occlusion_predictions`.
+
+        """
+        predictions = np.zeros((num_windows, num_windows, len(class_indices)),
+                               dtype='float32')
+        evaluated = np.zeros((num_windows, num_windows), dtype=bool)
+
+        def evaluate(candidates):
+            rows, cols = np.nonzero(candidates)
+            if len(rows):
+                predictions[rows, cols] = self.occlusion_predictions(
+                    base_array, fill_array, window, num_windows,
+                    class_indices, indices=rows * num_windows + cols,
+                    image_size=image_size)
+                evaluated[rows, cols] = True
+
+        # The windows of the coarsest grid must still cover the whole image,
+        # so that no region affecting the prediction is missed, and there
+        # should be at least three positions along each axis.
+        max_step = min(window * (num_windows - 1) / max(1 - window, 1e-6),
+                       (num_windows - 1) / 2)
+        step = 1
+        while 2 * step <= max_step:
+            step *= 2
+        evaluate(self._grid_mask(num_windows, step))
+
+        while step > 1:
+            step //= 2
+            drop = np.where(evaluated,
+                            reference - predictions[:, :, 0], -np.inf)
+            important = (self._max_filter(drop, 2 * step) >
+                         self.adaptive_threshold)
+            evaluate(self._grid_mask(num_windows, step) & ~evaluated &
+                     important)
+
+        # fill in positions that were not evaluated from their nearest
+        # evaluated neighbor
+        positions = np.indices((num_windows, num_windows)).reshape(2, -1).T
+        known = np.argwhere(evaluated)
+        distances = ((positions[:, None, :] -
+                      known[None, :, :]) ** 2).sum(axis=-1)
+        nearest = known[distances.argmin(axis=1)]
+        return predictions[nearest[:, 0], nearest[:, 1]]
+
+    @staticmethod
+    def _grid_mask(num_windows, step):
+        """Window positions on a grid with the given spacing, always
+        including the last position along each axis."""
+        on_grid = np.zeros(num_windows, dtype=bool)
+        on_grid[::step] = True
+        on_grid[-1] = True
+        return on_grid[:, None] & on_grid[None, :]
+
+    @staticmethod
+    def _max_filter(arr, radius):
+        """Maximum of each element's (2 * radius + 1) ** 2 neighborhood."""
+        padded = np.pad(arr, radius, mode='constant',
+                        constant_values=-np.inf)
+        result = np.full_like(arr, -np.inf)
+        for i in range(2 * radius + 1):
+            for j in range(2 * radius + 1):
+                result = np.maximum(result,
+                                    padded[i:i + arr.shape[0],
+                                           j:j + arr.shape[1]])
+        return result
+
+    def occlusion_boxes(self, input_size, window, num_windows,
+                        image_size=None):
+        """Pixel ranges of the occluding windows in the model input.
+
+        The windows are laid out on the image as in `occlusion_geometry`,
+        and then scaled to the model input, rounding outwards so that
+        every window covers at least one pixel of it.
+
+        Args:
+            input_size (tuple): (width, height) of the model input.
+            window (float): size of a window relative to the image.
+            num_windows (int): number of window positions along each axis.
+            image_size (tuple): (width, height) of the image the windows
+                are laid out on.  Defaults to `input_size`.
+
+        Returns:
+            tuple of the first and last (exclusive) rows of the windows
+            along the vertical axis, and their first and last (exclusive)
+            columns along the horizontal axis, each an array of
+            `num_windows` elements.
+
+        """
+        if image_size is None:
+            image_size = input_size
+        geometry = self.occlusion_geometry(image_size[0], image_size[1],
+                                           window, num_windows)
+
+        def scale(centers, pad, win, image_dim, input_dim):
+            starts = np.clip(centers - pad, 0, image_dim)
+            stops = np.clip(centers - pad + win, 0, image_dim)
+            factor = input_dim / image_dim
+            starts = np.minimum(np.floor(starts * factor).astype('int'),
+                                input_dim - 1)
+            stops = np.maximum(np.ceil(stops * factor).astype('int'),
+                               starts + 1)
+            return starts, np.minimum(stops, input_dim)
+
+        tops, bottoms = scale(geometry['centers_vertical'],
+                              geometry['pad_vertical'],
+                              geometry['win_length'],
+                              image_size[1], input_size[1])
+        lefts, rights = scale(geometry['centers_horizontal'],
+                              geometry['pad_horizontal'],
+                              geometry['win_width'],
+                              image_size[0], input_size[0])
+        return tops, bottoms, lefts, rights
+
+    def occluded_arrays(self, base_array, fill_array, window, num_windows,
+                        indices=None, image_size=None):
+        """Build a batch of occluded model inputs.
+
+        The windows are laid out on the image and scaled to the model input
+        (see `occlusion_boxes`), so the occlusion is applied to an already
+        preprocessed image.
+
+        Args:
+            base_array (array): a single preprocessed image, of shape
+                (height, width, channels).
+            fill_array (array): the preprocessed occluding color, of the same
+                shape as `base_array`.
+            window (float): size of a window relative to the image.
+            num_windows (int): number of window positions along each axis.
+            indices (array): window positions to build, where position
+                `i * num_windows + j` is the `i`-th vertical and `j`-th
+                horizontal one.  Defaults to all positions.
+            image_size (tuple): (width, height) of the image the windows
+                are laid out on.  Defaults to the size of `base_array`.
+
+        Returns:
+            array of shape (len(indices), height, width, channels), holding
+            the image occluded at each of the positions.
+
+        """
+        if indices is None:
+            indices = np.arange(num_windows ** 2)
+        indices = np.asarray(indices)
+        length, width = base_array.shape[:2]
+        tops, bottoms, lefts, rights = self.occlusion_boxes(
+            (width, length), window, num_windows, image_size)
+
+        rows = np.arange(length)
+        cols = np.arange(width)
+        row_mask = ((rows >= tops[:, None]) & (rows < bottoms[:, None]))
+        col_mask = ((cols >= lefts[:, None]) & (cols < rights[:, None]))
+        # (position, row, column)
+        mask = (row_mask[indices // num_windows][:, :, None] &
+                col_mask[indices % num_windows][:, None, :])
+        mask = mask.reshape(mask.shape + (1,) * (base_array.ndim - 2))
+        return np.where(mask, fill_array, base_array)
+
     def make_example_image(self, im,
                            centers_horizontal, centers_vertical,
                            win_width, win_length, pad_vertical,
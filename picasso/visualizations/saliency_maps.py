@@ -16,10 +16,7 @@ import time
 import numpy as np
 import tensorflow as tf
 
-import matplotlib
-matplotlib.use('Agg')
-from matplotlib import pyplot
-
+from picasso.rendering import render_heatmap, save_png
 from picasso.visualizations.base import BaseVisualization
 
 
@@ -40,12 +37,24 @@ class SaliencyMaps(BaseVisualization):
 
     ALLOWED_SETTINGS = {'Transparency': ['0.0', '0.25', '0.5', '0.75']}
 
-    @property
-    def transparency(self):
-        return float(self._transparency)
-
-    def __init__(self, model, logit_tensor_name=None):
+    def __init__(self, model, logit_tensor_name=None,
+                 memory_budget=16 * 2 ** 20):
+        """Create a new saliency map visualization.
+
+        Args:
+            model (:obj:`.models.model.BaseModel`): NN model to be
+                visualized.
+            logit_tensor_name (:obj:`str`): name of the tensor holding the
+                class logits.  Defaults to the input of the last softmax.
+            memory_budget (int): maximum number of bytes of model inputs to
+                evaluate gradients for at once.  Each input is repeated once
+                per displayed class, and larger batches are split into
+                chunks.  Activations and their gradients grow with the chunk
+                size, so this also bounds the memory used by the model.
+
+        """
         super().__init__(model)
+        self.memory_budget = memory_budget
         if logit_tensor_name:
             self.logit_tensor = self.model.sess.graph.get_tensor_by_name(
                 logit_tensor_name)
@@ -53,47 +62,109 @@ class SaliencyMaps(BaseVisualization):
             self.logit_tensor = self.get_logit_tensor()
 
         self.input_shape = self.model.tf_input_var.get_shape()[1:].as_list()
-
-    def get_gradient_wrt_class(self, class_index):
-        gradient_name = 'bv_{class_index}_gradient'.format(
-            class_index=class_index)
+        self.output_size = (244, 244)
+        self.num_classes = self.logit_tensor.get_shape().as_list()[-1]
+        self.class_weights, self.class_gradient = self.build_class_gradient()
+
+    def build_class_gradient(self):
+        """Gradient of weighted class logits with respect to the input.
+
+        The class weights are fed per example, so with one-hot weights each
+        row of the result is the gradient of the selected class logit of the
+        corresponding input.  Many (image, class) pairs can thus be evaluated
+        with a single run, and the graph doesn't grow with the number of
+        classes users look at.  The ops are only added once per graph; later
+        calls, e.g. from a second instance, reuse them.
+
+        Returns:
+            :obj:`tuple` of the class weight placeholder, with shape
+            (num_examples, num_classes), and the gradient tensor, with the
+            shape of the model's input.
+
+        """
+        graph = self.model.sess.graph
         try:
-            return self.model.sess.graph.get_tensor_by_name(
-                '{}:0'.format(gradient_name))
+            return (graph.get_tensor_by_name('bv_class_weights:0'),
+                    graph.get_tensor_by_name('bv_class_gradient:0'))
         except KeyError:
-            class_logit = tf.slice(self.logit_tensor,
-                                   [0, class_index],
-                                   [1, 1])
-            return tf.gradients(class_logit,
-                                self.model.tf_input_var,
-                                name=gradient_name)[0]
-
-    def make_visualization(self, inputs, output_dir):
-
-        pre_processed_arrays = self.model.preprocess([example['data']
-                                                     for example in inputs])
-
-        # get predictions
-        predictions = self.model.sess.run(self.model.tf_predict_var,
-                                          feed_dict={self.model.tf_input_var:
-                                                     pre_processed_arrays})
-        decoded_predictions = self.model.decode_prob(predictions)
+            with graph.as_default():
+                class_weights = tf.placeholder(self.logit_tensor.dtype,
+                                               shape=[None, self.num_classes],
+                                               name='bv_class_weights')
+                weighted_logits = tf.reduce_sum(self.logit_tensor *
+                                                class_weights)
+                gradient = tf.gradients(weighted_logits,
+                                        self.model.tf_input_var)[0]
+                gradient = tf.identity(gradient, name='bv_class_gradient')
+            return class_weights, gradient
+
+    def estimate_cost(self, settings, num_inputs):
+        # one prediction and one gradient per displayed class of each input
+        return num_inputs * (1 + self.model.top_probs)
+
+    def warm_up(self, batch_sizes):
+        latencies = []
+        for inputs in self.model.synthetic_batches(batch_sizes):
+            start = time.time()
+            self.model.run(self.class_gradient,
+                           {self.model.tf_input_var: inputs,
+                            self.class_weights: np.zeros(
+                                (len(inputs), self.num_classes),
+                                dtype='float32')})
+            latencies.append({'batch_size': len(inputs),
+                              'seconds': time.time() - start})
+        return latencies
+
+    def class_gradients(self, arrays, class_indices):
+        """Gradients of class logits with respect to preprocessed inputs.
+
+        The gradients of all (input, class) pairs are evaluated in batches:
+        row i * top_probs + j belongs to class j of input i.  Batches
+        hold at most `self.memory_budget` bytes of (repeated) inputs.
+
+        Args:
+            arrays (array): preprocessed inputs, as returned by
+                `self.model.preprocess`.
+            class_indices (array): classes of each input, of shape
+                (num_inputs, top_probs).
+
+        Returns:
+            array of shape (num_inputs, top_probs) + the input shape
+
+        """
+        num_inputs, top_probs = class_indices.shape
+        num_rows = num_inputs * top_probs
+        chunk_size = max(1, self.memory_budget // arrays[0].nbytes)
+        gradients = np.empty((num_rows,) + arrays.shape[1:],
+                             dtype=arrays.dtype)
+        for start in range(0, num_rows, chunk_size):
+            rows = np.arange(start, min(start + chunk_size, num_rows))
+            one_hot = np.zeros((len(rows), self.num_classes),
+                               dtype='float32')
+            one_hot[np.arange(len(rows)), class_indices.ravel()[rows]] = 1
+            gradients[rows] = self.model.run(
+                self.class_gradient,
+                {self.model.tf_input_var: arrays[rows // top_probs],
+                 self.class_weights: one_hot})
+        return gradients.reshape((num_inputs, top_probs) + arrays.shape[1:])
+
+    def make_visualization(self, inputs, output_dir, settings=None):
+        settings = self.parse_settings(settings)
+        transparency = float(settings.transparency)
+
+        # get predictions, shared with the other visualizations
+        prediction = self.model.preprocess_and_predict(
+            [example['data'] for example in inputs],
+            keys=[example.get('digest') for example in inputs])
+        pre_processed_arrays, _, _, decoded_predictions = prediction
+
+        class_indices = np.array([[pred['index'] for pred in decoded]
+                                  for decoded in decoded_predictions])
+        gradients = self.class_gradients(pre_processed_arrays, class_indices)
 
         results = []
         for i, inp in enumerate(inputs):
-            class_gradients = []
-            relevant_class_indices = [pred['index']
-                                      for pred in decoded_predictions[i]]
-            gradients_wrt_class = [self.get_gradient_wrt_class(index)
-                                   for index in relevant_class_indices]
-            for gradient_wrt_class in gradients_wrt_class:
-                class_gradients.append([self.model.sess.run(
-                    gradient_wrt_class,
-                    feed_dict={self.model.tf_input_var: [arr]})
-                    for arr in pre_processed_arrays])
-
-            output_arrays = np.array([gradient[i]
-                                      for gradient in class_gradients])
+            output_arrays = gradients[i]
             # if images are color, take the maximum channel
             if output_arrays.shape[-1] == 3:
                 output_arrays = output_arrays.max(-1)
@@ -105,29 +176,15 @@ class SaliencyMaps(BaseVisualization):
             output_images = output_arrays.reshape([-1] + self.input_shape[0:2])
 
             output_fns = []
-            pyplot.clf()
             for j, output_image in enumerate(output_images):
                 output_fn = '{fn}-{j}-{ts}.png'.format(ts=str(time.time()),
                                                        j=j,
                                                        fn=inp['filename'])
-
-                if j == 0:
-                    pyplot.imshow(inputs[i]['data']
-                                  .resize(output_image.shape)
-                                  .convert('RGB'),
-                                  alpha=self.transparency)
-
-                    im = pyplot.imshow(output_image,
-                                       alpha=1. - self.transparency,
-                                       cmap='inferno')
-                    pyplot.axis('off')
-                    im.axes.get_xaxis().set_visible(False)
-                    im.axes.get_yaxis().set_visible(False)
-                else:
-                    im.set_data(output_image)
-
-                pyplot.savefig(os.path.join(output_dir, output_fn),
-                               bbox_inches='tight', pad_inches=0)
+                save_png(render_heatmap(output_image, self.output_size,
+                                        cmap='inferno',
+                                        underlay=inp['data'],
+                                        alpha=1. - transparency),
+                         os.path.join(output_dir, output_fn))
                 output_fns.append(output_fn)
 
             results.append({'input_file_name': inp['filename'],
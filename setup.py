@@ -29,7 +29,6 @@ requirements = [
     'Jinja2>=2.9.5',
     'Keras>=1.2.2',
     'MarkupSafe>=0.23',
-    'matplotlib>=2.0.0',
     'numpy>=1.12.0',
     'olefile>=0.44',
     'packaging>=16.8',
@@ -23,6 +23,8 @@ Tests for `picasso` module.
 """
 import os
 
+import pytest
+
 
 class TestBaseModel:
 
@@ -34,6 +36,33 @@ class TestBaseModel:
             assert result[0]['index'] == example_prob_array[i].argmax()
             assert result[0]['name'] == str(result[0]['index'])
 
+    def test_overridden_decode_prob_labels_predictions(self):
+        import numpy as np
+        from PIL import Image
+        from picasso.models.base import BaseModel
+
+        class LabelledModel(BaseModel):
+            def load(self, data_dir):
+                pass
+
+            def run(self, fetches, feed_dict):
+                assert fetches == 'predict'
+                return np.tile([[0.1, 0.7, 0.2]], (len(feed_dict['input']), 1))
+
+            def decode_prob(self, class_probabilities):
+                return [[{'name': 'cat', 'prob': str(row.max())}]
+                        for row in class_probabilities]
+
+        model = LabelledModel(top_probs=2)
+        model._tf_input_var = 'input'
+        model._tf_predict_var = 'predict'
+        model.preprocess = lambda images: np.zeros((len(images), 2))
+        _, indices, probs, decoded = model.preprocess_and_predict(
+            [Image.new('L', (2, 2))])
+        assert indices.tolist() == [[1, 2]]
+        assert np.allclose(probs, [[0.7, 0.2]])
+        assert decoded == [[{'name': 'cat', 'prob': '0.7'}]]
+
 
 class TestKerasModel:
 
@@ -70,3 +99,932 @@ class TestTensorflowBackend:
             tf_input_var='convolution2d_input_1:0')
         assert tensorflow_model.tf_predict_var is not None
         assert tensorflow_model.tf_input_var is not None
+
+
+class TestFrozenModel:
+
+    def test_freeze_and_load(self, tmpdir):
+        import numpy as np
+        from picasso.models.base import load_model
+        from picasso.models.frozen import FrozenModel, freeze_model
+
+        example_dir = os.path.join('picasso', 'examples', 'tensorflow')
+        model_cls_path = os.path.join(example_dir, 'model.py')
+        model = load_model(model_cls_path, 'TensorflowMNISTModel',
+                           {'data_dir': os.path.join(example_dir,
+                                                     'data-volume'),
+                            'tf_predict_var': 'Softmax:0',
+                            'tf_input_var': 'convolution2d_input_1:0'})
+        metadata = freeze_model(model, str(tmpdir.join('mnist.pb')),
+                                model_cls_path, 'TensorflowMNISTModel')
+        assert metadata['num_nodes'] < len(model.sess.graph_def.node)
+
+        frozen = FrozenModel()
+        frozen.load(str(tmpdir))
+        inputs = np.random.random((2, 28, 28, 1)).astype('float32')
+        assert np.allclose(frozen.predict(inputs),
+                           model.run(model.tf_predict_var,
+                                     {model.tf_input_var: inputs}))
+        assert frozen.get_fetches()['top_k_values'].name == \
+            'bv_top_k_values:0'
+
+
+class TestModelRegistry:
+
+    def test_model_loaded_once(self, tmpdir):
+        from picasso.models.registry import ModelRegistry
+
+        model_file = tmpdir.join('model.py')
+        model_file.write(
+            'from picasso.models.base import BaseModel\n'
+            'LOADS = []\n'
+            'class CountingModel(BaseModel):\n'
+            '    def load(self, data_dir):\n'
+            '        LOADS.append(data_dir)\n')
+        registry = ModelRegistry()
+        args = {'data_dir': str(tmpdir)}
+
+        first = registry.get(str(model_file), 'CountingModel', args)
+        second = registry.get(str(model_file), 'CountingModel', dict(args))
+
+        assert first is second
+        assert len(registry.entries()) == 1
+        entry = registry.entries()[0]
+        assert entry.load_time >= 0
+        assert entry.memory_footprint == 0
+
+    def test_evicts_idle_models_least_recently_used(self, tmpdir):
+        from picasso.models.registry import ModelRegistry
+
+        model_file = tmpdir.join('model.py')
+        model_file.write(
+            'from picasso.models.base import BaseModel\n'
+            'class Model(BaseModel):\n'
+            '    def load(self, data_dir):\n'
+            '        pass\n')
+        registry = ModelRegistry()
+        entries = {}
+        for name in ['a', 'b', 'c']:
+            entries[name] = registry.get_entry(str(model_file), 'Model',
+                                               {'data_dir': name},
+                                               acquire=True)
+        entries['a'].release()
+        entries['b'].release()
+        # touch a, so b is the least recently used
+        entries['a'].acquire().release()
+
+        assert registry.evict(max_models=1) == [entries['b'], entries['a']]
+        assert entries['a'].closed and entries['b'].closed
+        assert registry.entries() == [entries['c']]
+        assert registry.get_loaded(str(model_file), 'Model',
+                                   {'data_dir': 'a'}) is None
+
+    def test_warm_up_latencies_recorded(self, tmpdir):
+        from picasso.models.registry import ModelRegistry
+
+        model_file = tmpdir.join('model.py')
+        model_file.write(
+            'from picasso.models.base import BaseModel\n'
+            'class Model(BaseModel):\n'
+            '    def load(self, data_dir):\n'
+            '        pass\n')
+        warmed_up = []
+
+        def warm_up(entry):
+            warmed_up.append(entry.model)
+            return {'predict': [{'batch_size': 1, 'seconds': 0.5}]}
+
+        registry = ModelRegistry()
+        entry = registry.get_entry(str(model_file), 'Model',
+                                   {'data_dir': str(tmpdir)},
+                                   warm_up=warm_up)
+        assert warmed_up == [entry.model]
+        assert entry.stats()['warm_up_latencies'] == \
+            {'predict': [{'batch_size': 1, 'seconds': 0.5}]}
+
+    def test_retired_entry_closed_after_release(self, base_model):
+        from picasso.models.registry import ModelEntry
+        from picasso.visualizations.base import BaseVisualization
+
+        entry = ModelEntry(base_model, 0, 0)
+        entry.visualizations = {'BaseVisualization':
+                                BaseVisualization(base_model)}
+        entry.acquire()
+        entry.retire()
+        assert not entry.closed
+        entry.release()
+        assert entry.closed
+        # the visualizations must not keep the closed model alive
+        assert entry.visualizations == {}
+
+
+class TestWarmUpOnStart:
+
+    def test_run_starts_warm_up_before_serving(self, monkeypatch):
+        import flask
+        import picasso
+
+        calls = []
+        monkeypatch.setattr(picasso, 'start_warm_up',
+                            lambda: calls.append('warm_up'))
+        monkeypatch.setattr(flask.Flask, 'run',
+                            lambda *args, **kwargs: calls.append('serve'))
+        monkeypatch.delenv('WERKZEUG_RUN_MAIN', raising=False)
+        app = picasso.create_app()
+        assert calls == []
+
+        app.run()
+        assert calls == ['warm_up', 'serve']
+
+        # the reloader's parent process only watches files
+        del calls[:]
+        app.run(use_reloader=True)
+        assert calls == ['serve']
+        monkeypatch.setenv('WERKZEUG_RUN_MAIN', 'true')
+        app.run(use_reloader=True)
+        assert calls == ['serve', 'warm_up', 'serve']
+
+        del calls[:]
+        app.config['WARM_UP_ON_START'] = False
+        app.run()
+        assert calls == ['serve']
+
+
+class TestCheckpointWatcher:
+
+    def test_reload_once_files_settle(self, tmpdir):
+        from picasso.models.watcher import CheckpointWatcher
+
+        changes = []
+        watcher = CheckpointWatcher(str(tmpdir), lambda: changes.append(1))
+        assert not watcher.poll()
+        tmpdir.join('weights-2.h5').write('partial')
+        assert not watcher.poll()
+        tmpdir.join('weights-2.h5').write('complete')
+        assert not watcher.poll()
+        assert watcher.poll()
+        assert not watcher.poll()
+        assert changes == [1]
+
+
+class TestBaseVisualization:
+
+    def test_parse_settings(self, base_model):
+        from picasso.visualizations.base import BaseVisualization
+
+        class VisForTest(BaseVisualization):
+            ALLOWED_SETTINGS = {'Window': ['0.50', '0.10'],
+                                'Occlusion': ['grey', 'black']}
+
+        vis = VisForTest(base_model)
+        settings = vis.parse_settings({'Window': '0.10'})
+        assert settings.window == '0.10'
+        assert settings['Occlusion'] == 'grey'
+        with pytest.raises(AttributeError):
+            settings.window = '0.50'
+        with pytest.raises(ValueError):
+            vis.parse_settings({'Window': '0.99'})
+        with pytest.raises(ValueError):
+            vis.parse_settings({'Unknown': 'x'})
+
+
+class TestInferenceScheduler:
+
+    def test_concurrent_runs_are_batched(self):
+        import threading
+        import numpy as np
+        from picasso.models.scheduler import InferenceScheduler
+
+        class Tensor:
+            def __init__(self, name):
+                self.name = name
+
+        inp, out = Tensor('input:0'), Tensor('output:0')
+
+        class Session:
+            batch_sizes = []
+
+            def run(self, fetches, feed_dict):
+                self.batch_sizes.append(len(feed_dict[inp]))
+                return [feed_dict[inp] * 2 for _ in fetches]
+
+        sess = Session()
+        scheduler = InferenceScheduler(sess, max_batch_size=8, max_delay=0.2)
+        results = {}
+
+        def call(i):
+            results[i] = scheduler.run(out, {inp: np.array([[i]])})
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        scheduler.close()
+
+        assert {i: int(results[i][0, 0]) for i in results} == \
+            {i: 2 * i for i in range(4)}
+        assert sum(sess.batch_sizes) == 4
+        assert len(sess.batch_sizes) < 4
+
+    def test_failed_batch_keeps_worker_alive(self):
+        import threading
+        import numpy as np
+        import pytest
+        from picasso.models.scheduler import InferenceScheduler
+
+        class Tensor:
+            def __init__(self, name):
+                self.name = name
+
+        inp, out = Tensor('input:0'), Tensor('output:0')
+
+        class Session:
+            def run(self, fetches, feed_dict):
+                if feed_dict[inp].dtype == np.float32:
+                    raise ValueError('bad input')
+                return [feed_dict[inp] * 2 for _ in fetches]
+
+        scheduler = InferenceScheduler(Session(), max_batch_size=8,
+                                       max_delay=0.2)
+        results = {}
+
+        def call(width):
+            results[width] = scheduler.run(out, {inp: np.ones((1, width))})
+
+        # examples of different shapes are never concatenated
+        threads = [threading.Thread(target=call, args=(width,))
+                   for width in (3, 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert {width: results[width].shape for width in results} == \
+            {3: (1, 3), 4: (1, 4)}
+
+        with pytest.raises(ValueError):
+            scheduler.run(out, {inp: np.ones((1, 3), dtype=np.float32)})
+        assert scheduler.run(out, {inp: np.ones((1, 3))}).sum() == 6
+        scheduler.close()
+
+
+class TestPartialOcclusion:
+
+    @pytest.fixture
+    def occlusion(self, base_model):
+        from picasso.visualizations.partial_occlusion import PartialOcclusion
+        return PartialOcclusion(base_model)
+
+    def test_occluded_arrays(self, occlusion):
+        import numpy as np
+
+        base = np.random.rand(20, 30, 3)
+        fill = np.zeros_like(base)
+        arrays = occlusion.occluded_arrays(base, fill, 0.3, 3)
+        assert np.array_equal(
+            occlusion.occluded_arrays(base, fill, 0.3, 3, indices=[4, 7]),
+            arrays[[4, 7]])
+
+        assert arrays.shape == (9, 20, 30, 3)
+        geometry = occlusion.occlusion_geometry(30, 20, 0.3, 3)
+        for i, top in enumerate(geometry['centers_vertical'] -
+                                geometry['pad_vertical']):
+            for j, left in enumerate(geometry['centers_horizontal'] -
+                                     geometry['pad_horizontal']):
+                expected = base.copy()
+                occlusion.add_occlusion_to_arr(
+                    expected, (top, left), geometry['win_width'],
+                    geometry['win_length'])
+                assert np.array_equal(arrays[i * 3 + j], expected)
+
+    def test_every_window_occludes_small_inputs(self, occlusion):
+        import numpy as np
+
+        # windows laid out on the 244px image, applied to a 28px input
+        base = np.ones((28, 28, 1))
+        fill = np.zeros_like(base)
+        for window in occlusion.ALLOWED_SETTINGS['Window']:
+            for strides in occlusion.ALLOWED_SETTINGS['Strides']:
+                arrays = occlusion.occluded_arrays(
+                    base, fill, float(window), int(strides),
+                    image_size=(244, 244))
+                occluded = (arrays == 0).reshape(len(arrays), -1)
+                assert occluded.any(axis=1).all(), (window, strides)
+                # the windows scale with the input
+                assert occluded.sum(axis=1).max() <= \
+                    (np.ceil(float(window) * 28) + 1) ** 2
+
+    def test_make_heatmaps(self, occlusion, tmpdir):
+        import numpy as np
+        from PIL import Image
+
+        purple, yellow = [68, 1, 84], [253, 231, 37]
+        predictions = np.array([[0., 1.], [1., 0.], [1., 1.], [0., 0.]])
+        filenames = occlusion.make_heatmaps(predictions, str(tmpdir),
+                                            '9.png', 2)
+
+        assert len(filenames) == 2
+        expected = [np.array([[purple, yellow], [yellow, purple]]),
+                    np.array([[yellow, purple], [yellow, purple]])]
+        for filename, cells in zip(filenames, expected):
+            heatmap = np.array(Image.open(tmpdir.join(filename).strpath))
+            assert np.array_equal(
+                heatmap, cells.repeat(122, axis=0).repeat(122, axis=1))
+
+    def test_occlusion_predictions_are_chunked(self, occlusion):
+        import numpy as np
+
+        batch_sizes = []
+
+        def predict_classes(batch, class_indices):
+            batch_sizes.append(len(batch))
+            return batch.reshape(len(batch), -1)[:, class_indices]
+
+        occlusion.model.predict_classes = predict_classes
+        base = np.random.rand(10, 10, 1).astype('float32')
+        occlusion.memory_budget = 4 * base.nbytes
+        predictions = occlusion.occlusion_predictions(
+            base, np.zeros_like(base), 0.2, 5, [3, 0])
+
+        assert batch_sizes == [4, 4, 4, 4, 4, 4, 1]
+        expected = occlusion.occluded_arrays(
+            base, np.zeros_like(base), 0.2, 5).reshape(25, -1)[:, [3, 0]]
+        assert np.array_equal(predictions, expected)
+
+    def test_adaptive_occlusion_predictions(self, occlusion):
+        import numpy as np
+
+        num_windows = 17
+        # the top class drops when a window covers position (12, 3)
+        drop = np.zeros((num_windows, num_windows))
+        drop[8:17, 0:8] = 0.5
+        num_evaluated = []
+
+        def occlusion_predictions(base_array, fill_array, window,
+                                  num_windows, class_indices, indices=None,
+                                  image_size=None):
+            num_evaluated.append(len(indices))
+            top = 1 - drop.ravel()[indices]
+            return np.stack([top, 1 - top], axis=1)
+
+        occlusion.occlusion_predictions = occlusion_predictions
+        predictions = occlusion.adaptive_occlusion_predictions(
+            None, None, 0.5, num_windows, [0, 1], reference=1.)
+
+        assert predictions.shape == (num_windows ** 2, 2)
+        heatmap = predictions[:, 0].reshape(num_windows, num_windows)
+        assert np.allclose(heatmap, 1 - drop)
+        assert sum(num_evaluated) < num_windows ** 2 / 2
+
+
+class TestSaliencyMaps:
+
+    def test_class_gradients_are_chunked(self, base_model):
+        import numpy as np
+        from picasso.visualizations.base import BaseVisualization
+        from picasso.visualizations.saliency_maps import SaliencyMaps
+
+        batches = []
+
+        def run(fetches, feed_dict):
+            inputs = feed_dict[base_model.tf_input_var]
+            weights = feed_dict[saliency.class_weights]
+            batches.append(len(inputs))
+            # gradient of input * class index
+            return inputs * weights.argmax(1).reshape(-1, 1, 1)
+
+        # skip building the gradient op, which needs a graph
+        saliency = SaliencyMaps.__new__(SaliencyMaps)
+        BaseVisualization.__init__(saliency, base_model)
+        base_model.run = run
+        saliency.num_classes = 10
+        saliency.class_weights = 'class_weights'
+        saliency.class_gradient = 'class_gradient'
+        arrays = np.random.rand(3, 4, 5).astype('float32')
+        saliency.memory_budget = 4 * arrays[0].nbytes
+        class_indices = np.array([[2, 7], [0, 1], [9, 3]])
+
+        gradients = saliency.class_gradients(arrays, class_indices)
+        assert batches == [4, 2]
+        assert gradients.shape == (3, 2, 4, 5)
+        for i in range(3):
+            for j in range(2):
+                assert np.allclose(gradients[i, j],
+                                   arrays[i] * class_indices[i, j])
+
+
+class TestRendering:
+
+    def test_render_heatmap(self):
+        import numpy as np
+        from picasso.rendering import COLORMAPS, render_heatmap
+
+        values = np.array([[0., 1.], [0.5, 1.]])
+        rendered = render_heatmap(values, (4, 6), vmin=0, vmax=1)
+
+        assert rendered.shape == (6, 4, 3)
+        assert rendered.dtype == np.uint8
+        assert (rendered[0, 0] == COLORMAPS['viridis'][0]).all()
+        assert (rendered[-1, -1] == COLORMAPS['viridis'][-1]).all()
+
+    def test_render_heatmap_pixels(self):
+        import numpy as np
+        from picasso.rendering import render_heatmap
+
+        purple, yellow = [68, 1, 84], [253, 231, 37]
+        values = np.array([[0., 1., 2.], [1., -1., 0.]])
+        rendered = render_heatmap(values, (6, 4), vmin=0, vmax=1)
+
+        # every cell is a 2x2 block, values are clipped to [vmin, vmax]
+        expected = np.array([[purple, yellow, yellow],
+                             [yellow, purple, purple]], dtype='uint8')
+        assert np.array_equal(rendered,
+                              expected.repeat(2, axis=0).repeat(2, axis=1))
+
+    @pytest.mark.parametrize('cmap', ['viridis', 'inferno'])
+    def test_colormaps_match_matplotlib(self, cmap):
+        import numpy as np
+        from picasso.rendering import COLORMAPS, LUT_SIZE
+        plt = pytest.importorskip('matplotlib.pyplot')
+
+        reference = plt.get_cmap(cmap, LUT_SIZE)(np.arange(LUT_SIZE))
+        reference = (reference[:, :3] * 255).round()
+        # the tables are interpolated from a few anchor colors
+        assert np.abs(COLORMAPS[cmap] - reference).max() <= 6
+
+    def test_render_heatmap_reference_images(self):
+        import numpy as np
+        from PIL import Image
+        from picasso.rendering import render_heatmap
+
+        res_path = './tests/resources/rendering/'
+        # a sweep of occlusion probabilities, as rendered by
+        # PartialOcclusion
+        occlusion = render_heatmap(np.linspace(0, 1, 25).reshape(5, 5),
+                                   (244, 244), vmin=0, vmax=1)
+        assert np.array_equal(
+            occlusion, np.array(Image.open(res_path + 'occlusion.png')))
+
+        # a gradient over the input image, as rendered by SaliencyMaps
+        underlay = Image.open('./tests/resources/input/9.png')
+        saliency = render_heatmap(np.outer(np.arange(7), np.arange(7)) / 36.,
+                                  (244, 244), cmap='inferno',
+                                  underlay=underlay, alpha=0.6)
+        assert np.array_equal(
+            saliency, np.array(Image.open(res_path + 'saliency.png')))
+
+
+class TestDecodeProb:
+
+    def test_top_k_matches_full_sort(self, base_model):
+        import numpy as np
+
+        probs = np.random.random((20, 1000))
+        indices, top_probs = base_model.top_k(probs, k=7)
+
+        expected = np.argsort(-probs, axis=-1)[:, :7]
+        assert np.array_equal(indices, expected)
+        assert np.array_equal(top_probs,
+                              np.take_along_axis(probs, expected, axis=-1))
+
+    def test_class_table(self, base_model, example_prob_array):
+        base_model.load_class_table = lambda num_classes: {
+            'code': ['n{:02d}'.format(i) for i in range(num_classes)],
+            'name': ['class {}'.format(i) for i in range(num_classes)]}
+        results = base_model.decode_prob(example_prob_array)
+        for i, result in enumerate(results):
+            index = example_prob_array[i].argmax()
+            assert len(result) == base_model.top_probs
+            assert result[0] == {
+                'index': index,
+                'code': 'n{:02d}'.format(index),
+                'name': 'class {}'.format(index),
+                'prob': '{:.3f}'.format(example_prob_array[i].max())}
+
+
+class TestResultCache:
+
+    def test_lru_eviction(self):
+        from picasso.cache import LRUCache
+
+        cache = LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+        assert 'b' not in cache
+        assert cache.get('a') == 1 and cache.get('c') == 3
+
+    def test_disk_tier_restores_files(self, tmpdir):
+        from picasso.cache import ResultCache
+
+        output_dir = tmpdir.mkdir('out')
+        output_dir.join('heatmap.png').write_binary(b'png')
+        results = [{'input_file_name': 'x.png', 'has_output': True,
+                    'has_processed_input': False,
+                    'output_file_names': ['heatmap.png']}]
+        cache = ResultCache(memory_entries=1,
+                            disk_dir=str(tmpdir.join('cache')),
+                            disk_bytes=2 ** 20)
+        key = cache.make_key(['hash'], 'Vis', {'Setting': 'a'}, 'ckpt')
+        assert key != cache.make_key(['hash'], 'Vis', {'Setting': 'b'},
+                                     'ckpt')
+        cache.put(key, results, str(output_dir))
+        # evict from memory, so the entry is read from disk
+        cache.memory.clear()
+
+        new_dir = tmpdir.mkdir('new')
+        assert cache.get(key, str(new_dir)) == results
+        assert new_dir.join('heatmap.png').read_binary() == b'png'
+
+        cache.disk_bytes = 0
+        cache._evict_disk()
+        cache.memory.clear()
+        assert cache.get(key, str(new_dir)) is None
+
+
+class TestPredictionMemo:
+
+    def test_predictions_shared_between_calls(self, base_model,
+                                              monkeypatch):
+        import numpy as np
+        from PIL import Image
+        import picasso.models.base
+
+        calls = []
+
+        def run_top_k(arrays):
+            calls.append(len(arrays))
+            return (np.tile([[1, 0]], (len(arrays), 1)),
+                    np.tile([[0.9, 0.1]], (len(arrays), 1)))
+
+        base_model.preprocess = lambda images: np.array(
+            [np.array(image, dtype='float32') / 255. for image in images])
+        base_model.run_top_k = run_top_k
+        base_model.decode_top_k = lambda indices, probs: [
+            [{'index': int(index)} for index in row] for row in indices]
+
+        a = Image.new('L', (4, 4), 0)
+        b = Image.new('L', (4, 4), 255)
+        arrays, indices, _, decoded = base_model.preprocess_and_predict([a])
+        assert calls == [1]
+        arrays, indices, _, decoded = base_model.preprocess_and_predict(
+            [b, a.copy()])
+        # only the new image is run through the model
+        assert calls == [1, 1]
+        assert arrays.shape == (2, 4, 4)
+        assert arrays[0].max() == 1. and arrays[1].max() == 0.
+        assert decoded == [[{'index': 1}, {'index': 0}]] * 2
+
+        preprocessed = []
+        preprocess = base_model.preprocess
+        base_model.preprocess = lambda images: (
+            preprocessed.append(len(images)) or preprocess(images))
+        base_model._latest_ckpt_name = 'new-checkpoint'
+        base_model.preprocess_and_predict([a])
+        assert calls == [1, 1, 1]
+        # the preprocessed array doesn't depend on the checkpoint
+        assert preprocessed == []
+
+        # uploads are identified by their digest, without hashing pixels
+        monkeypatch.setattr(picasso.models.base, 'hash_image', None)
+        base_model.preprocess_and_predict([b, b], keys=['d', 'd'])
+        base_model.preprocess_and_predict([b], keys=['d'])
+        assert preprocessed == [2]
+        assert calls == [1, 1, 1, 2]
+
+    def test_single_flight(self):
+        import threading
+        import time
+        from picasso.cache import SingleFlight
+
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'result'
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flights.do('key', compute)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(
+            target=lambda: results.append(flights.do('key', compute)))
+            for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        # give the followers time to join the running call
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        assert len(calls) == 1
+        assert sorted(results) == [('result', False)] + [('result', True)] * 3
+        assert len(flights) == 0
+
+
+class TestJobManager:
+
+    def test_jobs_run_in_background(self):
+        import threading
+        from picasso.jobs import Job, JobManager
+
+        manager = JobManager(num_workers=1)
+        release = threading.Event()
+        running = manager.submit(lambda: release.wait(5) and 'done')
+        queued = manager.submit(lambda: 'never')
+        failing = manager.submit(lambda: 1 / 0)
+
+        assert manager.cancel(queued.id)
+        assert not manager.cancel(queued.id)
+        assert queued.status == Job.CANCELLED
+
+        release.set()
+        manager.shutdown()
+        assert running.status == Job.DONE and running.result == 'done'
+        assert failing.status == Job.FAILED and 'division' in failing.error
+        assert queued.result is None
+        with pytest.raises(RuntimeError):
+            manager.submit(lambda: None)
+
+    def test_finished_jobs_are_forgotten(self):
+        from picasso.jobs import JobManager
+
+        manager = JobManager(num_workers=1, max_finished=2)
+        jobs = [manager.submit(lambda: None) for _ in range(3)]
+        manager.shutdown()
+        assert manager.get(jobs[0].id) is None
+        assert manager.get(jobs[2].id) is jobs[2]
+
+    def test_cheap_jobs_first_and_overload(self):
+        import threading
+        from picasso.jobs import JobManager, Overloaded
+
+        manager = JobManager(num_workers=1, max_backlog=100)
+        release = threading.Event()
+        order = []
+        manager.submit(lambda: release.wait(5), cost=10)
+        manager.submit(lambda: order.append('expensive'), cost=80)
+        manager.submit(lambda: order.append('cheap'), cost=5)
+        assert manager.backlog == 95
+        with pytest.raises(Overloaded) as e:
+            manager.submit(lambda: None, cost=10)
+        assert e.value.retry_after >= 1
+
+        release.set()
+        manager.shutdown()
+        assert order == ['cheap', 'expensive']
+        assert manager.backlog == 0
+
+    def test_waiting_jobs_age(self):
+        import threading
+        import time
+        from picasso.jobs import JobManager, JobTimeout
+
+        manager = JobManager(num_workers=1, aging_rate=1000)
+        release = threading.Event()
+        order = []
+        blocker = manager.submit(lambda: release.wait(5))
+        with pytest.raises(JobTimeout):
+            blocker.wait(0.01)
+        manager.submit(lambda: order.append('expensive'), cost=50)
+        time.sleep(0.1)
+        # waited long enough to go before cheaper, newer jobs
+        manager.submit(lambda: order.append('cheap'), cost=1)
+
+        release.set()
+        manager.shutdown()
+        assert order == ['expensive', 'cheap']
+
+
+class TestSessionStore:
+
+    @pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+    def test_images_indexed_by_uid(self, backend):
+        from picasso.sessions import make_session_store
+
+        store = make_session_store(backend)
+        sid = store.create({'img_input_dir': '/tmp/in'})
+        other = store.create({})
+        for i in range(3):
+            image = store.add_image(sid, {'filename': '{}.png'.format(i)})
+            assert image['uid'] == i
+        assert store.add_image(other, {'filename': 'x.png'})['uid'] == 0
+
+        assert store.get_image(sid, 1) == {'filename': '1.png', 'uid': 1}
+        assert store.get_image(sid, 3) is None
+        assert [image['uid'] for image in store.list_images(sid)] == [0, 1, 2]
+
+        # the latest upload with a name wins
+        store.add_image(sid, {'filename': '1.png', 'size': 2})
+        assert store.find_image(sid, '1.png') == \
+            {'filename': '1.png', 'size': 2, 'uid': 3}
+        assert store.find_image(sid, 'x.png') is None
+        assert store.find_image(other, 'x.png')['uid'] == 0
+
+        store.update(sid, settings={'Strides': '10'})
+        assert store.get(sid) == {'img_input_dir': '/tmp/in',
+                                  'settings': {'Strides': '10'}}
+        store.delete(sid)
+        assert store.get(sid) is None
+        assert store.list_images(sid) == []
+        assert store.find_image(sid, '1.png') is None
+        assert store.get_image(other, 0)['filename'] == 'x.png'
+        # e.g. deleted by garbage collection during a request
+        store.update(sid, settings={})
+        assert store.get(sid) is None
+
+
+class TestStorageManager:
+
+    def make_session(self, manager, num_bytes, content=b'x'):
+        import io
+
+        data = manager.create_session_dirs()
+        sid = manager.session_store.create(data)
+        manager.add_upload(sid, data, io.BytesIO(content * num_bytes),
+                           'a.png')
+        return sid, data
+
+    def test_quotas_and_expiry(self, tmpdir):
+        from picasso.sessions import MemorySessionStore
+        from picasso.storage import QuotaExceeded, StorageManager
+
+        store = MemorySessionStore()
+        manager = StorageManager(store, root=str(tmpdir),
+                                 session_quota=100, global_quota=250,
+                                 ttl=60)
+        old_sid, old_data = self.make_session(manager, 100, b'o')
+        sid, data = self.make_session(manager, 100, b's')
+        with pytest.raises(QuotaExceeded):
+            manager.reserve(sid, data, 1)
+
+        # the least recently used session makes room for a new one
+        store._sessions[old_sid]['last_access'] -= 10
+        new_sid, new_data = self.make_session(manager, 100, b'n')
+        assert store.get(old_sid) is None
+        assert not os.path.exists(old_data['img_output_dir'])
+        assert manager.usage()['num_sessions'] == 2
+
+        store._sessions[sid]['last_access'] -= 61
+        assert manager.collect() == 100
+        assert store.get(sid) is None
+        assert store.get(new_sid) is not None
+        assert sorted(tmpdir.listdir()) == sorted([
+            tmpdir.join('blobs'),
+            tmpdir.join(os.path.basename(
+                os.path.dirname(new_data['img_output_dir'])))])
+        assert manager.usage()['upload_bytes'] == 100
+
+    def test_uploads_shared_by_content(self, tmpdir):
+        import io
+        from picasso.sessions import MemorySessionStore
+        from picasso.storage import StorageManager
+
+        store = MemorySessionStore()
+        manager = StorageManager(store, root=str(tmpdir))
+        sid, data = self.make_session(manager, 100)
+        other_sid, other_data = self.make_session(manager, 100)
+        image = manager.add_upload(sid, data, io.BytesIO(b'x' * 100),
+                                   'b.png')
+        assert [i['hash'] for i in store.list_images(other_sid)] == \
+            [image['hash']]
+        assert manager.usage()['upload_bytes'] == 100
+        assert manager.session_usage(sid, data) == 200
+
+        path = manager.upload_path(image)
+        manager.delete_session(sid, data)
+        assert os.path.exists(path)
+        manager.delete_session(other_sid, other_data)
+        assert not os.path.exists(path)
+        assert manager.usage()['upload_bytes'] == 0
+
+    def test_reservations_and_outputs_count(self, tmpdir):
+        from picasso.sessions import MemorySessionStore
+        from picasso.storage import QuotaExceeded, StorageManager
+
+        store = MemorySessionStore()
+        manager = StorageManager(store, root=str(tmpdir),
+                                 session_quota=100, global_quota=250)
+        data = manager.create_session_dirs()
+        sid = store.create(data)
+
+        # an upload in progress counts until it has been added
+        manager.reserve(sid, data, 60)
+        with pytest.raises(QuotaExceeded):
+            manager.reserve(sid, data, 60)
+        manager.release_reservation(sid, 60)
+        manager.reserve(sid, data, 60)
+        manager.release_reservation(sid, 60)
+
+        output = os.path.join(data['img_output_dir'], 'out.png')
+        with open(output, 'wb') as f:
+            f.write(b'x' * 101)
+        manager.add_output([output])
+        assert manager.usage()['used_bytes'] == 101
+        with pytest.raises(QuotaExceeded):
+            manager.reserve_output(sid, data)
+
+        # an output written again is counted once
+        manager.add_output([output])
+        assert manager.session_usage(sid, data) == 101
+
+    def test_usage_counted_without_scanning(self, tmpdir, monkeypatch):
+        import picasso.storage
+        from picasso.sessions import MemorySessionStore
+        from picasso.storage import QuotaExceeded, StorageManager
+
+        store = MemorySessionStore()
+        manager = StorageManager(store, root=str(tmpdir),
+                                 global_quota=250, min_collect_interval=60)
+        sid, data = self.make_session(manager, 100, b'a')
+        output = os.path.join(data['img_output_dir'], 'out.png')
+        with open(output, 'wb') as f:
+            f.write(b'x' * 50)
+        manager.add_output([output])
+        other_sid, other_data = self.make_session(manager, 100, b'b')
+
+        # a restarted server measures the existing sessions once
+        restarted = StorageManager(store, root=str(tmpdir),
+                                   global_quota=250, min_collect_interval=60)
+        restarted.restore_references()
+        assert restarted.collect() == 250
+
+        def fail(*args):
+            raise AssertionError('scanned the disk or the session store')
+
+        monkeypatch.setattr(picasso.storage, 'file_sizes', fail)
+        monkeypatch.setattr(store, 'list_images', fail)
+        assert restarted.session_usage(sid, data) == 150
+        restarted.reserve_output(other_sid, other_data)
+
+        # garbage collection to make room is rate-limited
+        collections = []
+        monkeypatch.setattr(restarted, 'collect',
+                            lambda **kwargs: collections.append(kwargs))
+        with pytest.raises(QuotaExceeded):
+            restarted.reserve(other_sid, other_data, 1)
+        assert collections == []
+
+    def test_concurrent_deletions_release_uploads_once(self, tmpdir):
+        import threading
+        import time
+        from picasso.sessions import MemorySessionStore
+        from picasso.storage import StorageManager
+
+        class SlowStore(MemorySessionStore):
+            def list_images(self, sid):
+                images = super().list_images(sid)
+                time.sleep(0.05)
+                return images
+
+        store = SlowStore()
+        manager = StorageManager(store, root=str(tmpdir))
+        sid, data = self.make_session(manager, 100)
+        other_sid, _ = self.make_session(manager, 100)
+        path = manager.upload_path(store.list_images(other_sid)[0])
+
+        threads = [threading.Thread(target=manager.delete_session,
+                                    args=(sid, data)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the other session still holds the upload
+        assert os.path.exists(path)
+        assert manager.usage()['upload_bytes'] == 100
+
+
+class TestUploads:
+
+    def test_decode_scales_down(self):
+        import io
+        from PIL import Image
+        from picasso.uploads import decode_image
+
+        encoded = io.BytesIO()
+        Image.new('RGB', (2000, 1000), 'red').save(encoded, format='JPEG')
+        encoded.seek(0)
+        image = decode_image(encoded, max_size=(200, 200))
+        assert image.size == (200, 100)
+        assert image.format == 'JPEG'
+
+    def test_invalid_uploads(self):
+        import io
+        from PIL import Image
+        from picasso.uploads import InvalidUpload, decode_image
+
+        with pytest.raises(InvalidUpload):
+            decode_image(io.BytesIO(b'not an image'))
+        encoded = io.BytesIO()
+        Image.new('L', (100, 100)).save(encoded, format='PNG')
+        encoded.seek(0)
+        with pytest.raises(InvalidUpload):
+            decode_image(encoded, max_pixels=100)
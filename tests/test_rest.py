@@ -6,19 +6,23 @@ from flask import url_for
 from PIL import Image, ImageChops
 
 
+# size of the heatmaps rendered by the visualizations
+OUTPUT_SIZE = (244, 244)
+
+
 def verify_data(client, data, vis, prefix=''):
     res_path = './tests/resources/'
     assert data['input_file_name']
     assert data['predict_probs']
     if data['has_output']:
-        assert data['output_file_names']
-        i = 1
+        assert len(data['output_file_names']) == len(data['predict_probs'])
         for filename in data['output_file_names']:
-            actual_image = client.get(url_for('api.download_outputs', filename=filename)).data
-            actual_processed_input = Image.open(io.BytesIO(actual_image))
-            expected_processed_input = Image.open(res_path + vis.__name__ + '/' + prefix + 'output/' + str(i) + '.png')
-            assert ImageChops.difference(actual_processed_input, expected_processed_input).getbbox() is None
-            i += 1
+            response = client.get(url_for('api.download_outputs', filename=filename))
+            assert response.status_code == 200
+            actual_output = Image.open(io.BytesIO(response.data))
+            assert actual_output.format == 'PNG'
+            assert actual_output.size == OUTPUT_SIZE
+            assert actual_output.mode == 'RGB'
     if data['has_processed_input']:
         assert data['processed_input_file_name']
         filename = data['processed_input_file_name']
@@ -42,6 +46,17 @@ class TestRestAPI:
         assert data['latest_ckpt_time']
         assert data['model_name']
 
+    def test_health_probes(self, client):
+        live = client.get(url_for('api.health_live'))
+        assert live.status_code == 200
+        assert json.loads(live.get_data(as_text=True))['alive']
+        client.get(url_for('api.app_state'))
+        ready = client.get(url_for('api.health_ready'))
+        assert ready.status_code == 200
+        data = json.loads(ready.get_data(as_text=True))
+        assert data['ready']
+        assert 'predict' in data['warm_up_latencies']
+
     def test_api_uploading_file(self, client, random_image_files):
         upload_file = str(random_image_files.listdir()[0])
         with open(upload_file, "rb") as imageFile:
@@ -102,3 +117,37 @@ class TestRestAPI:
     def test_visualizers_information(self, client, vis):
         response = client.get(url_for('api.visualizers_information', vis_name=vis.__name__))
         assert response.status_code == 200
+
+    def test_visualize_batch(self, client, test_image):
+        uids = []
+        for name in ['a.png', 'b.png']:
+            with open(test_image, "rb") as imageFile:
+                upload_data = {'file': (io.BytesIO(imageFile.read()), name)}
+            upload_response = client.post(url_for('api.images'),
+                                          data=upload_data)
+            uids.append(json.loads(
+                upload_response.get_data(as_text=True))['uid'])
+        response = client.post(
+            url_for('api.visualize_batch'),
+            data=json.dumps({'images': uids,
+                             'visualizers': [
+                                 'ClassProbabilities',
+                                 {'name': 'PartialOcclusion',
+                                  'settings': {'Strides': '5'}}]}),
+            content_type='application/json')
+        assert response.status_code == 200
+        results = json.loads(response.get_data(as_text=True))['results']
+        assert [result['visualizer'] for result in results] == [
+            'ClassProbabilities', 'PartialOcclusion']
+        assert results[1]['settings']['Strides'] == '5'
+        for result in results:
+            assert [output['input_file_name']
+                    for output in result['outputs']] == ['a.png', 'b.png']
+
+    def test_visualize_batch_unknown_image(self, client):
+        response = client.post(
+            url_for('api.visualize_batch'),
+            data=json.dumps({'images': [12345],
+                             'visualizers': ['ClassProbabilities']}),
+            content_type='application/json')
+        assert response.status_code == 400